@@ -46,6 +46,7 @@ from gi.repository import Gio
 from gettext import gettext as _
 
 import lib.document
+import lib.tiledsurface
 from lib import brush
 from lib import helpers
 from lib import mypaintlib
@@ -367,6 +368,9 @@ class Application (object):
         self._transient_msg_context_id = context_id
         self._transient_msg_remove_timeout_id = None
 
+        # Periodic compression of tiles nobody is using
+        self._tile_sweep_timeout_id = None
+
         # Profiling & debug stuff
         self.profiler = gui.profiling.Profiler()
 
@@ -430,6 +434,10 @@ class Application (object):
         self._apply_pressure_mapping_settings()
         self._apply_button_mapping_settings()
         self._apply_autosave_settings()
+        self._apply_rendering_settings()
+        self._apply_memory_settings()
+        self._apply_saving_settings()
+        self._apply_loading_settings()
         self.preferences_window.update_ui()
 
     def load_settings(self):
@@ -479,6 +487,10 @@ class Application (object):
             'ui.toolbar_icon_size': 'large',
             'ui.dark_theme_variant': True,
             'saving.default_format': 'openraster',
+            'saving.workers': 2,
+            'saving.tile_index': False,
+            'loading.workers': 2,
+            'loading.lazy': False,
             'brushmanager.selected_brush': None,
             'brushmanager.selected_groups': [],
             'frame.color_rgba': (0.12, 0.12, 0.12, 0.92),
@@ -487,6 +499,9 @@ class Application (object):
             'document.autosave_backups': True,
             'document.autosave_interval': 10,
 
+            'display.render_cache_mib': 64,
+            'memory.cold_tile_seconds': 300,
+            'memory.raw_tile_budget_mib': 0,
             'display.colorspace': "srgb",
             # sRGB is a good default even for OS X since v10.6 / Snow
             # Leopard: http://support.apple.com/en-us/HT3712.
@@ -612,6 +627,57 @@ class Application (object):
         model.autosave_backups = active
         model.autosave_interval = interval
 
+    def _apply_rendering_settings(self):
+        cache_mib = self.preferences["display.render_cache_mib"]
+        logger.debug("Applying rendering settings: cache=%rMiB", cache_mib)
+        layer_stack = self.doc.model.layer_stack
+        layer_stack.render_cache_budget = int(cache_mib) * 1024 * 1024
+
+    def _apply_saving_settings(self):
+        workers = self.preferences["saving.workers"]
+        logger.debug("Applying saving settings: workers=%r", workers)
+        self.doc.model.save_workers = max(1, int(workers))
+        tile_index = bool(self.preferences["saving.tile_index"])
+        logger.debug("Applying saving settings: tile_index=%r", tile_index)
+        self.doc.model.save_tile_index = tile_index
+
+    def _apply_loading_settings(self):
+        workers = self.preferences["loading.workers"]
+        logger.debug("Applying loading settings: workers=%r", workers)
+        self.doc.model.load_workers = max(1, int(workers))
+        lazy = bool(self.preferences["loading.lazy"])
+        logger.debug("Applying loading settings: lazy=%r", lazy)
+        self.doc.model.load_lazily = lazy
+
+    #: How often to look for tiles to compress, in seconds
+    TILE_SWEEP_INTERVAL = 15
+
+    def _apply_memory_settings(self):
+        idle = self.preferences["memory.cold_tile_seconds"]
+        budget_mib = self.preferences["memory.raw_tile_budget_mib"]
+        logger.debug(
+            "Applying memory settings: cold_tile_seconds=%r, "
+            "raw_tile_budget=%rMiB",
+            idle, budget_mib,
+        )
+        compressor = lib.tiledsurface.tile_compressor
+        compressor.idle_seconds = (idle or None)
+        compressor.max_bytes = (int(budget_mib) * 1024 * 1024) or None
+        timeout_id = self._tile_sweep_timeout_id
+        if compressor.enabled and timeout_id is None:
+            timeout_id = GLib.timeout_add_seconds(
+                interval=self.TILE_SWEEP_INTERVAL,
+                function=self._tile_sweep_timer_cb,
+                )
+        elif not compressor.enabled and timeout_id is not None:
+            GLib.source_remove(timeout_id)
+            timeout_id = None
+        self._tile_sweep_timeout_id = timeout_id
+
+    def _tile_sweep_timer_cb(self):
+        lib.tiledsurface.tile_compressor.sweep_in_background()
+        return True
+
     def save_gui_config(self):
         Gtk.AccelMap.save(join(self.user_confpath, 'accelmap.conf'))
         workspace = self.workspace
@@ -673,6 +673,12 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
 
     """
 
+    ## Class constants
+
+    #: Model changes spanning more tiles than this are redrawn as one
+    #: area, rather than tile by tile.
+    MAX_REDRAW_TILES = 256
+
     ## Method defs
 
     def __init__(self, tdw, idle_redraw_priority=None):
@@ -681,8 +687,11 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
 
         self.connect("draw", self._draw_cb)
         self._idle_redraw_priority = idle_redraw_priority
-        self._idle_redraw_queue = []
         self._idle_redraw_src_id = None
+        # Pending redraws, passed on to GTK together by an idle callback
+        self._redraw_all = False
+        self._redraw_tiles = set()  # model tiles, at mipmap level 0
+        self._redraw_areas = []  # display coords
 
         self.connect("state-changed", self._state_changed_cb)
 
@@ -858,58 +867,112 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
             self.queue_draw()
             return
 
-        # Create an expose event with the event bbox rotated/zoomed.
-        corners = [(x, y), (x+w, y), (x, y+h), (x+w, y+h)]
-        corners = [self.model_to_display(x, y) for (x, y) in corners]
-        bbox = helpers.rotated_rectangle_bbox(corners)
-        self.queue_draw_area(*bbox)
+        # Damage is tracked as the model tiles touched, so that changes
+        # far apart don't make everything between them be redrawn too.
+        N = tiledsurface.N
+        tx0, ty0 = int(floor(x)) // N, int(floor(y)) // N
+        tx1, ty1 = (int(ceil(x + w)) - 1) // N, (int(ceil(y + h)) - 1) // N
+        if (tx1 - tx0 + 1) * (ty1 - ty0 + 1) > self.MAX_REDRAW_TILES:
+            bbox = self._model_rect_to_display_bbox(x, y, w, h)
+            self.queue_draw_area(*bbox)
+            return
+        if self._redraw_all:
+            return
+        self._redraw_tiles.update(
+            (tx, ty)
+            for ty in xrange(ty0, ty1 + 1)
+            for tx in xrange(tx0, tx1 + 1)
+        )
+        self._queue_idle_redraw()
 
     def queue_draw(self):
-        if self._idle_redraw_priority is None:
-            gtk.DrawingArea.queue_draw(self)
-            return
-        self._queue_idle_redraw(None)
+        self._redraw_all = True
+        self._redraw_tiles.clear()
+        self._redraw_areas[:] = []
+        self._queue_idle_redraw()
 
     def queue_draw_area(self, x, y, w, h):
-        if self._idle_redraw_priority is None:
-            gtk.DrawingArea.queue_draw_area(self, x, y, w, h)
+        if self._redraw_all:
             return
-        bbox = helpers.Rect(x, y, w, h)
-        self._queue_idle_redraw(bbox)
-
-    def _queue_idle_redraw(self, bbox):
-        queue = self._idle_redraw_queue
-        if bbox is None:
-            queue[:] = []
-        elif None in queue:
-            return
-        else:
-            queue[:] = [b for b in queue if not bbox.contains(b)]
-            for b in queue:
-                if b.contains(bbox):
-                    return
-        queue.append(bbox)
+        self._redraw_areas.append((x, y, w, h))
+        self._queue_idle_redraw()
+
+    def _queue_idle_redraw(self):
+        """Pass on the pending redraws to GTK when next idle
+
+        Redraws are batched up until then, so changes from several
+        events make up one draw. Without an explicit idle priority,
+        the callback runs before GTK's own redraw handling.
+
+        """
         if self._idle_redraw_src_id is not None:
             return
+        priority = self._idle_redraw_priority
+        if priority is None:
+            priority = glib.PRIORITY_HIGH_IDLE
         src_id = glib.idle_add(
             self._idle_redraw_cb,
-            priority = self._idle_redraw_priority,
+            priority = priority,
         )
         self._idle_redraw_src_id = src_id
 
     def _idle_redraw_cb(self):
         assert self._idle_redraw_src_id is not None
-        queue = self._idle_redraw_queue
-        if len(queue) > 0:
-            bbox = queue.pop(0)
-            if bbox is None:
-                gtk.DrawingArea.queue_draw(self)
-            else:
+        self._idle_redraw_src_id = None
+        if self._redraw_all:
+            gtk.DrawingArea.queue_draw(self)
+        else:
+            # GTK accumulates these into the region handed to _draw_cb.
+            areas = self._redraw_areas
+            areas.extend(self._get_tile_redraw_areas(self._redraw_tiles))
+            for bbox in areas:
                 gtk.DrawingArea.queue_draw_area(self, *bbox)
-        if len(queue) == 0:
-            self._idle_redraw_src_id = None
-            return False
-        return True
+        self._redraw_all = False
+        self._redraw_tiles.clear()
+        self._redraw_areas[:] = []
+        return False
+
+    def _get_tile_redraw_areas(self, tiles):
+        """Display areas covering some model tiles, as rendered
+
+        :param set tiles: (tx, ty) model tiles, at mipmap level 0
+        :returns: (x, y, w, h) display areas
+        :rtype: list
+
+        The tiles are first reduced to those of the mipmap level the
+        canvas is rendered at, then adjacent ones in each row are
+        covered by a single area.
+
+        """
+        level = self._get_render_mipmap_level()
+        size = tiledsurface.N << level
+        rows = {}
+        for (tx, ty) in set((tx >> level, ty >> level) for (tx, ty) in tiles):
+            rows.setdefault(ty, []).append(tx)
+        areas = []
+        for ty, txs in rows.iteritems():
+            txs.sort()
+            run_start = run_end = txs[0]
+            for tx in txs[1:] + [None]:
+                if tx == run_end + 1:
+                    run_end = tx
+                    continue
+                areas.append(self._model_rect_to_display_bbox(
+                    run_start * size, ty * size,
+                    (run_end - run_start + 1) * size, size,
+                ))
+                run_start = run_end = tx
+        return areas
+
+    def _model_rect_to_display_bbox(self, x, y, w, h):
+        """Display bbox of a model rectangle, rotated/zoomed"""
+        if self.is_translation_only():
+            # Same as _tile_is_visible(), so neighbours aren't included
+            dx, dy = self.model_to_display(x, y)
+            return (int(dx), int(dy), w, h)
+        corners = [(x, y), (x+w, y), (x, y+h), (x+w, y+h)]
+        corners = [self.model_to_display(x, y) for (x, y) in corners]
+        return helpers.rotated_rectangle_bbox(corners)
 
     ## Redraw events
 
@@ -1036,7 +1099,7 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
             return surf
 
         # Render just what we need.
-        transformation, surface, sparse, mipmap_level, clip_rect = \
+        transformation, surface, sparse, mipmap_level, clip_rects = \
             self._render_prepare(cr)
         display_filter = None
         if use_filter:
@@ -1047,7 +1110,7 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
             surface,
             sparse,
             mipmap_level,
-            clip_rect,
+            clip_rects,
             filter = display_filter,
         )
         surf.flush()
@@ -1091,7 +1154,7 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
 
         # Prep a pixbuf-surface aligned to the model to render into.
         # This also applies the transformation.
-        transformation, surface, sparse, mipmap_level, clip_rect = \
+        transformation, surface, sparse, mipmap_level, clip_rects = \
             self._render_prepare(cr)
 
         # not sure if it is a good idea to clip so tightly
@@ -1112,7 +1175,7 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
             surface,
             sparse,
             mipmap_level,
-            clip_rect,
+            clip_rects,
             filter = self.display_filter,
         )
 
@@ -1139,7 +1202,7 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
         return True
 
     def _render_get_clip_region(self, cr, device_bbox):
-        """Get the area that needs to be updated, in device coords.
+        """Get the areas that need to be updated, in device coords.
 
         Called when handling "draw" events.  This uses Cairo's clip
         region, which ultimately derives from the areas sent by
@@ -1150,15 +1213,17 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
 
         :param cairo.Context cr: as passed to the "draw" event handler.
         :param tuple device_bbox: (x,y,w,h) widget extents
-        :returns: (clipregion, sparse)
+        :returns: (clip_rects, sparse)
         :rtype: tuple
 
-        The clip region return value is a lib.helpers.Rect containing
-        the area to redraw in display coordinates, or None.
+        The clip region return value is a list of lib.helpers.Rects
+        making up the area to redraw in display coordinates, or None.
 
         This also determines whether the redraw is "sparse", meaning
-        that the clip region returned does not contain the centre of the
-        device bbox.
+        that the clip region is made of several separate rectangles, or
+        that it does not contain the centre of the device bbox. Only
+        the tiles within the clip rectangles are rendered for sparse
+        redraws.
 
         """
 
@@ -1174,6 +1239,19 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
         x, y, w, h = device_bbox
         cx, cy = x+w/2, y+h/2
 
+        # Where pycairo can return the clip region's rectangles, the
+        # redraw areas queued from separate tiles stay separate.
+        try:
+            rect_list = cr.copy_clip_rectangle_list()
+        except (AttributeError, cairo.Error):
+            rect_list = None
+        if rect_list and len(rect_list) > 1:
+            rects = [
+                helpers.Rect(int(rx), int(ry), int(rw), int(rh))
+                for (rx, ry, rw, rh) in rect_list
+            ]
+            return rects, True
+
         # As of 2012-07-08, Ubuntu Precise (LTS, unfortunately) and Debian
         # unstable(!) use python-cairo 1.8.8, which does not support
         # the cairo.Region return from Gdk.Window.get_clip_region() we
@@ -1205,13 +1283,14 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
                 or cy < rect.y
                 or cy > (rect.y + rect.h)
             )
+            rects = [rect]
         else:
-            rect = None
+            rects = None
             sparse = False
 
-        return rect, sparse
+        return rects, sparse
 
-    def _tile_is_visible(self, tx, ty, transformation, clip_rect,
+    def _tile_is_visible(self, tx, ty, transformation, clip_rects,
                          translation_only):
         """Tests whether an individual tile is visible.
 
@@ -1246,7 +1325,10 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
             ]
             bbox = helpers.rotated_rectangle_bbox(corners)
         tile_rect = helpers.Rect(*bbox)
-        return clip_rect.overlaps(tile_rect)
+        for clip_rect in clip_rects:
+            if clip_rect.overlaps(tile_rect):
+                return True
+        return False
 
     def _render_prepare(self, cr):
         """Prepares a blank pixbuf & other details for later rendering.
@@ -1262,7 +1344,7 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
         allocation = self.get_allocation()
         w, h = allocation.width, allocation.height
         device_bbox = (0, 0, w, h)
-        clip_rect, sparse = self._render_get_clip_region(cr, device_bbox)
+        clip_rects, sparse = self._render_get_clip_region(cr, device_bbox)
         x, y, w, h = device_bbox
 
         # Use a copy of the cached translation matrix for this
@@ -1270,18 +1352,7 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
         # greater than zero.
         transformation = cairo.Matrix(*self._get_model_view_transformation())
 
-        # HQ rendering causes a very clear slowdown on some hardware.
-        # Probably could avoid this entirely by rendering differently,
-        # but for now, if the canvas is being panned around,
-        # just render more simply.
-        if self._hq_rendering:
-            mipmap_level = max(0, int(floor(log(1.0/self.scale, 2))))
-        else:
-            mipmap_level = max(0, int(ceil(log(1/self.scale, 2))))
-
-        # OPTIMIZE: If we would render tile scanlines,
-        # OPTIMIZE:  we could probably use the better one above...
-        mipmap_level = min(mipmap_level, tiledsurface.MAX_MIPMAP_LEVEL)
+        mipmap_level = self._get_render_mipmap_level()
         transformation.scale(2**mipmap_level, 2**mipmap_level)
 
         # bye bye device coordinates
@@ -1307,10 +1378,25 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
         # https://bugs.freedesktop.org/show_bug.cgi?id=28670
 
         surface = pixbufsurface.Surface(x1, y1, x2-x1+1, y2-y1+1)
-        return transformation, surface, sparse, mipmap_level, clip_rect
+        return transformation, surface, sparse, mipmap_level, clip_rects
+
+    def _get_render_mipmap_level(self):
+        """The mipmap level to render at, for the current view"""
+        # HQ rendering causes a very clear slowdown on some hardware.
+        # Probably could avoid this entirely by rendering differently,
+        # but for now, if the canvas is being panned around,
+        # just render more simply.
+        if self._hq_rendering:
+            mipmap_level = max(0, int(floor(log(1.0/self.scale, 2))))
+        else:
+            mipmap_level = max(0, int(ceil(log(1/self.scale, 2))))
+
+        # OPTIMIZE: If we would render tile scanlines,
+        # OPTIMIZE:  we could probably use the better one above...
+        return min(mipmap_level, tiledsurface.MAX_MIPMAP_LEVEL)
 
     def _render_execute(self, cr, transformation, surface, sparse,
-                        mipmap_level, clip_rect, filter=None):
+                        mipmap_level, clip_rects, filter=None):
         """Renders tiles into a prepared pixbufsurface, then blits it.
 
 
@@ -1333,7 +1419,7 @@ class CanvasRenderer (gtk.DrawingArea, DrawCursorMixin):
                     tx,
                     ty,
                     transformation,
-                    clip_rect,
+                    clip_rects,
                     translation_only,
                 )
             ]
@@ -12,6 +12,14 @@
 
 import abc
 import uuid
+import sys
+import time
+import threading
+import collections
+import logging
+logger = logging.getLogger(__name__)
+
+from gi.repository import GLib
 
 
 class Autosaveable:
@@ -69,7 +77,8 @@ class Autosaveable:
         be skipped.
 
         :param unicode oradir: Root of OpenRaster-like structure
-        :param lib.idletask.Processor taskproc: Output: queue of tasks
+        :param taskproc: Output: queue of tasks
+        :type taskproc: Writer or lib.idletask.Processor
         :param set manifest: Output: files in data/ to retain afterward
         :param tuple bbox: frame bounding box, (x,y,w,h)
         :param \*\*kwargs: To be passed to underlying save routines.
@@ -95,7 +104,10 @@ class Autosaveable:
 
         It follows that snapshots should be used for auto-saving,
         because the user can make changes between the queued tasks
-        as the queue is run.
+        as the queue is run. The Writer runs tasks in a thread of its
+        own, so they must not touch live model data at all. Tasks
+        which have to can be marked to run in the main thread instead:
+        see `Writer`.
 
         The returned element should contain sub-elements for any
         sub-layers, and the queue operation should recursively call this
@@ -112,3 +124,184 @@ class Autosaveable:
         https://tavianator.com/2014/06/the-visitor-pattern-in-python/)
 
         """
+
+
+class Writer (object):
+    """Runs queued autosave tasks in order, in a thread of its own
+
+    Tasks are queued with the same `add_work()` call as for a
+    `lib.idletask.Processor`, and are likewise called repeatedly until
+    they return false. They run one after another in a dedicated
+    thread however, so they must only use snapshots, clones, or other
+    data which the main thread won't change under them.
+
+    >>> writer = Writer()
+    >>> out = []
+    >>> def task(items):
+    ...     out.append(items.pop(0))
+    ...     return bool(items)
+    >>> writer.add_work(task, [1, 2])
+    >>> writer.add_work(task, [3])
+    >>> writer.join()
+    True
+    >>> out
+    [1, 2, 3]
+    >>> writer.has_work()
+    False
+
+    Tasks which must run in the main thread have a true
+    `autosave_main_thread` attribute. When it's their turn, the writer
+    passes them to the GLib main loop, and waits until they're done.
+
+    If a task raises an exception, the rest of the queue is dropped,
+    and the error callback is invoked in the main thread.
+
+    Tasks should do their heavy lifting in code which releases the
+    interpreter lock, so that painting in the main thread isn't held
+    up by them. For example, `lib.tiledsurface.PNGFileUpdateTask`
+    only holds it to render each strip a tile at a time: the PNG
+    encoder releases it while compressing.
+
+    """
+
+    #: Seconds to sleep between task calls, so that the main thread
+    #: gets the interpreter lock back often while painting.
+    CHUNK_PAUSE = 0.001
+
+    def __init__(self, error_cb=None):
+        """Initialize, ready to accept work
+
+        :param callable error_cb: Called with no args if a task fails.
+
+        """
+        super(Writer, self).__init__()
+        self._error_cb = error_cb
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._busy = False
+        self._generation = 0  # bumped by stop()
+        self._thread = None
+
+    def has_work(self):
+        """True if tasks are queued or running"""
+        with self._cond:
+            return self._busy or bool(self._queue)
+
+    def add_work(self, func, *args, **kwargs):
+        """Queue a task
+
+        :param func: a task callable.
+        :param *args: passed to func
+        :param **kwargs: passed to func
+
+        This starts the writer thread if it isn't already running.
+
+        """
+        with self._cond:
+            self._queue.append((func, args, kwargs))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target = self._thread_loop,
+                    name = "autosave-writer",
+                )
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def stop(self):
+        """Drop all queued tasks, waiting for any running one to return
+
+        Tasks waiting for the main thread are abandoned, so this is
+        safe to call from the main thread.
+
+        """
+        with self._cond:
+            self._queue.clear()
+            self._generation += 1
+            self._cond.notify_all()
+            while self._busy:
+                self._cond.wait()
+
+    def join(self, timeout=None):
+        """Wait for all queued tasks to finish (not in the main thread)
+
+        :param float timeout: seconds to wait for, at most
+        :returns: whether all the work has finished
+        :rtype: bool
+
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            while self._busy or self._queue:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _thread_loop(self):
+        """Runs queued tasks forever (writer thread)"""
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                func, args, kwargs = self._queue[0]
+                generation = self._generation
+                self._busy = True
+            failed = False
+            try:
+                if getattr(func, "autosave_main_thread", False):
+                    more = self._call_in_main_thread(
+                        func, args, kwargs,
+                        generation,
+                    )
+                else:
+                    more = func(*args, **kwargs)
+            except:
+                logger.exception("autosave: task %r failed", func)
+                failed = True
+            with self._cond:
+                self._busy = False
+                if generation == self._generation:
+                    if failed:
+                        self._queue.clear()
+                    elif not more:
+                        self._queue.popleft()
+                pause = bool(self._queue)
+                self._cond.notify_all()
+            if failed and self._error_cb:
+                GLib.idle_add(self._error_cb)
+            if pause:
+                time.sleep(self.CHUNK_PAUSE)
+
+    def _call_in_main_thread(self, func, args, kwargs, generation):
+        """Run a task to completion in the main thread (writer thread)"""
+        outcome = []  # exc_info, or None for success
+
+        def _idle_cb():
+            with self._cond:
+                if generation != self._generation:
+                    return False
+            try:
+                if func(*args, **kwargs):
+                    return True
+                exc_info = None
+            except:
+                exc_info = sys.exc_info()
+            with self._cond:
+                outcome.append(exc_info)
+                self._cond.notify_all()
+            return False
+
+        GLib.idle_add(_idle_cb, priority=GLib.PRIORITY_LOW)
+        with self._cond:
+            while not outcome and generation == self._generation:
+                self._cond.wait()
+        if outcome and outcome[0] is not None:
+            exc_type, exc_value, exc_tb = outcome[0]
+            raise exc_type, exc_value, exc_tb
+        return False
@@ -8,11 +8,13 @@
 
 import mypaintlib
 import helpers
+import lib.cache
 
 import urllib
 import copy
 import math
 import json
+import numpy
 from libmypaint import brushsettings
 
 STRING_VALUE_SETTINGS = set((
@@ -480,6 +482,37 @@ class BrushInfo (object):
         return s1 == s2
 
 
+#: Parsed BrushInfos, keyed by settings string
+_brushinfo_cache = lib.cache.LRUCache(capacity=32)
+
+
+def get_cached_brushinfo(settings_str):
+    """Returns a parsed BrushInfo for a settings string, via a cache
+
+    :param str settings_str: as from `BrushInfo.save_to_string()`
+    :rtype: BrushInfo
+
+    Replaying strokes needs the settings they were recorded with,
+    and parsing them each time is slow. The same BrushInfo is returned
+    for the same string, so it must not be modified. Use it with
+    ``Brush(brushinfo, observe=False)``.
+
+    >>> bi = BrushInfo()
+    >>> bi.load_defaults()
+    >>> s = bi.save_to_string()
+    >>> get_cached_brushinfo(s) is get_cached_brushinfo(s)
+    True
+    >>> get_cached_brushinfo(s).matches(bi)
+    True
+
+    """
+    brushinfo = _brushinfo_cache.get(settings_str)
+    if brushinfo is None:
+        brushinfo = BrushInfo(settings_str)
+        _brushinfo_cache[settings_str] = brushinfo
+    return brushinfo
+
+
 class Brush (mypaintlib.PythonBrush):
     """A brush, capable of painting to a surface
 
@@ -488,12 +521,42 @@ class Brush (mypaintlib.PythonBrush):
 
     """
 
-    def __init__(self, brushinfo):
+    def __init__(self, brushinfo, observe=True):
+        """Initialize
+
+        :param BrushInfo brushinfo: the settings to use
+        :param bool observe: follow later changes to the settings.
+            Pass False for throwaway brushes made from BrushInfos
+            which won't change, like those from
+            `get_cached_brushinfo()`, so the BrushInfo doesn't keep
+            them alive.
+
+        """
         super(Brush, self).__init__()
         self.brushinfo = brushinfo
-        brushinfo.observers.append(self._update_from_brushinfo)
+        if observe:
+            brushinfo.observers.append(self._update_from_brushinfo)
         self._update_from_brushinfo(ALL_SETTINGS)
 
+    def stroke_to_array(self, surface, events):
+        """Paints a whole array of events in one call
+
+        :param surface: the C++ surface to paint to, e.g.
+            a `lib.tiledsurface.MyPaintSurface`'s ``backend``
+        :param events: array-like of shape (N, 6), with columns
+            (dtime, x, y, pressure, xtilt, ytilt)
+        :returns: the number of events painted
+
+        This is equivalent to calling `stroke_to()` for each event in
+        turn, but without the per-event Python overheads. It stops
+        early if the surface raises an exception, and re-raises it.
+
+        """
+        events = numpy.ascontiguousarray(events, dtype='float64')
+        if events.ndim != 2 or events.shape[1] != 6:
+            raise ValueError("events must have shape (N, 6)")
+        return super(Brush, self).stroke_to_array(surface, events)
+
     def _update_from_brushinfo(self, settings):
         """Updates changed low-level settings from the BrushInfo"""
         for cname in settings:
@@ -8,28 +8,68 @@
 
 
 from collections import OrderedDict
+from collections import deque
+from collections import namedtuple
+import threading
+import sys
+
+
+CacheStats = namedtuple("CacheStats", [
+    "entries",
+    "nbytes",
+    "hits",
+    "misses",
+    "evictions",
+])
 
 
 class LRUCache (object):
-    """Least-recently-used cache with dict-like usage"""
+    """Least-recently-used cache with dict-like usage
+
+    Individual operations are thread-safe.
+
+    >>> cache = LRUCache(capacity=2)
+    >>> cache["a"] = 1
+    >>> cache["b"] = 2
+    >>> cache.get("a")
+    1
+    >>> cache["c"] = 3
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    >>> cache.pop("a")
+    1
+    >>> cache.pop("a", "gone")
+    'gone'
+
+    An optional callback is invoked for each item pushed out of the
+    cache to make room for newer ones.
+
+    >>> evicted = []
+    >>> cache = LRUCache(capacity=1, evict_cb=lambda k, v: evicted.append(k))
+    >>> cache["x"] = 1
+    >>> cache["y"] = 2
+    >>> evicted
+    ['x']
+    >>> cache.stats
+    CacheStats(entries=1, nbytes=None, hits=0, misses=0, evictions=1)
+
+    """
     # The idea for using an OrderedDict comes from Kun Xi:
     # http://www.kunxi.org/blog/2014/05/lru-cache-in-python/
 
     _SENTINEL = object()
 
-    def __init__(self, capacity=2048):
+    def __init__(self, capacity=2048, evict_cb=None):
         self._capacity = capacity
+        self._evict_cb = evict_cb
         self._cache = OrderedDict()
         self._hits = 0
         self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
 
     def __repr__(self):
-        hitrate = 1.0
-        missrate = 0.0
-        accesses = float(self._hits + self._misses)
-        if accesses > 0:
-            hitrate = self._hits / accesses
-            missrate = self._misses / accesses
+        hitrate, missrate = self._get_rates()
         return "<LRUCache c: %d/%d h: %.0f%% m: %.0f%%>" % (
             len(self._cache),
             self._capacity,
@@ -37,10 +77,40 @@ class LRUCache (object):
             missrate * 100,
         )
 
+    def _get_rates(self):
+        hitrate = 1.0
+        missrate = 0.0
+        accesses = float(self._hits + self._misses)
+        if accesses > 0:
+            hitrate = self._hits / accesses
+            missrate = self._misses / accesses
+        return (hitrate, missrate)
+
+    @property
+    def stats(self):
+        """Current usage and hit/miss/eviction counts
+
+        :rtype: CacheStats
+
+        The counts are reset by `clear()`.
+
+        """
+        with self._lock:
+            return CacheStats(
+                entries = len(self._cache),
+                nbytes = self._get_nbytes(),
+                hits = self._hits,
+                misses = self._misses,
+                evictions = self._evictions,
+            )
+
     def clear(self):
-        self._cache.clear()
-        self._hits = 0
-        self._misses = 0
+        with self._lock:
+            self._cache.clear()
+            self._forget_all()
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
 
     def __len__(self):
         return len(self._cache)
@@ -55,19 +125,427 @@ class LRUCache (object):
         return item
 
     def get(self, key, default=None):
-        try:
-            item = self._cache.pop(key)
+        with self._lock:
+            try:
+                item = self._cache.pop(key)
+                self._cache[key] = item
+                self._hits += 1
+                return item
+            except KeyError:
+                self._misses += 1
+                return default
+
+    def __setitem__(self, key, item):
+        with self._lock:
+            old = self._cache.pop(key, self._SENTINEL)
+            if old is not self._SENTINEL:
+                self._forget(key, old)
             self._cache[key] = item
-            self._hits += 1
-            return item
-        except KeyError:
-            self._misses += 1
+            self._remember(key, item)
+            evicted = self._evict_while_over_budget()
+        self._notify_evicted(evicted)
+
+    def pop(self, key, default=_SENTINEL):
+        """Removes an item, returning it (no effect on hit stats)"""
+        with self._lock:
+            item = self._cache.pop(key, self._SENTINEL)
+            if item is not self._SENTINEL:
+                self._forget(key, item)
+                return item
+        if default is self._SENTINEL:
+            raise KeyError(key)
+        return default
+
+    def keys(self):
+        """Returns a list of the keys, oldest first"""
+        with self._lock:
+            return list(self._cache.keys())
+
+    ## Size accounting (overridable)
+
+    def _over_budget(self):
+        """True if the oldest entries need to be evicted (lock held)"""
+        return len(self._cache) > self._capacity
+
+    def _remember(self, key, item):
+        """Account for an item being added (lock held)"""
+        pass
+
+    def _forget(self, key, item):
+        """Account for an item being removed (lock held)"""
+        pass
+
+    def _forget_all(self):
+        """Account for all items being removed (lock held)"""
+        pass
+
+    def _get_nbytes(self):
+        """Total size of the items, if tracked (lock held)"""
+        return None
+
+    ## Eviction
+
+    def _evict_while_over_budget(self):
+        """Evict the oldest entries until within budget (lock held)"""
+        evicted = []
+        while self._cache and self._over_budget():
+            key, item = self._cache.popitem(last=False)
+            self._forget(key, item)
+            self._evictions += 1
+            evicted.append((key, item))
+        return evicted
+
+    def _notify_evicted(self, evicted):
+        """Runs the eviction callback (lock released)"""
+        if not self._evict_cb:
+            return
+        for key, item in evicted:
+            self._evict_cb(key, item)
+
+
+class ByteBudgetLRUCache (LRUCache):
+    """Least-recently-used cache bounded by its items' sizes in bytes
+
+    This is useful for caches of tile arrays, whose footprint can be
+    capped directly. Item sizes are measured when they are added, by
+    default using their ``nbytes`` attribute (NumPy arrays have this)
+    or `sys.getsizeof()`.
+
+    >>> cache = ByteBudgetLRUCache(max_bytes=10, cost_func=len)
+    >>> cache["a"] = "12345"
+    >>> cache["b"] = "1234"
+    >>> cache.stats.nbytes
+    9
+    >>> cache["c"] = "123"
+    >>> sorted(cache.keys())
+    ['b', 'c']
+    >>> cache.stats
+    CacheStats(entries=2, nbytes=7, hits=0, misses=0, evictions=1)
+
+    Lowering the budget evicts immediately.
+
+    >>> cache.max_bytes = 3
+    >>> cache.keys()
+    ['c']
+
+    Items larger than the whole budget are not retained.
+
+    >>> cache["d"] = "12345"
+    >>> "d" in cache
+    False
+
+    """
+
+    def __init__(self, max_bytes, cost_func=None, evict_cb=None,
+                 capacity=None):
+        """Initialize
+
+        :param int max_bytes: Maximum total size of all items
+        :param callable cost_func: Returns the size of an item in bytes
+        :param callable evict_cb: Called as evict_cb(key, item) for
+            each item removed to make room for others
+        :param int capacity: Optional additional limit on the number
+            of items
+
+        """
+        super(ByteBudgetLRUCache, self).__init__(
+            capacity = capacity,
+            evict_cb = evict_cb,
+        )
+        self._max_bytes = int(max_bytes)
+        self._cost_func = cost_func or _default_cost
+        self._costs = {}
+        self._nbytes = 0
+
+    def __repr__(self):
+        hitrate, missrate = self._get_rates()
+        mib = float(1024 * 1024)
+        return ("<ByteBudgetLRUCache c: %d b: %.1f/%.1fMiB "
+                "h: %.0f%% m: %.0f%% e: %d>") % (
+            len(self._cache),
+            self._nbytes / mib,
+            self._max_bytes / mib,
+            hitrate * 100,
+            missrate * 100,
+            self._evictions,
+        )
+
+    @property
+    def max_bytes(self):
+        """The cache's size budget, in bytes"""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, n):
+        with self._lock:
+            self._max_bytes = int(n)
+            evicted = self._evict_while_over_budget()
+        self._notify_evicted(evicted)
+
+    def _over_budget(self):
+        if self._nbytes > self._max_bytes:
+            return True
+        if self._capacity is None:
+            return False
+        return len(self._cache) > self._capacity
+
+    def _remember(self, key, item):
+        cost = int(self._cost_func(item))
+        self._costs[key] = cost
+        self._nbytes += cost
+
+    def _forget(self, key, item):
+        self._nbytes -= self._costs.pop(key, 0)
+
+    def _forget_all(self):
+        self._costs.clear()
+        self._nbytes = 0
+
+    def _get_nbytes(self):
+        return self._nbytes
+
+
+class TileCache (ByteBudgetLRUCache):
+    """Byte-budgeted cache of tiles, shared by several owners
+
+    Keys are tuples beginning with ``(owner, tx, ty, mipmap_level)``.
+    The cache keeps an index of its keys by owner and tile, so that an
+    owner's entries for an area can be dropped without scanning every
+    key in the cache. Owners normally use it via a `TileCachePartition`.
+
+    >>> cache = TileCache(max_bytes=100, cost_func=len)
+    >>> for key in [("a", 0, 0, 0), ("a", 1, 0, 0), ("a", 0, 0, 1),
+    ...             ("a", -1, 3, 0), ("b", 1, 0, 0)]:
+    ...     cache[key] = "1234"
+    >>> cache.drop_area("a", (65, 1, 1, 1), tile_size=64)
+    >>> sorted(cache.keys())
+    [('a', -1, 3, 0), ('a', 0, 0, 0), ('b', 1, 0, 0)]
+
+    Large areas are handled by checking the owner's cached tiles
+    against the area instead.
+
+    >>> cache.drop_area("a", (-64, 64, 10**6, 10**6), tile_size=64)
+    >>> sorted(cache.keys())
+    [('a', 0, 0, 0), ('b', 1, 0, 0)]
+
+    An empty area means everything.
+
+    >>> cache.drop_area("a", (0, 0, 0, 0), tile_size=64)
+    >>> cache.keys()
+    [('b', 1, 0, 0)]
+    >>> cache.stats.nbytes
+    4
+
+    Owners which are going away can release their entries from any
+    thread, or from a finalizer. They're dropped at the next insert.
+
+    >>> cache.release_owner("b")
+    >>> cache[("c", 0, 0, 0)] = "1234"
+    >>> cache.keys()
+    [('c', 0, 0, 0)]
+
+    """
+
+    def __init__(self, max_bytes, **kwargs):
+        super(TileCache, self).__init__(max_bytes, **kwargs)
+        self._tiles = {}  # {owner: {(tx, ty, mipmap_level): set(keys)}}
+        self._levels = set()
+        self._released_owners = deque()
+
+    def _remember(self, key, item):
+        while self._released_owners:
+            owner = self._released_owners.popleft()
+            self._drop_tiles(owner, list(self._tiles.get(owner, ())))
+        super(TileCache, self)._remember(key, item)
+        owner, tx, ty, mipmap_level = key[:4]
+        tiles = self._tiles.setdefault(owner, {})
+        tiles.setdefault((tx, ty, mipmap_level), set()).add(key)
+        self._levels.add(mipmap_level)
+
+    def _forget(self, key, item):
+        super(TileCache, self)._forget(key, item)
+        owner, tx, ty, mipmap_level = key[:4]
+        tiles = self._tiles.get(owner)
+        if tiles is None:
+            return
+        tile = (tx, ty, mipmap_level)
+        keys = tiles.get(tile)
+        if keys is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del tiles[tile]
+            if not tiles:
+                del self._tiles[owner]
+
+    def _forget_all(self):
+        super(TileCache, self)._forget_all()
+        self._tiles.clear()
+
+    def _drop_tiles(self, owner, tiles):
+        """Remove an owner's entries for some tiles (lock held)"""
+        index = self._tiles.get(owner)
+        if not index:
+            return
+        for tile in tiles:
+            keys = index.get(tile)
+            if not keys:
+                continue
+            for key in list(keys):
+                item = self._cache.pop(key)
+                self._forget(key, item)
+
+    def drop_owner(self, owner):
+        """Removes all of an owner's entries (no effect on stats)"""
+        with self._lock:
+            tiles = list(self._tiles.get(owner, ()))
+            self._drop_tiles(owner, tiles)
+
+    def release_owner(self, owner):
+        """Queues all of an owner's entries for removal
+
+        This doesn't take the lock, so it's safe to call from
+        ``__del__``. The entries go at the start of the next insert.
+
+        """
+        self._released_owners.append(owner)
+
+    def drop_area(self, owner, bbox, tile_size):
+        """Removes an owner's entries for tiles intersecting a bbox
+
+        :param owner: Owner whose entries are to be dropped
+        :param tuple bbox: Model-space x, y, w, h. Empty means all.
+        :param int tile_size: Size of a tile at mipmap level 0
+
+        This costs time proportional to the number of tiles in the
+        area, or to the number the owner has cached if that's fewer.
+
+        """
+        x, y, w, h = [int(c) for c in bbox]
+        if w <= 0 or h <= 0:
+            self.drop_owner(owner)
+            return
+        with self._lock:
+            index = self._tiles.get(owner)
+            if not index:
+                return
+            ranges = []
+            ntiles = 0
+            for mipmap_level in self._levels:
+                size = tile_size << mipmap_level
+                txs = xrange(x // size, (x+w-1) // size + 1)
+                tys = xrange(y // size, (y+h-1) // size + 1)
+                ranges.append((mipmap_level, txs, tys))
+                ntiles += len(txs) * len(tys)
+            if ntiles <= len(index):
+                tiles = [
+                    (tx, ty, mipmap_level)
+                    for (mipmap_level, txs, tys) in ranges
+                    for ty in tys
+                    for tx in txs
+                ]
+            else:
+                tiles = []
+                for tile in index:
+                    tx, ty, mipmap_level = tile
+                    size = tile_size << mipmap_level
+                    if (tx*size < x+w and x < (tx+1)*size
+                            and ty*size < y+h and y < (ty+1)*size):
+                        tiles.append(tile)
+            self._drop_tiles(owner, tiles)
+
+
+class TileCachePartition (object):
+    """One owner's share of a `TileCache`, with dict-like usage
+
+    Keys are ``(tx, ty, mipmap_level, ...)`` tuples. Entries compete
+    for space with those of all the other partitions of the same cache.
+
+    >>> shared = TileCache(max_bytes=6, cost_func=len)
+    >>> a = TileCachePartition(shared)
+    >>> b = TileCachePartition(shared)
+    >>> a[(0, 0, 0)] = "123"
+    >>> b[(0, 0, 0)] = "456"
+    >>> a.get((0, 0, 0)), b.get((0, 0, 0))
+    ('123', '456')
+    >>> b[(1, 0, 0)] = "789"
+    >>> a.get((0, 0, 0)) is None
+    True
+    >>> b.clear()
+    >>> len(shared)
+    0
+
+    A partition's entries are released when it's garbage collected.
+
+    >>> a[(0, 0, 0)] = "123"
+    >>> del a
+    >>> b[(0, 0, 0)] = "456"
+    >>> len(shared)
+    1
+
+    Partitions of no cache at all store nothing.
+
+    >>> c = TileCachePartition(None)
+    >>> c[(0, 0, 0)] = "123"
+    >>> c.get((0, 0, 0)) is None
+    True
+
+    """
+
+    def __init__(self, cache):
+        """Initialize, as a new partition of a shared cache
+
+        :param TileCache cache: The cache to use, or None to disable.
+
+        """
+        self._cache = cache
+        self._owner = object()
+
+    def __del__(self):
+        if self._cache is not None:
+            self._cache.release_owner(self._owner)
+
+    def __contains__(self, key):
+        if self._cache is None:
+            return False
+        return ((self._owner,) + tuple(key)) in self._cache
+
+    def get(self, key, default=None):
+        if self._cache is None:
             return default
+        return self._cache.get((self._owner,) + tuple(key), default)
 
     def __setitem__(self, key, item):
-        try:
-            self._cache.pop(key)
-        except KeyError:
-            while len(self._cache) >= self._capacity:
-                self._cache.popitem(last=False)
-        self._cache[key] = item
+        if self._cache is None:
+            return
+        self._cache[(self._owner,) + tuple(key)] = item
+
+    def clear(self):
+        """Removes all of this partition's entries"""
+        if self._cache is None:
+            return
+        self._cache.drop_owner(self._owner)
+
+    def drop_area(self, bbox, tile_size):
+        """Removes entries for tiles intersecting a model-space bbox"""
+        if self._cache is None:
+            return
+        self._cache.drop_area(self._owner, bbox, tile_size)
+
+
+def _default_cost(item):
+    """Default size measure for items in a ByteBudgetLRUCache"""
+    try:
+        return item.nbytes
+    except AttributeError:
+        return sys.getsizeof(item)
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
@@ -31,10 +31,17 @@ class CommandStack (object):
 
     MAXLEN = 30   # FIXME: dynamic size (psutil)?
 
+    #: Undo history length when old steps can be swapped out to disk
+    MAXLEN_SWAPPED = 300
+
+    #: Number of recent undo steps which are never swapped out
+    RESIDENT_STEPS = 10
+
     def __init__(self, **kwargs):
         super(CommandStack, self).__init__()
         self.undo_stack = []
         self.redo_stack = []
+        self._swap = None
         self.stack_updated()
 
     def __repr__(self):
@@ -76,6 +83,7 @@ class CommandStack (object):
         if not self.undo_stack:
             return
         command = self.undo_stack.pop()
+        command.history_swapped_out = False
         command.undo()
         self.redo_stack.append(command)
         self.stack_updated()
@@ -97,7 +105,10 @@ class CommandStack (object):
         return command
 
     def reduce_undo_history(self):
-        """Trims the undo stack"""
+        """Trims the undo stack, and swaps out older steps if possible"""
+        maxlen = self.MAXLEN
+        if self._swap is not None:
+            maxlen = self.MAXLEN_SWAPPED
         stack = self.undo_stack
         self.undo_stack = []
         steps = 0
@@ -105,8 +116,54 @@ class CommandStack (object):
             self.undo_stack.insert(0, item)
             if not item.automatic_undo:
                 steps += 1
-            if steps == self.MAXLEN:  # and memory > ...
+            if steps == maxlen:  # and memory > ...
                 break
+        self._swap_out_history()
+
+    ## Swapping out old undo steps
+
+    def set_swap(self, swap):
+        """Use a swap file for old undo steps, allowing a longer history
+
+        :param lib.tileswap.TileSwap swap: swap to use, or None
+
+        Undo steps older than the most recent `RESIDENT_STEPS` have
+        the tiles which only they hold written out to the swap by its
+        own thread when new commands are done. They are read back in
+        lazily when they are used.
+
+        """
+        if self._swap is not None and self._swap is not swap:
+            self._swap.stop()
+        self._swap = swap
+
+    def _swap_out_history(self):
+        """Queue the tiles of older commands not yet swapped out
+
+        :returns: the number of tiles queued to be swapped out
+
+        Only the commands which just became old enough are looked at,
+        and they only list the tiles the document no longer uses, so
+        the cost doesn't depend on the size of the document.
+
+        """
+        if self._swap is None:
+            return 0
+        pending = []
+        steps = 0
+        for command in reversed(self.undo_stack):
+            if steps >= self.RESIDENT_STEPS:
+                if command.history_swapped_out:
+                    break  # and everything older
+                pending.append(command)
+            if not command.automatic_undo:
+                steps += 1
+        tiles = []
+        for command in reversed(pending):
+            tiles.extend(command.iter_history_tiles())
+            command.history_swapped_out = True
+        self._swap.spill_in_background(tiles)
+        return len(tiles)
 
     def get_last_command(self):
         """Returns the most recently performed command"""
@@ -157,6 +214,9 @@ class Command (object):
     automatic_undo = False
     display_name = _("Unknown Command")
 
+    #: Set by the CommandStack when its tiles have been swapped out
+    history_swapped_out = False
+
     ## Method defs
 
     def __init__(self, doc, **kwargs):
@@ -208,6 +268,18 @@ class Command (object):
         """
         raise NotImplementedError
 
+    def iter_history_tiles(self):
+        """Iterates over the tiles only held by the command for undo
+
+        Commands which hold snapshots of layer data, or layers which
+        are not in the document, should implement this to allow their
+        tiles to be swapped out to disk when they're old enough.
+        See `CommandStack.set_swap()`. Only tiles which the document
+        no longer uses once the command is done should be listed, and
+        the cost shouldn't depend on the size of the layers involved.
+        """
+        return iter(())
+
     ## Deprecated utility functions for subclasses
 
     def _notify_canvas_observers(self, layer_bboxes):
@@ -319,6 +391,10 @@ class Brushwork (Command):
         layer.add_stroke_shape(stroke, self._sshot_before)
         self._sshot_after = layer.save_snapshot()
 
+    def iter_history_tiles(self):
+        """Iterates over the tiles which the stroke replaced"""
+        return _iter_replaced_tiles(self._sshot_before, self._sshot_after)
+
     def _check_recording_started(self):
         """Ensure command is in the recording phase"""
         assert not self._recording_finished
@@ -346,6 +422,7 @@ class Brushwork (Command):
         self._stroke_seq = lib.stroke.Stroke()
         self._stroke_seq.start_recording(model.brush)
         assert self._sshot_after is None
+        model.layer_stack.start_painting_cache(self._layer_path)
         self._recording_started = True
 
     def stroke_to(self, dtime, x, y, pressure, xtilt, ytilt):
@@ -416,6 +493,8 @@ class Brushwork (Command):
         layer = self._stroke_target_layer
         self._stroke_target_layer = None  # prevent potential leak
         self._recording_finished = True
+        if layer is not None:
+            self.doc.layer_stack.stop_painting_cache()
         if self._stroke_seq is None:
             # Unclear circumstances, but I've seen it happen
             # (unpaintable layers and visibility state toggling).
@@ -471,6 +550,7 @@ class FloodFill (Command):
         self.new_layer = None
         self.new_layer_path = None
         self.snapshot = None
+        self._sshot_after = None
 
     def redo(self):
         # Pick a source
@@ -500,6 +580,8 @@ class FloodFill (Command):
         # Fill connected areas of the source into the destination
         src_layer.flood_fill(self.x, self.y, self.color, self.bbox,
                              self.tolerance, dst_layer=dst_layer)
+        if self.snapshot is not None:
+            self._sshot_after = dst_layer.save_snapshot()
 
     def undo(self):
         layers = self.doc.layer_stack
@@ -514,6 +596,11 @@ class FloodFill (Command):
             assert self.snapshot is not None
             layers.current.load_snapshot(self.snapshot)
             self.snapshot = None
+            self._sshot_after = None
+
+    def iter_history_tiles(self):
+        """Iterates over the tiles which the fill replaced"""
+        return _iter_replaced_tiles(self.snapshot, self._sshot_after)
 
 
 class TrimLayer (Command):
@@ -742,6 +829,11 @@ class MergeLayerDown (Command):
         self._lower_layer = None
         rootstack.current_path = self._upper_path
 
+    # The replaced layers' tiles aren't offered for swapping out with
+    # iter_history_tiles(). Listing them would cost as much as the
+    # layers are big, and they can be shared copy-on-write with layers
+    # still in the document, e.g. duplicates.
+
 
 class NormalizeLayerMode (Command):
     """Normalize a layer's mode & opacity, incorporating its backdrop
@@ -1424,3 +1516,25 @@ class ExternalLayerEdit (Command):
     def undo(self):
         layer = self.doc.layer_stack.deepget(self._layer_path)
         layer.load_snapshot(self._before)
+
+
+## Helper functions
+
+
+def _iter_replaced_tiles(before, after):
+    """Iterates over the tiles of a layer snapshot not in a later one
+
+    Snapshots share the chunks of tiles which didn't change, so the
+    cost depends on how much changed between them, not on the size of
+    the layer.
+
+    """
+    before = getattr(before, "surface_sshot", None)
+    after = getattr(after, "surface_sshot", None)
+    if before is None or after is None:
+        return
+    tiledict = before.tiledict
+    for pos in tiledict.get_changed_keys(after.tiledict):
+        tile = tiledict.get(pos)
+        if tile is not None:
+            yield tile
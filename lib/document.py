@@ -48,6 +48,11 @@ import lib.pixbuf
 from lib.errors import FileHandlingError
 from lib.errors import AllocationError
 import lib.idletask
+import lib.autosave
+import lib.tileswap
+import lib.workerpool
+import lib.orazipwriter
+import lib.orazipreader
 from lib.gettext import C_
 import lib.xml
 import lib.glib
@@ -65,6 +70,10 @@ CACHE_DOC_AUTOSAVE_SUBDIR = u"autosave"
 CACHE_ACTIVITY_FILE = u"active"
 CACHE_UPDATE_INTERVAL = 10  # seconds
 
+#: Autosaves rewrite an otherwise unchanged stack.xml if its unsaved
+#: painting time would be out by more than this.
+AUTOSAVE_STACKXML_MAX_TIME_DRIFT = 60  # seconds
+
 # Logging and error reporting strings
 _LOAD_FAILED_COMMON_TEMPLATE_LINE = C_(
     "Document IO: common error strings: {error_loading_common}",
@@ -253,6 +262,21 @@ class Document (object):
     #: new blank painting layer if they empty out the document.
     CREATE_PAINTING_LAYER_IF_EMPTY = True
 
+    #: Default number of threads for encoding layer PNGs when saving.
+    #: Encoding runs without the GIL, so this scales like loading does.
+    SAVE_WORKERS = 2
+
+    #: Default for whether layers are saved with tile indexes as well
+    #: as PNGs, for quicker loading. See lib.tileindex.
+    SAVE_TILE_INDEX = False
+
+    #: Default number of threads for decoding layer PNGs when loading.
+    #: Decoding mostly runs without the GIL, so this scales well.
+    LOAD_WORKERS = 2
+
+    #: Default for whether layer PNGs are only decoded when needed.
+    LOAD_LAZILY = False
+
     ## Initialization and cleanup
 
     def __init__(self, brushinfo=None, painting_only=False):
@@ -274,6 +298,11 @@ class Document (object):
         self.brush.brushinfo.observers.append(self.brushsettings_changed_cb)
         self.stroke = None
         self.command_stack = command.CommandStack()
+        self.save_workers = self.SAVE_WORKERS
+        self.save_tile_index = self.SAVE_TILE_INDEX
+        self.load_workers = self.LOAD_WORKERS
+        self.load_lazily = self.LOAD_LAZILY
+        self._ora_record = None  # (realpath, stat key, OraSaveRecord)
 
         # Cache and auto-saving to the cache
         self._painting_only = painting_only
@@ -284,8 +313,11 @@ class Document (object):
         self._autosave_processor = None
         self._autosave_countdown_id = None
         self._autosave_dirty = False
+        self._autosave_stackxml_written = None  # (xml sans time, time)
         if not painting_only:
-            self._autosave_processor = lib.idletask.Processor()
+            self._autosave_processor = lib.autosave.Writer(
+                error_cb = self._autosave_failed_cb,
+            )
             self.command_stack.stack_updated += self._command_stack_updated_cb
             self.effective_bbox_changed += self._effective_bbox_changed_cb
 
@@ -346,6 +378,8 @@ class Document (object):
             doc_cache_dir = doc_cache_dir.decode(sys.getfilesystemencoding())
         logger.debug("Created working-doc cache dir %r", doc_cache_dir)
         self._cache_dir = doc_cache_dir
+        # Old undo steps can be swapped out to a file in the cache dir.
+        self.command_stack.set_swap(lib.tileswap.TileSwap(doc_cache_dir))
         # Start the cache updater, which kicks off background autosaves,
         # and updates an activity canary file.
         # Not a perfect solution, but maybe a better cross-platform one
@@ -370,6 +404,9 @@ class Document (object):
             return
         self._stop_cache_updater()
         self._stop_autosave_writes()
+        # The swap file is anonymous, and lives on until the history
+        # referring to it goes away.
+        self.command_stack.set_swap(None)
         shutil.rmtree(self._cache_dir, ignore_errors=True)
         if os.path.exists(self._cache_dir):
             logger.error(
@@ -454,7 +491,10 @@ class Document (object):
         """Start the countdown to an automatic backup, if it isn't already.
 
         This does nothing if the countdown has already been started, or
-        if the autosave writes are in progress.
+        if the autosave writes are in progress. If painting makes the
+        document dirty faster than the writer can keep up, autosaves
+        therefore happen back to back rather than piling up: the cache
+        updater restarts the countdown once the writer is free.
 
         """
         assert not self._painting_only
@@ -487,14 +527,16 @@ class Document (object):
         self._autosave_countdown_id = None
         return False
 
-    ## Queued autosave writes: low priority & chunked
+    ## Queued autosave writes: in a writer thread, from snapshots
 
     def _queue_autosave_writes(self):
-        """Add autosaved backup tasks to the background processor
+        """Add autosaved backup tasks to the background writer
 
         These tasks consist of nicely chunked writes for all layers
         whose data has changed, plus a few extra structural and
-        bookeeping ones.
+        bookeeping ones. They run in the writer's own thread, and use
+        snapshots taken here, so the main thread only has to take the
+        snapshots.
 
         """
         if not self._cache_dir:
@@ -505,6 +547,8 @@ class Document (object):
         assert not self._painting_only
         assert not self._autosave_processor.has_work()
         assert self._autosave_dirty
+        # Changes made from now on need another autosave.
+        self._autosave_dirty = False
         oradir = os.path.join(self._cache_dir, CACHE_DOC_AUTOSAVE_SUBDIR)
         datadir = os.path.join(oradir, "data")
         if not os.path.exists(datadir):
@@ -539,10 +583,12 @@ class Document (object):
         # This is a (very) local extension to the format.
         t_str = "{:3f}".format(self.unsaved_painting_time)
         image_elem.attrib[_ORA_UNSAVED_PAINTING_TIME_ATTR] = t_str
-        # Thumbnail generation.
+        # Thumbnail generation. Only the parts which changed since the
+        # last autosave are rendered again.
         rootstack_sshot = self.layer_stack.save_snapshot()
         rootstack_clone = layer.RootLayerStack(doc=None)
         rootstack_clone.load_snapshot(rootstack_sshot)
+        thumbnail = self.layer_stack.get_thumbnail()
         thumbdir_rel = "Thumbnails"
         thumbdir = os.path.join(oradir, thumbdir_rel)
         if not os.path.exists(thumbdir):
@@ -551,8 +597,9 @@ class Document (object):
         thumbfile_rel = os.path.join(thumbdir_rel, thumbfile_basename)
         taskproc.add_work(
             self._autosave_thumbnail_cb,
+            thumbnail,
             rootstack_clone,
-            image_bbox,
+            thumbnail.prepare(image_bbox),
             os.path.join(thumbdir, thumbfile_basename)
         )
         manifest.add(thumbfile_rel)
@@ -571,35 +618,55 @@ class Document (object):
             manifest = manifest,
         )
 
-    def _autosave_thumbnail_cb(self, rootstack, bbox, filename):
+    def _autosave_thumbnail_cb(self, thumbnail, rootstack, job, filename):
         """Autosaved backup task: write Thumbnails/thumbnail.png
 
-        This runs every time currently for the same reason we rewrite
-        stack.xml each time. It would be a big win if we didn't have to
-        do this though.
+        The persistent thumbnail only re-renders the tiles which have
+        changed, from the clone of the layer stack. The file is only
+        written if the thumbnail changed, or if it's missing.
 
         """
         assert not self._painting_only
-        thumbnail = rootstack.render_thumbnail(bbox)
-        tmpname = filename + u".TMP"
-        lib.pixbuf.save(thumbnail, tmpname)
-        lib.fileutils.replace(tmpname, filename)
+        try:
+            pixbuf = thumbnail.render(rootstack, job)  # the clone: safe
+            if thumbnail.changed or not os.path.exists(filename):
+                tmpname = filename + u".TMP"
+                lib.pixbuf.save(pixbuf, tmpname)
+                lib.fileutils.replace(tmpname, filename)
+        except Exception:
+            thumbnail.invalidate((0, 0, 0, 0))  # write it all next time
+            raise
         return False
 
     def _autosave_stackxml_cb(self, image_elem, filename):
-        """Autosaved backup task: write stack.xml
+        """Autosaved backup task: write stack.xml, if it changed
 
-        This runs every time because the document's layer structure can
-        change without data layers being aware of it.
+        The element is built every time, because the document's layer
+        structure can change without data layers being aware of it. It
+        is only written if it differs from what was last written. The
+        unsaved painting time is written along with other changes, or
+        when it has drifted by AUTOSAVE_STACKXML_MAX_TIME_DRIFT.
 
         """
         assert not self._painting_only
         lib.xml.indent_etree(image_elem)
+        t_str = image_elem.attrib.pop(_ORA_UNSAVED_PAINTING_TIME_ATTR)
+        key = ET.tostring(image_elem, encoding='UTF-8')
+        image_elem.attrib[_ORA_UNSAVED_PAINTING_TIME_ATTR] = t_str
+        t = float(t_str)
+        written = self._autosave_stackxml_written
+        if written is not None and os.path.exists(filename):
+            written_key, written_t = written
+            drift = abs(t - written_t)
+            if key == written_key and drift < AUTOSAVE_STACKXML_MAX_TIME_DRIFT:
+                os.utime(filename, None)  # last-modified time of the backup
+                return False
         tmpname = filename + u".TMP"
         with open(tmpname, 'wb') as xml_fp:
             xml = ET.tostring(image_elem, encoding='UTF-8')
             xml_fp.write(xml)
         lib.fileutils.replace(tmpname, filename)
+        self._autosave_stackxml_written = (key, t)
         return False
 
     def _autosave_cleanup_cb(self, oradir, manifest):
@@ -630,15 +697,39 @@ class Document (object):
                 "autosave: missing %r (listed in the manifest)",
                 path,
             )
-        self._autosave_dirty = False
-        logger.debug("autosave: all done, doc marked autosave-clean")
+        logger.debug("autosave: all done")
+        return False
+
+    def _autosave_failed_cb(self):
+        """Writer error callback: retry the autosave later"""
+        assert not self._painting_only
+        logger.warning("autosave failed: doc marked autosave-dirty again")
+        self._autosave_dirty = True
+        self._mark_layers_autosave_dirty()
         return False
 
     def _stop_autosave_writes(self):
         assert not self._painting_only
         logger.debug("autosave stopped: clearing task queue")
+        if self._autosave_processor.has_work():
+            self._autosave_dirty = True
+            self._mark_layers_autosave_dirty()
+            # A prepared thumbnail render may never run
+            self.layer_stack.get_thumbnail().invalidate((0, 0, 0, 0))
         self._autosave_processor.stop()
 
+    def _mark_layers_autosave_dirty(self):
+        """Make every layer write its data again on the next autosave
+
+        Used when queued writes were dropped or failed. Layers only
+        commit their checkpoint details once those writes succeed,
+        but they clear their own dirty flags when they are queued.
+
+        """
+        self.layer_stack.background_layer.autosave_dirty = True
+        for layer in self.layer_stack.deepiter():
+            layer.autosave_dirty = True
+
     def _command_stack_updated_cb(self, cmdstack):
         assert not self._painting_only
         if not self.autosave_backups: return
@@ -796,6 +887,7 @@ class Document (object):
             self._create_cache_dir()
         self.command_stack.clear()
         self._layers.clear()
+        self._ora_record = None
         if self.CREATE_PAINTING_LAYER_IF_EMPTY:
             self.add_layer((-1,))
             self._layers.current_path = (0,)
@@ -1209,6 +1301,8 @@ class Document (object):
         save = getattr(self, 'save_' + ext, self._unsupported)
         result = None
         try:
+            # Lazily loaded layers may still be reading the file.
+            lib.orazipreader.release_file(filename)
             result = save(filename, **kwargs)
         except GObject.GError as e:
             logger.exception("GError when writing %r: %s", filename, e)
@@ -1404,9 +1498,38 @@ class Document (object):
 
     save_jpeg = save_jpg
 
-    @fileutils.via_tempfile
     def save_ora(self, filename, options=None, **kwargs):
-        """Saves OpenRaster data to a file"""
+        """Saves OpenRaster data to a file
+
+        Saving over the OpenRaster file which was last saved or loaded
+        is incremental, if it hasn't been touched since then. PNG data
+        for layers which haven't changed is copied across from the old
+        file rather than being encoded again.
+
+        """
+        previous = None
+        if self._ora_record is not None:
+            prev_filename, prev_stat, prev_record = self._ora_record
+            if _same_file_unchanged(filename, prev_filename, prev_stat):
+                previous = (prev_filename, prev_record)
+        record = lib.orazipwriter.OraSaveRecord()
+        thumbnail = self._save_ora(
+            filename, options,
+            previous = previous,
+            record = record,
+            **kwargs
+        )
+        self._set_ora_record(filename, record)
+        return thumbnail
+
+    def _set_ora_record(self, filename, record):
+        """Remember what's in an OpenRaster file, for incremental saves"""
+        filename = os.path.realpath(filename)
+        self._ora_record = (filename, _file_stat_key(filename), record)
+
+    @fileutils.via_tempfile
+    def _save_ora(self, filename, options=None, previous=None, record=None,
+                  **kwargs):
         logger.info('save_ora: %r (%r, %r)', filename, options, kwargs)
         t0 = time.time()
         frame_bbox = None
@@ -1419,6 +1542,10 @@ class Document (object):
             xres=self._xres if self._xres else None,
             yres=self._yres if self._yres else None,
             frame_active = self.frame_enabled,
+            workers = self.save_workers,
+            tile_index = self.save_tile_index,
+            previous = previous,
+            record = record,
             **kwargs
         )
         logger.info('%.3fs save_ora total', time.time() - t0)
@@ -1440,16 +1567,33 @@ class Document (object):
         image_xres = max(0, int(image_elem.attrib.get('xres', 0)))
         image_yres = max(0, int(image_elem.attrib.get('yres', 0)))
 
-        # Delegate loading of image data to the layers tree itself
+        # Delegate loading of image data to the layers tree itself.
+        # Layer PNGs are decoded in the background meanwhile, or only
+        # when they're first needed if loading lazily.
         self.layer_stack.clear()
-        self.layer_stack.load_from_openraster(
+        pool = None
+        if self.load_workers > 1 and not self.load_lazily:
+            pool = lib.workerpool.WorkerPool(self.load_workers,
+                                             name="ora-load")
+        reader = lib.orazipreader.OraZipReader(
             orazip,
-            root_stack_elem,
-            cache_dir,
-            feedback_cb,
-            x=0, y=0,
-            **kwargs
+            pool = pool,
+            feedback_cb = feedback_cb,
+            lazy = self.load_lazily,
         )
+        try:
+            self.layer_stack.load_from_openraster(
+                reader,
+                root_stack_elem,
+                cache_dir,
+                feedback_cb,
+                x=0, y=0,
+                **kwargs
+            )
+            reader.finish()
+        finally:
+            if pool is not None:
+                pool.shutdown()
         assert len(self.layer_stack) > 0
 
         # Resolution information if specified
@@ -1472,11 +1616,19 @@ class Document (object):
         self.set_frame_enabled(frame_enab, user_initiated=False)
 
         orazip.close()
+        self._set_ora_record(filename, reader.record)
 
         logger.info('%.3fs load_ora total', time.time() - t0)
 
     def resume_from_autosave(self, autosave_dir, feedback_cb=None):
-        """Resume using an autosave dir (and its parent cache dir)"""
+        """Resume using an autosave dir (and its parent cache dir)
+
+        Layers are loaded from their tile index files where possible.
+        These are journals of every tile written up to the last
+        complete autosave. The layer PNGs are only checkpoints, written
+        less often, and are used only when a tile index is unusable.
+
+        """
         assert os.path.isdir(autosave_dir)
         assert os.path.basename(autosave_dir) == CACHE_DOC_AUTOSAVE_SUBDIR
         doc_cache_dir = os.path.dirname(autosave_dir)
@@ -1571,7 +1723,7 @@ class Document (object):
         self.set_frame_enabled(frame_enab, user_initiated=False)
 
 
-def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=None, frame_active=False, **kwargs):
+def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=None, frame_active=False, workers=1, tile_index=False, previous=None, record=None, **kwargs):
     """Save a root layer stack to a new OpenRaster zipfile
 
     :param lib.layer.RootLayerStack root_stack: what to save
@@ -1580,18 +1732,45 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=
     :param int xres: nominal X resolution for the doc
     :param int yres: nominal Y resolution for the doc
     :param frame_active: True if the frame is enabled
+    :param int workers: number of threads for encoding PNGs
+    :param bool tile_index: also save layers as tile indexes
+    :param tuple previous: (filename, OraSaveRecord) for an earlier
+        save to copy unchanged layer data from
+    :param lib.orazipwriter.OraSaveRecord record: receives details
+        of what was saved, for a later incremental save
     :param \*\*kwargs: Passed through to root_stack.save_to_openraster()
     :rtype: GdkPixbuf
     :returns: Thumbnail preview image (256x256 max) of what was saved
 
+    With more than one worker, the layers' PNG files are encoded in
+    parallel. The layer stack must not be changed during the save.
+    The zipfile's members are always written in the same order.
+
     >>> from lib.layer.test import make_test_stack
     >>> root, leaves = make_test_stack()
     >>> import tempfile
     >>> tmpdir = tempfile.mkdtemp()
     >>> orafile = os.path.join(tmpdir, "test.ora")
-    >>> _save_layers_to_new_orazip(root, orafile)  # doctest: +ELLIPSIS
+    >>> record = lib.orazipwriter.OraSaveRecord()
+    >>> _save_layers_to_new_orazip(root, orafile, record=record)
+    ... # doctest: +ELLIPSIS
     <Pixbuf...>
     >>> assert os.path.isfile(orafile)
+
+    Layers which haven't changed since the save which produced
+    `previous` have their PNG data copied from that file as-is.
+
+    >>> orafile2 = os.path.join(tmpdir, "test2.ora")
+    >>> _save_layers_to_new_orazip(root, orafile2,
+    ...                            previous=(orafile, record))
+    ... # doctest: +ELLIPSIS
+    <Pixbuf...>
+    >>> z1 = zipfile.ZipFile(orafile)
+    >>> z2 = zipfile.ZipFile(orafile2)
+    >>> pngs = [n for n in z1.namelist() if n.startswith("data/")]
+    >>> all(z1.getinfo(n).CRC == z2.getinfo(n).CRC for n in pngs)
+    True
+    >>> z1.close(); z2.close()
     >>> shutil.rmtree(tmpdir)
     >>> assert not os.path.exists(tmpdir)
 
@@ -1604,6 +1783,50 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=
         filename, 'w',
         compression=zipfile.ZIP_STORED,
     )
+    pool = None
+    if workers > 1:
+        pool = lib.workerpool.WorkerPool(workers, name="ora-save")
+    prev_orazip = None
+    prev_record = None
+    if previous is not None:
+        prev_filename, prev_record = previous
+        try:
+            prev_orazip = zipfile.ZipFile(prev_filename)
+        except (IOError, zipfile.BadZipfile):
+            logger.exception("Cannot reuse data from %r", prev_filename)
+    writer = lib.orazipwriter.OraZipWriter(
+        orazip,
+        pool = pool,
+        feedback_cb = kwargs.get("feedback_cb"),
+        previous = prev_orazip,
+        previous_record = prev_record,
+        record = record,
+        tile_index = tile_index,
+    )
+    try:
+        thumbnail = _save_layers_to_orazip_writer(
+            root_stack, writer, tempdir,
+            bbox = bbox,
+            xres = xres,
+            yres = yres,
+            frame_active = frame_active,
+            **kwargs
+        )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if prev_orazip is not None:
+            prev_orazip.close()
+    orazip.close()
+    os.rmdir(tempdir)
+
+    return thumbnail
+
+
+def _save_layers_to_orazip_writer(root_stack, orazip, tempdir, bbox=None,
+                                  xres=None, yres=None, frame_active=False,
+                                  **kwargs):
+    """Save a root layer stack via an OraZipWriter (see above)"""
 
     # The mimetype entry must be first
     helpers.zipfile_writestr(orazip, 'mimetype', lib.xml.OPENRASTER_MEDIA_TYPE)
@@ -1643,22 +1866,37 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=
     # OpenRaster version declaration
     image.attrib["version"] = lib.xml.OPENRASTER_VERSION
 
+    # Save fully rendered image too, and derive the thumbnail from it
+    # rather than rendering everything a second time. It may be encoded
+    # in a worker thread while the main loop runs, so render a clone.
+    thumbnails = []
+    root_stack_clone = layer.RootLayerStack(doc=None)
+    root_stack_clone.load_snapshot(root_stack.save_snapshot())
+
+    def _save_merged_image(fp, **kwargs):
+        root_stack_clone.save_as_png(
+            fp, *bbox,
+            alpha=False, background=True,
+            **kwargs
+        )
+        fp.seek(0)
+        thumbnails.append(lib.pixbuf.load_from_stream(
+            fp,
+            max_size = (256, 256),
+        ))
+
+    orazip.write_png('mergedimage.png', _save_merged_image, **kwargs)
+    orazip.flush()
+
     # Thumbnail preview (256x256)
-    thumbnail = root_stack.render_thumbnail(bbox)
-    tmpfile = join(tempdir, 'tmp.png')
-    lib.pixbuf.save(thumbnail, tmpfile, 'png')
-    orazip.write(tmpfile, 'Thumbnails/thumbnail.png')
-    os.remove(tmpfile)
-
-    # Save fully rendered image too
-    tmpfile = os.path.join(tempdir, "mergedimage.png")
-    root_stack.save_as_png(
-        tmpfile, *bbox,
-        alpha=False, background=True,
-        **kwargs
+    thumbnail = thumbnails[0]
+    thumbnail_fp = StringIO()
+    lib.pixbuf.save_to_stream(thumbnail, thumbnail_fp, 'png')
+    helpers.zipfile_writestr(
+        orazip,
+        'Thumbnails/thumbnail.png',
+        thumbnail_fp.getvalue(),
     )
-    orazip.write(tmpfile, 'mergedimage.png')
-    os.remove(tmpfile)
 
     # Prettification
     lib.xml.indent_etree(image)
@@ -1666,12 +1904,27 @@ def _save_layers_to_new_orazip(root_stack, filename, bbox=None, xres=None, yres=
 
     # Finalize
     helpers.zipfile_writestr(orazip, 'stack.xml', xml)
-    orazip.close()
-    os.rmdir(tempdir)
+    orazip.flush()
 
     return thumbnail
 
 
+def _file_stat_key(filename):
+    """Returns details which change if a file is rewritten"""
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+
+def _same_file_unchanged(filename, prev_filename, prev_stat_key):
+    """True if filename is prev_filename, and is still as it was"""
+    if os.path.realpath(filename) != prev_filename:
+        return False
+    try:
+        return _file_stat_key(prev_filename) == prev_stat_key
+    except OSError:
+        return False
+
+
 def get_app_cache_root():
     """Get the app-specific cache root dir, creating it if needed.
 
@@ -41,6 +41,8 @@ static void
 png_write_error_callback (png_structp png_save_ptr,
                           png_const_charp error_msg)
 {
+    // Encoding may be happening without the GIL (see below).
+    PyGILState_STATE gstate = PyGILState_Ensure();
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -51,10 +53,41 @@ png_write_error_callback (png_structp png_save_ptr,
             PyErr_Format(PyExc_RuntimeError, "Error writing PNG: %s", error_msg);
         }
     }
+    PyGILState_Release(gstate);
     longjmp (png_jmpbuf(png_save_ptr), 1);
 }
 
 
+// Write and flush functions for writing to Python file-like objects.
+// Errors raised by write() are left set, so png_write_error_callback()
+// passes them on to the caller unchanged. Rows are encoded without
+// the GIL, so the write callback takes the GIL for itself.
+
+static void
+png_write_pyobject_callback (png_structp png_save_ptr,
+                             png_bytep data,
+                             png_size_t length)
+{
+    PyObject *file = (PyObject *)png_get_io_ptr(png_save_ptr);
+    PyGILState_STATE gstate = PyGILState_Ensure();
+    PyObject *result = PyObject_CallMethod(file, (char *)"write",
+                                           (char *)"s#",
+                                           (char *)data, (int)length);
+    Py_XDECREF(result);
+    PyGILState_Release(gstate);
+    if (! result) {
+        png_error(png_save_ptr, "write() failed");
+    }
+}
+
+
+static void
+png_flush_pyobject_callback (png_structp png_save_ptr)
+{
+    // Flushing is up to the owner of the file-like object.
+}
+
+
 struct ProgressivePNGWriter::State
 {
     int width;
@@ -133,23 +166,29 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
 
     const int bpc = 8;
 
-    if (! PyFile_Check(file)) {
-        PyErr_SetString(
-            PyExc_TypeError,
-            "file arg must be a builtin file object"
-        );
+    // Builtin files are written to directly. Anything else with a
+    // write() method gets the encoded data passed to that method.
+    FILE *fp = NULL;
+    if (PyFile_Check(file)) {
+        fp = PyFile_AsFile(file);
+        if (!fp) {
+            PyErr_SetString(
+                PyExc_TypeError,
+                "file arg has no FILE* associated with it?"
+            );
+            return;
+        }
     }
-    state->file = file;
-    Py_INCREF(file);
-
-    FILE *fp = PyFile_AsFile(file);
-    if (!fp) {
+    else if (! PyObject_HasAttrString(file, "write")) {
         PyErr_SetString(
             PyExc_TypeError,
-            "file arg has no FILE* associated with it?"
+            "file arg must be a builtin file object, "
+            "or have a write() method"
         );
         return;
     }
+    state->file = file;
+    Py_INCREF(file);
 
     png_ptr = png_create_write_struct (PNG_LIBPNG_VER_STRING,
                                        (png_voidp)NULL,
@@ -181,7 +220,14 @@ ProgressivePNGWriter::ProgressivePNGWriter(PyObject *file,
         return;
     }
 
-    png_init_io(png_ptr, fp);
+    if (fp) {
+        png_init_io(png_ptr, fp);
+    }
+    else {
+        png_set_write_fn(png_ptr, (png_voidp)file,
+                         png_write_pyobject_callback,
+                         png_flush_pyobject_callback);
+    }
 
     png_set_IHDR (png_ptr, info_ptr,
                   w, h, bpc,
@@ -227,6 +273,8 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     int row = 0;
     char *err_text = NULL;
     PyObject *err_type = PyExc_RuntimeError;
+    // Set while rows are being encoded without the GIL
+    PyThreadState * volatile thread_state = NULL;
 
     if (! state) {
         err_type = PyExc_RuntimeError;
@@ -266,7 +314,18 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     assert(PyArray_STRIDE(arr, 1) == 4);
     assert(PyArray_STRIDE(arr, 2) == 1);
 
+    rowcount = PyArray_DIM(arr, 0);
+    if (state->y + rowcount > state->height) {
+        err_type = PyExc_RuntimeError;
+        err_text = "too many pixel rows written";
+        goto errexit;
+    }
+
     if (setjmp(png_jmpbuf(state->png_ptr))) {
+        if (thread_state) {
+            PyEval_RestoreThread(thread_state);
+            thread_state = NULL;
+        }
         if (PyErr_Occurred()) {
             state->cleanup();
             return NULL;
@@ -275,23 +334,21 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
         err_text = "libpng error during write()";
         goto errexit;
     }
-    rowcount = PyArray_DIM(arr, 0);
     rowstride = PyArray_STRIDE(arr, 0);
     rowdata = (png_bytep)PyArray_DATA(arr);
     row_p = (png_bytep)rowdata;
+
+    // Filtering and compression don't need the GIL, so release it to
+    // let other threads run while the strip is encoded. The caller
+    // keeps a reference to the array for the duration.
+    thread_state = PyEval_SaveThread();
     for (row=0; row<rowcount; row++) {
         png_write_row(state->png_ptr, row_p);
-        if (! state->check_valid()) {
-            state->cleanup();
-            return NULL;
-        }
         row_p += rowstride;
-        if (++(state->y) > state->height) {
-            err_type = PyExc_RuntimeError;
-            err_text = "too many pixel rows written";
-            goto errexit;
-        }
     }
+    PyEval_RestoreThread(thread_state);
+    thread_state = NULL;
+    state->y += rowcount;
     Py_RETURN_NONE;
 
   errexit:
@@ -309,6 +366,8 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
 PyObject *
 ProgressivePNGWriter::close()
 {
+    // Set while the end of the stream is encoded without the GIL
+    PyThreadState * volatile thread_state = NULL;
     if (! state) {
         PyErr_SetString(
             PyExc_RuntimeError,
@@ -321,11 +380,22 @@ ProgressivePNGWriter::close()
         return NULL;
     }
     if (setjmp(png_jmpbuf(state->png_ptr))) {
+        if (thread_state) {
+            PyEval_RestoreThread(thread_state);
+            thread_state = NULL;
+        }
         state->cleanup();
-        PyErr_SetString(PyExc_RuntimeError, "libpng error during close()");
+        if (! PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError,
+                            "libpng error during close()");
+        }
         return NULL;
     }
+    // Flushing the compressor can take a while too.
+    thread_state = PyEval_SaveThread();
     png_write_end (state->png_ptr, NULL);
+    PyEval_RestoreThread(thread_state);
+    thread_state = NULL;
     if (state->y != state->height) {
         state->cleanup();
         PyErr_SetString(
@@ -349,6 +419,8 @@ static void
 png_read_error_callback (png_structp png_read_ptr,
                          png_const_charp error_msg)
 {
+    // Decoding may be happening without the GIL (see below).
+    PyGILState_STATE gstate = PyGILState_Ensure();
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -361,10 +433,57 @@ png_read_error_callback (png_structp png_read_ptr,
                          error_msg);
         }
     }
+    PyGILState_Release(gstate);
     longjmp (png_jmpbuf(png_read_ptr), 1);
 }
 
 
+// Read callback for file-like Python objects. This is called while
+// decoding rows, which happens without the GIL, so it takes the GIL
+// for itself.
+
+static void
+png_read_pyobject_callback (png_structp png_read_ptr,
+                            png_bytep data,
+                            png_size_t length)
+{
+    PyObject *file = (PyObject *)png_get_io_ptr(png_read_ptr);
+    PyGILState_STATE gstate = PyGILState_Ensure();
+    png_size_t done = 0;
+    bool failed = false;
+    while (done < length) {
+        PyObject *chunk = PyObject_CallMethod(file, (char *)"read",
+                                              (char *)"n",
+                                              (Py_ssize_t)(length - done));
+        if (! chunk) {
+            failed = true;
+            break;
+        }
+        char *chunk_data = NULL;
+        Py_ssize_t chunk_len = 0;
+        if (PyString_AsStringAndSize(chunk, &chunk_data, &chunk_len) < 0) {
+            Py_DECREF(chunk);
+            failed = true;
+            break;
+        }
+        if (chunk_len <= 0 || (png_size_t)chunk_len > length - done) {
+            Py_DECREF(chunk);
+            PyErr_SetString(PyExc_IOError,
+                            "read() returned an unexpected amount of data");
+            failed = true;
+            break;
+        }
+        memcpy(data + done, chunk_data, chunk_len);
+        done += chunk_len;
+        Py_DECREF(chunk);
+    }
+    PyGILState_Release(gstate);
+    if (failed) {
+        png_error(png_read_ptr, "read() failed");
+    }
+}
+
+
 static const double PNG_gAMA_scale = 100000;
 static const double PNG_cHRM_scale = 100000;
 
@@ -377,38 +496,25 @@ log_lcms2_error (cmsContext context_id, cmsUInt32Number err_code,
 }
 
 
-/** load_png_fast_progressive:
- *
- * @filename: filename to load, in the system encoding
- * @get_buffer_callback: a Python callable returning writeable arrays
- * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
- * returns: a dict of flags describing what was read.
- *
- * Read a PNG progressively as 8bit RGBA. The callback must have the signature
- *
- *   numpy_array = callback(full_image_width, full_image_height)
- *
- * @get_buffer_callback  must return a writeable array of the image width.  If
- * the height is smaller than the image height, the callback will be called
- * again until the full image has been processed. The buffer will be written
- * with 8-bit RGBA data
- *
- */
+// Shared implementation of the loaders below. Reads from fp if it's
+// not NULL, otherwise from the file-like Python object.
 
-PyObject *
-load_png_fast_progressive (char *filename,
+static PyObject *
+load_png_progressive_impl (FILE *fp,
+                           PyObject *file,
                            PyObject *get_buffer_callback,
                            bool convert_to_srgb)
 {
     // Note: we are not using the method that libpng calls "Reading PNG
     // files progressively". That method would involve feeding the data
     // into libpng piece by piece, which is not necessary if we can give
-    // libpng a simple FILE pointer.
+    // libpng a simple FILE pointer, or a read callback.
 
     png_structp png_ptr = NULL;
     png_infop info_ptr = NULL;
     PyObject *result = NULL;
-    FILE *fp = NULL;
+    // Set while rows are being decoded without the GIL
+    PyThreadState * volatile thread_state = NULL;
     uint32_t width, height;
     uint32_t rows_left;
     png_byte color_type;
@@ -455,37 +561,6 @@ load_png_fast_progressive (char *filename,
 
     cmsSetLogErrorHandler(log_lcms2_error);
 
-#ifdef _WIN32
-    wchar_t *win32_filename;
-#ifdef __MINGW64_VERSION_MAJOR
-    // mbstowcs seems mismatch with default python encoding, force to be utf8
-    __mingw_str_utf8_wide(filename, &win32_filename, NULL);
-#else
-    size_t len;
-    wchar_t *buf;
-    // what __mingw_str_utf8_wide is
-    len = MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, NULL, 0); 
-    buf = (wchar_t *) calloc(len + 1, sizeof (wchar_t));
-    if(!buf)
-        len = 0;
-    else {
-        if (len != 0)
-            MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, buf, len);
-        buf[len] = L'0'; // Must null-terminated
-    }
-    win32_filename = buf;
-#endif
-    fp = _wfopen(win32_filename, L"rb");
-    if (win32_filename)
-        free(win32_filename);
-#else
-    fp = fopen(filename, "rb");
-#endif
-    if (!fp) {
-        PyErr_SetFromErrno(PyExc_IOError);
-        goto cleanup;
-    }
-
     png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING, (png_voidp)NULL,
                                       png_read_error_callback, NULL);
     if (!png_ptr) {
@@ -500,10 +575,20 @@ load_png_fast_progressive (char *filename,
     }
 
     if (setjmp(png_jmpbuf(png_ptr))) {
+        if (thread_state) {
+            PyEval_RestoreThread(thread_state);
+            thread_state = NULL;
+        }
         goto cleanup;
     }
 
-    png_init_io(png_ptr, fp);
+    if (fp) {
+        png_init_io(png_ptr, fp);
+    }
+    else {
+        png_set_read_fn(png_ptr, (png_voidp)file,
+                        png_read_pyobject_callback);
+    }
 
     png_read_info(png_ptr, info_ptr);
 
@@ -800,7 +885,10 @@ load_png_fast_progressive (char *filename,
             }
         }
 
-        // Populate the strip of memory with pixels decoded from the PNG stream
+        // Populate the strip of memory with pixels decoded from the PNG
+        // stream. Decompression and colour conversion don't need the
+        // GIL, so release it to let other loaders run at the same time.
+        thread_state = PyEval_SaveThread();
         png_read_rows(png_ptr, row_pointers, NULL, rows);
         rows_left -= rows;
 
@@ -830,6 +918,8 @@ load_png_fast_progressive (char *filename,
             }
             free(input_buffer);
         }
+        PyEval_RestoreThread(thread_state);
+        thread_state = NULL;
         free(row_pointers);
         Py_DECREF(obj);
     } //while (rows_left)
@@ -850,8 +940,6 @@ cleanup:
     }
     // libpng's style is to free internally allocated stuff like the icc
     // tables in png_destroy_*(). I think.
-    if (fp)
-        fclose(fp);
     if (convert_to_srgb) {
         if (input_buffer_profile)
             cmsCloseProfile(input_buffer_profile);
@@ -865,3 +953,98 @@ cleanup:
 
     return result;
 }
+
+
+/** load_png_fast_progressive:
+ *
+ * @filename: filename to load, in the system encoding
+ * @get_buffer_callback: a Python callable returning writeable arrays
+ * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
+ * returns: a dict of flags describing what was read.
+ *
+ * Read a PNG progressively as 8bit RGBA. The callback must have the signature
+ *
+ *   numpy_array = callback(full_image_width, full_image_height)
+ *
+ * @get_buffer_callback  must return a writeable array of the image width.  If
+ * the height is smaller than the image height, the callback will be called
+ * again until the full image has been processed. The buffer will be written
+ * with 8-bit RGBA data
+ *
+ * Rows are decoded without holding the GIL, so several PNGs can be
+ * loaded at once from different threads.
+ *
+ */
+
+PyObject *
+load_png_fast_progressive (char *filename,
+                           PyObject *get_buffer_callback,
+                           bool convert_to_srgb)
+{
+    FILE *fp = NULL;
+
+#ifdef _WIN32
+    wchar_t *win32_filename;
+#ifdef __MINGW64_VERSION_MAJOR
+    // mbstowcs seems mismatch with default python encoding, force to be utf8
+    __mingw_str_utf8_wide(filename, &win32_filename, NULL);
+#else
+    size_t len;
+    wchar_t *buf;
+    // what __mingw_str_utf8_wide is
+    len = MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, NULL, 0); 
+    buf = (wchar_t *) calloc(len + 1, sizeof (wchar_t));
+    if(!buf)
+        len = 0;
+    else {
+        if (len != 0)
+            MultiByteToWideChar(CP_UTF8, MB_ERR_INVALID_CHARS, filename, -1, buf, len);
+        buf[len] = L'0'; // Must null-terminated
+    }
+    win32_filename = buf;
+#endif
+    fp = _wfopen(win32_filename, L"rb");
+    if (win32_filename)
+        free(win32_filename);
+#else
+    fp = fopen(filename, "rb");
+#endif
+    if (!fp) {
+        PyErr_SetFromErrno(PyExc_IOError);
+        return NULL;
+    }
+
+    PyObject *result = load_png_progressive_impl(fp, NULL,
+                                                 get_buffer_callback,
+                                                 convert_to_srgb);
+    fclose(fp);
+    return result;
+}
+
+
+/** load_png_fast_progressive_from_file:
+ *
+ * @file: a file-like Python object with a read() method
+ * @get_buffer_callback: a Python callable returning writeable arrays
+ * @convert_to_srgb: apply colorspace conversions, to sRGB display pixels
+ * returns: a dict of flags describing what was read.
+ *
+ * Like load_png_fast_progressive(), but reads the PNG data from a
+ * stream, e.g. a member of a zipfile opened with ZipFile.open().
+ *
+ */
+
+PyObject *
+load_png_fast_progressive_from_file (PyObject *file,
+                                     PyObject *get_buffer_callback,
+                                     bool convert_to_srgb)
+{
+    if (! PyObject_HasAttrString(file, "read")) {
+        PyErr_SetString(PyExc_TypeError,
+                        "file must be a file-like object with a read() "
+                        "method");
+        return NULL;
+    }
+    return load_png_progressive_impl(NULL, file, get_buffer_callback,
+                                     convert_to_srgb);
+}
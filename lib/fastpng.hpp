@@ -21,7 +21,8 @@
 #include <Python.h>
 
 
-// Writes a PNG file progressively in strips
+// Writes a PNG file progressively in strips, to a builtin file object
+// or to any Python object with a write() method.
 
 class ProgressivePNGWriter
 {
@@ -47,4 +48,11 @@ load_png_fast_progressive (char *filename,
                            PyObject *get_buffer_callback,
                            bool convert_to_srgb);
 
+// The same, but reading from a file-like object with a read() method.
+
+PyObject *
+load_png_fast_progressive_from_file (PyObject *file,
+                                     PyObject *get_buffer_callback,
+                                     bool convert_to_srgb);
+
 #endif //FASTPNG_HPP
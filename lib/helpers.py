@@ -14,6 +14,8 @@ import zipfile
 import colorsys
 import urllib
 import gc
+import time
+import struct
 import numpy
 import logging
 logger = logging.getLogger(__name__)
@@ -389,6 +391,137 @@ def zipfile_writestr(z, arcname, data):
     z.writestr(zi, data)
 
 
+#: Chunk size for copying data into zipfile entries
+_ZIP_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def zipfile_write_stream(z, arcname, fp, size, crc):
+    """Copy a stream into a new stored zipfile entry
+
+    :param zipfile.ZipFile z: A zip file open for write.
+    :param unicode arcname: Name of the file entry to add.
+    :param fp: Readable file-like object positioned at the data.
+    :param int size: Number of bytes to copy from `fp`.
+    :param int crc: The data's (unsigned) CRC-32 checksum.
+
+    This is like `zipfile_writestr()`, but the data is copied across
+    in chunks rather than having to be held in memory all at once. The
+    entry is always stored uncompressed.
+
+    >>> import tempfile, shutil, StringIO, zlib
+    >>> d = tempfile.mkdtemp()
+    >>> z = zipfile.ZipFile(os.path.join(d, "t.zip"), "w")
+    >>> data = "hello" * 1000
+    >>> zipfile_write_stream(z, "a.txt", StringIO.StringIO(data),
+    ...                      len(data), zlib.crc32(data) & 0xffffffff)
+    >>> z.close()
+    >>> z = zipfile.ZipFile(os.path.join(d, "t.zip"), "r")
+    >>> z.read("a.txt") == data
+    True
+    >>> z.close()
+    >>> shutil.rmtree(d)
+
+    """
+    zi = _new_zipinfo(arcname)
+    zi.compress_type = zipfile.ZIP_STORED
+    zi.file_size = size
+    zi.compress_size = size
+    zi.CRC = crc
+    _zipfile_write_entry(z, zi, fp)
+
+
+def zipfile_copy_raw(z, arcname, src, src_info):
+    """Copy an entry from one zipfile to another, without recompressing
+
+    :param zipfile.ZipFile z: A zip file open for write.
+    :param unicode arcname: Name of the file entry to add.
+    :param zipfile.ZipFile src: A zip file open for read.
+    :param zipfile.ZipInfo src_info: The entry in `src` to copy.
+
+    The entry's compressed data is copied across byte for byte, so this
+    costs no more than the disk I/O.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> z1 = zipfile.ZipFile(os.path.join(d, "1.zip"), "w",
+    ...                      compression=zipfile.ZIP_DEFLATED)
+    >>> z1.writestr("a.txt", "hello" * 1000)
+    >>> z1.close()
+    >>> z1 = zipfile.ZipFile(os.path.join(d, "1.zip"), "r")
+    >>> z2 = zipfile.ZipFile(os.path.join(d, "2.zip"), "w")
+    >>> zipfile_copy_raw(z2, "b.txt", z1, z1.getinfo("a.txt"))
+    >>> z2.close()
+    >>> z2 = zipfile.ZipFile(os.path.join(d, "2.zip"), "r")
+    >>> z2.read("b.txt") == z1.read("a.txt")
+    True
+    >>> z2.getinfo("b.txt").compress_type == zipfile.ZIP_DEFLATED
+    True
+    >>> z1.close(); z2.close()
+    >>> shutil.rmtree(d)
+
+    """
+    if src_info.flag_bits & 0x1:
+        raise ValueError("Cannot copy encrypted entry %r" % (arcname,))
+    fp = src.fp
+    fp.seek(src_info.header_offset)
+    fheader = fp.read(zipfile.sizeFileHeader)
+    if len(fheader) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipfile("Truncated file header")
+    fheader = struct.unpack(zipfile.structFileHeader, fheader)
+    if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("Bad magic number for file header")
+    fp.seek(
+        fheader[zipfile._FH_FILENAME_LENGTH] +
+        fheader[zipfile._FH_EXTRA_FIELD_LENGTH],
+        os.SEEK_CUR,
+    )
+    zi = _new_zipinfo(arcname)
+    zi.compress_type = src_info.compress_type
+    zi.file_size = src_info.file_size
+    zi.compress_size = src_info.compress_size
+    zi.CRC = src_info.CRC
+    _zipfile_write_entry(z, zi, fp)
+
+
+def _new_zipinfo(arcname):
+    """New ZipInfo for a regular file, with the same perms as z.write()"""
+    zi = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+    zi.external_attr = 0o644 << 16  # wider perms, should match z.write()
+    zi.external_attr |= 0o100000 << 16  # regular file
+    return zi
+
+
+def _zipfile_write_entry(z, zi, fp):
+    """Write an entry's header, then its (compressed) data from fp
+
+    Python 2's zipfile can't do this by itself, so this mirrors what
+    its `writestr()` does.
+
+    """
+    if not z.fp:
+        raise RuntimeError(
+            "Attempt to write to ZIP archive that was already closed"
+        )
+    zi.header_offset = z.fp.tell()
+    z._writecheck(zi)
+    z._didModify = True
+    zip64 = (zi.file_size > zipfile.ZIP64_LIMIT or
+             zi.compress_size > zipfile.ZIP64_LIMIT)
+    if zip64 and not z._allowZip64:
+        raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+    z.fp.write(zi.FileHeader(zip64))
+    remaining = zi.compress_size
+    while remaining > 0:
+        chunk = fp.read(min(remaining, _ZIP_COPY_CHUNK_SIZE))
+        if not chunk:
+            raise IOError("Data for %r ended early" % (zi.filename,))
+        z.fp.write(chunk)
+        remaining -= len(chunk)
+    z.fp.flush()
+    z.filelist.append(zi)
+    z.NameToInfo[zi.filename] = zi
+
+
 def run_garbage_collector():
     logger.info('MEM: garbage collector run, collected %d objects',
                 gc.collect())
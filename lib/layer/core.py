@@ -765,7 +765,8 @@ class LayerBase (TileBlittable, TileCompositable):
                            canvas_bbox, frame_bbox, **kwargs):
         """Saves the layer's data into an open OpenRaster ZipFile
 
-        :param orazip: a `zipfile.ZipFile` open for write
+        :param orazip: a zipfile open for write, wrapped for ordering
+        :type orazip: lib.orazipwriter.OraZipWriter
         :param tmpdir: path to a temp dir, removed after the save
         :param path: Unique path of the layer, for encoding in filenames
         :type path: tuple of ints
@@ -790,6 +791,8 @@ class LayerBase (TileBlittable, TileCompositable):
 
         More than one file may be written to the zipfile. The etree
         element returned should describe everything that was written.
+        PNG data should be written with ``orazip.write_png()``, which
+        may encode it in a worker thread.
 
         Paths must be unique sequences of ints, but are not necessarily
         valid RootLayerStack paths. It's faked for the normally
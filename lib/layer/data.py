@@ -25,6 +25,7 @@ from copy import deepcopy
 from random import randint
 import uuid
 import struct
+import weakref
 
 from lib.gettext import C_
 import lib.tiledsurface as tiledsurface
@@ -32,6 +33,8 @@ import lib.strokemap
 import lib.helpers as helpers
 import lib.fileutils
 import lib.pixbuf
+import lib.orazipreader
+import lib.tileindex
 from lib.modes import *
 import core
 import lib.layer.error
@@ -69,6 +72,15 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
     #: Substitute content if the layer cannot be loaded.
     FALLBACK_CONTENT = None
 
+    #: MyPaint-specific attribute naming the layer's tile index, an
+    #: optional copy of the PNG's data with random access to its tiles.
+    #: See lib.tileindex.
+    _ORA_TILES_ATTR = "{%s}tiles" % (lib.xml.OPENRASTER_MYPAINT_NS,)
+
+    #: Autosaves only append changed tiles to the layer's tile index,
+    #: and rewrite its PNG after this many such updates.
+    AUTOSAVE_CHECKPOINT_INTERVAL = 20
+
     ## Initialization
 
     def __init__(self, surface=None, **kwargs):
@@ -91,6 +103,19 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         else:
             self._surface = surface
 
+        #: Surface generation of the last tile index update queued
+        self._autosave_tiles_queued_generation = None
+        #: Surface generation the autosaved tile index holds, if known
+        self._autosave_tiles_written_generation = None
+        #: Bbox of the last autosaved PNG (the checkpoint), if any
+        self._autosave_png_bbox = None
+        #: Bbox of the autosaved PNG once queued writes have finished
+        self._autosave_queued_png_bbox = None
+        #: CRC-32 of the last autosaved PNG, once the index knows it
+        self._autosave_png_crc = None
+        #: Tile index updates queued since the PNG was last written
+        self._autosave_journal_updates = 0
+
     @classmethod
     def new_from_surface_backed_layer(cls, src):
         """Clone from another SurfaceBackedLayer
@@ -171,14 +196,36 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             raise lib.layer.error.LoadingFailed(
                 "Only %r are supported" % (suffixes,),
             )
-        # Delegate the actual loading part
-        self._load_surface_from_orazip_member(
-            orazip,
-            cache_dir,
-            src,
-            feedback_cb,
-            x, y,
-        )
+        # Use the tile index instead of the PNG if there's a usable
+        # one, otherwise delegate the actual loading part.
+        is_reader = isinstance(orazip, lib.orazipreader.OraZipReader)
+        tiles_src = attrs.get(self._ORA_TILES_ATTR, None)
+        if not (is_reader and tiles_src and src_ext == ".png"):
+            tiles_src = None
+        elif not orazip.load_tile_index(tiles_src, src, x, y,
+                                        self._surface):
+            tiles_src = None
+        if tiles_src is None:
+            self._load_surface_from_orazip_member(
+                orazip,
+                cache_dir,
+                src,
+                feedback_cb,
+                x, y,
+            )
+        # Note what the PNG holds once it's loaded, so that unchanged
+        # layers can be copied across raw when saving over the file.
+        if is_reader and src_ext == ".png":
+            record = orazip.record
+            orazip.call_when_loaded(self._record_ora_entries,
+                                    record, src, tiles_src, x, y)
+
+    def _record_ora_entries(self, record, src, tiles_src, x, y):
+        """Internal: note what the loaded entries hold, for saving"""
+        state = _OraPNGState(self._surface, (x, y), exact=False)
+        record.add(("layer", self.autosave_uuid), src, state)
+        if tiles_src is not None:
+            record.add(("layer-tiles", self.autosave_uuid), tiles_src, state)
 
     def _load_surface_from_orazip_member(self, orazip, cache_dir,
                                          src, feedback_cb, x, y):
@@ -187,13 +234,29 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         Intended strictly for override by subclasses which need to first
         extract and then keep the file around afterwards.
 
+        When reading through a `lib.orazipreader.OraZipReader`, PNGs
+        are decoded straight into tiles, possibly in the background,
+        or lazily. The surface only gets its tiles once they are all
+        decoded.
+
         """
-        pixbuf = lib.pixbuf.load_from_zipfile(
-            datazip=orazip,
-            filename=src,
-            feedback_cb=feedback_cb,
-        )
-        self.load_surface_from_pixbuf(pixbuf, x=x, y=y)
+        def _load_via_pixbuf():
+            pixbuf = lib.pixbuf.load_from_zipfile(
+                datazip=orazip,
+                filename=src,
+                feedback_cb=feedback_cb,
+            )
+            self.load_surface_from_pixbuf(pixbuf, x=x, y=y)
+
+        is_png = os.path.splitext(src)[1].lower() == ".png"
+        if is_png and isinstance(orazip, lib.orazipreader.OraZipReader):
+            orazip.load_png(
+                src, x, y,
+                self._surface,
+                fallback_func = _load_via_pixbuf,
+            )
+        else:
+            _load_via_pixbuf()
 
     def load_from_openraster_dir(self, oradir, elem, cache_dir, feedback_cb,
                                  x=0, y=0, **kwargs):
@@ -233,6 +296,15 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             raise lib.layer.error.LoadingFailed(
                 "Only %r are supported" % (suffixes,),
             )
+        # Use the tile index if there's a usable one. Autosaves always
+        # write them, so this makes resuming quick.
+        tiles_src = attrs.get(self._ORA_TILES_ATTR, None)
+        if tiles_src and src_ext == ".png":
+            if self._load_surface_from_oradir_tile_index(
+                    os.path.join(oradir, tiles_src),
+                    os.path.join(oradir, src),
+                    x, y):
+                return
         # Delegate the actual loading part
         self._load_surface_from_oradir_member(
             oradir,
@@ -242,6 +314,32 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
             x, y,
         )
 
+    def _load_surface_from_oradir_tile_index(self, filename, png_filename,
+                                             x, y):
+        """Loads the surface from a tile index file, if it's usable
+
+        :returns: whether the surface was loaded
+        :rtype: bool
+
+        Tiles are read from the file when they're first used.
+
+        """
+        try:
+            index = lib.tileindex.open_file(filename)
+            png_crc = lib.tileindex.file_crc(png_filename)
+            sshot = index.load_tiles(x, y, png_crc=png_crc)
+        except (IOError, OSError, lib.tileindex.InvalidTileIndex) as err:
+            logger.warning("Not using tile index %r: %s", filename, err)
+            return False
+        self._surface.load_snapshot(sshot)
+        # It's in the autosave dir, so later autosaves can update it
+        # if the tiles weren't moved while loading them.
+        if (x, y) == index.origin:
+            generation = self._surface.get_generation()
+            self._autosave_tiles_queued_generation = generation
+            self._autosave_tiles_written_generation = generation
+        return True
+
     def _load_surface_from_oradir_member(self, oradir, cache_dir,
                                          src, feedback_cb, x, y):
         """Loads the surface from a file in an OpenRaster-like folder
@@ -423,12 +521,38 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         # mypaint-specific attribute name. If/when OpenRaster
         # standardizes looped layer data, that code should be moved
         # here.
+        #
+        # Non-looped layers also keep a tile index of the same data.
+        # Between checkpoints, it's used as a journal: only the tiles
+        # which changed get appended to it, and the PNG is left alone.
+        # The PNG is rewritten every so often, or when it's missing.
+        # Resuming loads the index, which has the latest tiles, and
+        # only falls back to the PNG if the index is unusable.
 
         png_basename = self.autosave_uuid + ".png"
         png_relpath = os.path.join("data", png_basename)
         png_path = os.path.join(oradir, png_relpath)
-        png_bbox = self._surface.looped and bbox or tuple(self.get_bbox())
-        if self.autosave_dirty or not os.path.exists(png_path):
+        tiles_relpath = None
+        tiles_path = None
+        if not self._surface.looped:
+            tiles_relpath = os.path.join("data", self.autosave_uuid + ".tiles")
+            tiles_path = os.path.join(oradir, tiles_relpath)
+        needs_update = (
+            self.autosave_dirty
+            or self._autosave_png_bbox is None
+            or not os.path.exists(png_path)
+            or (tiles_path and not os.path.exists(tiles_path))
+        )
+        needs_checkpoint = (
+            tiles_path is None
+            or self._autosave_png_bbox is None
+            or not os.path.exists(png_path)
+            or (self._autosave_journal_updates >=
+                self.AUTOSAVE_CHECKPOINT_INTERVAL)
+        )
+        png_bbox = self._surface.looped and bbox or self._autosave_png_bbox
+        if needs_update and needs_checkpoint:
+            png_bbox = self._surface.looped and bbox or tuple(self.get_bbox())
             task = tiledsurface.PNGFileUpdateTask(
                 surface = self._surface,
                 filename = png_path,
@@ -437,7 +561,31 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
                 **kwargs
             )
             taskproc.add_work(task)
+            taskproc.add_work(self._autosave_checkpoint_cb, png_bbox)
+        elif needs_update:
+            self._autosave_journal_updates += 1
+        if needs_update:
+            if tiles_path:
+                sshot = self._surface.save_snapshot()
+                base_generation = self._autosave_tiles_queued_generation
+                changed = None
+                if base_generation is not None:
+                    changed = self._surface.changed_tiles_since(
+                        base_generation,
+                    )
+                self._autosave_tiles_queued_generation = sshot.generation
+                taskproc.add_work(
+                    self._autosave_tile_index_cb,
+                    sshot,
+                    changed,
+                    base_generation,
+                    tiles_path,
+                    png_path,
+                    png_bbox[0:2],
+                    needs_checkpoint,
+                )
             self.autosave_dirty = False
+        self._autosave_queued_png_bbox = png_bbox
         # Calculate appropriate offsets
         png_x, png_y = png_bbox[0:2]
         ref_x, ref_y = bbox[0:2]
@@ -448,8 +596,52 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         manifest.add(png_relpath)
         elem = self._get_stackxml_element("layer", x, y)
         elem.attrib["src"] = png_relpath
+        if tiles_relpath:
+            manifest.add(tiles_relpath)
+            elem.attrib[self._ORA_TILES_ATTR] = tiles_relpath
         return elem
 
+    def _autosave_checkpoint_cb(self, png_bbox):
+        """Autosave task: record that the checkpoint PNG was written
+
+        The writer drops the rest of its queue if a task fails, so this
+        only runs if the PNG was written successfully. Until then, the
+        previous checkpoint's details stay in effect.
+
+        """
+        self._autosave_png_bbox = png_bbox
+        self._autosave_png_crc = None
+        self._autosave_journal_updates = 0
+        return False
+
+    def _autosave_tile_index_cb(self, sshot, changed, base_generation,
+                                filename, png_filename, origin, checkpoint):
+        """Autosave task: write or update the tile index file
+
+        This runs after any PNG write, so that the index can record
+        the PNG's checksum. The changed tiles are listed by the main
+        thread from the surface's change tracking when the task is
+        queued. They are relative to the previous queued update, so if
+        that didn't complete, the whole file is rewritten instead.
+
+        """
+        written_generation = self._autosave_tiles_written_generation
+        if base_generation is None or base_generation != written_generation:
+            changed = None
+        png_crc = self._autosave_png_crc
+        if checkpoint or png_crc is None:
+            png_crc = lib.tileindex.file_crc(png_filename)
+        lib.tileindex.update_file(
+            filename,
+            sshot.tiledict,
+            changed,
+            origin,
+            png_crc = png_crc,
+        )
+        self._autosave_tiles_written_generation = sshot.generation
+        self._autosave_png_crc = png_crc
+        return False
+
     @staticmethod
     def _make_refname(prefix, path, suffix, sep='-'):
         """Internal: standardized filename for something wiith a path"""
@@ -462,28 +654,88 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
     def _save_rect_to_ora(self, orazip, tmpdir, prefix, path,
                           frame_bbox, rect, **kwargs):
         """Internal: saves a rectangle of the surface to an ORA zip"""
-        # Write PNG data via a tempfile
+        # Write PNG data, possibly in the background
         pngname = self._make_refname(prefix, path, ".png")
-        pngpath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(pngpath, *rect, **kwargs)
-        t1 = time.time()
-        logger.debug('%.3fs surface saving %r', t1-t0, pngname)
-        # Archive and remove
         storepath = "data/%s" % (pngname,)
-        orazip.write(pngpath, storepath)
-        os.remove(pngpath)
+        png_x, png_y = self._write_png_to_ora(
+            orazip, storepath, prefix, rect,
+            **kwargs
+        )
+        # Optionally write a tile index of the same data too
+        tiles_storepath = None
+        if getattr(orazip, "tile_index", False) and not self._surface.looped:
+            tilesname = self._make_refname(prefix, path, ".tiles")
+            tiles_storepath = "data/%s" % (tilesname,)
+            self._write_tile_index_to_ora(
+                orazip, tiles_storepath, storepath, prefix, rect,
+            )
         # Return details
-        png_bbox = tuple(rect)
-        png_x, png_y = png_bbox[0:2]
         ref_x, ref_y = frame_bbox[0:2]
         x = png_x - ref_x
         y = png_y - ref_y
         assert (x == y == 0) or not self._surface.looped
         elem = self._get_stackxml_element("layer", x, y)
         elem.attrib["src"] = storepath
+        if tiles_storepath is not None:
+            elem.attrib[self._ORA_TILES_ATTR] = tiles_storepath
         return elem
 
+    def _write_png_to_ora(self, orazip, storepath, prefix, rect, **kwargs):
+        """Internal: writes a PNG of the surface, or reuses an old one
+
+        :returns: the position of the PNG's top left corner
+        :rtype: tuple
+
+        If the surface is unchanged since it was saved to, or loaded
+        from the file being overwritten, the old PNG data is copied
+        across as it is rather than being encoded again.
+
+        The PNG may be encoded in a worker thread while the main loop
+        keeps running, so it's encoded from a snapshot of the surface.
+
+        """
+        key = (prefix, self.autosave_uuid)
+        surface = self._surface
+        state = orazip.copy_unchanged(
+            storepath, key,
+            lambda s: s.is_current(surface, rect),
+        )
+        if state is None:
+            sshot = surface.save_snapshot()
+            clone_surface = tiledsurface.Surface(
+                looped = surface.looped,
+                looped_size = surface.looped_size,
+            )
+            clone_surface.load_snapshot(sshot)
+            orazip.write_png(storepath, clone_surface.save_as_png,
+                             *rect, **kwargs)
+            state = _OraPNGState(surface, rect, sshot=sshot)
+            orazip.record.add(key, storepath, state)
+        return state.x, state.y
+
+    def _write_tile_index_to_ora(self, orazip, storepath, png_storepath,
+                                 prefix, rect):
+        """Internal: writes a tile index of the surface, or reuses one
+
+        Like the PNG, an unchanged index is copied across as it is. If
+        that ends up not matching the PNG (e.g. one was re-encoded but
+        the other copied), the CRC check when loading spots it, and
+        the PNG gets used instead.
+
+        """
+        key = (prefix + "-tiles", self.autosave_uuid)
+        surface = self._surface
+        state = orazip.copy_unchanged(
+            storepath, key,
+            lambda s: s.is_current(surface, rect),
+        )
+        if state is None:
+            sshot = surface.save_snapshot()
+            orazip.write_tile_index(storepath, png_storepath,
+                                    sshot.tiledict, rect[0:2])
+            state = _OraPNGState(surface, rect, sshot=sshot)
+            orazip.record.add(key, storepath, state)
+
     ## Painting symmetry axis
 
     def set_symmetry_state(self, active, center_x):
@@ -519,6 +771,49 @@ class SurfaceBackedLayer (core.LayerBase, lib.autosave.Autosaveable):
         self._surface.trim(rect)
 
 
+class _OraPNGState (object):
+    """What a PNG written to or read from an OpenRaster file holds
+
+    These are recorded in a `lib.orazipwriter.OraSaveRecord` so that
+    incremental saves can tell whether the PNG is still current. Only
+    a change-tracking marker is kept, not a snapshot, so the surface
+    still owns its tiles and can modify them in place afterwards.
+
+    """
+
+    def __init__(self, surface, rect, exact=True, sshot=None):
+        """Initialize
+
+        :param surface: the surface the PNG was made from or loaded into
+        :param tuple rect: where the PNG is, (x, y, w, h)
+        :param bool exact: False if only the PNG's x and y are known
+        :param sshot: the snapshot of surface the PNG was made from,
+            if it wasn't made from the surface as it is now
+
+        """
+        super(_OraPNGState, self).__init__()
+        self._surface_ref = weakref.ref(surface)
+        if sshot is not None:
+            self._generation = sshot.generation
+        else:
+            self._generation = surface.get_generation()
+        self.x, self.y = rect[0:2]
+        self._rect = exact and tuple(rect) or None
+
+    def is_current(self, surface, rect):
+        """True if the PNG still matches a surface and requested rect
+
+        Looped surfaces are saved filling the requested rectangle, so
+        for those the rectangle must match too.
+
+        """
+        if surface.looped and tuple(rect) != self._rect:
+            return False
+        if surface is not self._surface_ref():
+            return False
+        return surface.changed_tiles_since(self._generation) == []
+
+
 class SurfaceBackedLayerMove (object):
     """Move object wrapper for surface-backed layers
 
@@ -1033,14 +1328,11 @@ class BackgroundLayer (SurfaceBackedLayer):
         rect = (x+x0, y+y0, w, h)
 
         pngname = self._make_refname("background", path, "tile.png")
-        tmppath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(tmppath, *rect, **kwargs)
-        t1 = time.time()
         storename = 'data/%s' % (pngname,)
-        logger.debug('%.3fs surface saving %s', t1 - t0, storename)
-        orazip.write(tmppath, storename)
-        os.remove(tmppath)
+        self._write_png_to_ora(
+            orazip, storename, "background-tile", rect,
+            **kwargs
+        )
         elem.attrib[self.ORA_BGTILE_LEGACY_ATTR] = storename
         elem.attrib[self.ORA_BGTILE_ATTR] = storename
         return elem
@@ -1250,6 +1542,9 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         #: List of strokemap.StrokeShape instances (not stroke.Stroke),
         #: ordered by depth.
         self.strokes = []
+        #: Which of the strokes may touch each tile, for picking.
+        #: It keeps itself up to date with the list.
+        self._stroke_index = lib.strokemap.StrokeIndex()
 
     def clear(self):
         """Clear both the surface and the strokemap"""
@@ -1405,13 +1700,18 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         encapsulate the shape of a rendered stroke, and the brush settings
         which were used to render it.  The shape of the rendered stroke is
         determined by visually diffing snapshots taken before the stroke
-        started and now.
+        started and now. Only the tiles which the surface has noted as
+        changed since the "before" snapshot are compared.
 
         """
+        before_sshot = before.surface_sshot
         after_sshot = self._surface.save_snapshot()
         shape = lib.strokemap.StrokeShape.new_from_snapshots(
-            before.surface_sshot,
+            before_sshot,
             after_sshot,
+            candidates = self._surface.changed_tiles_since(
+                before_sshot.generation,
+            ),
         )
         if shape is not None:
             shape.brush_string = stroke.brush_settings
@@ -1476,7 +1776,7 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
     def get_stroke_info_at(self, x, y):
         """Get the stroke at the given point"""
         x, y = int(x), int(y)
-        for s in reversed(self.strokes):
+        for s in self._stroke_index.get_shapes_at(self.strokes, x, y):
             if s.touches_pixel(x, y):
                 return s
 
@@ -1519,21 +1819,26 @@ class PaintingLayer (SurfaceBackedLayer, core.ExternallyEditable):
         dat_basename = u"%s-strokemap.dat" % (self.autosave_uuid,)
         dat_relpath = os.path.join("data", dat_basename)
         dat_path = os.path.join(oradir, dat_relpath)
-        # Have to do this before the supercall because that will clear
+        # Have to test this before the supercall because that will clear
         # the dirty flag.
-        if self.autosave_dirty or not os.path.exists(dat_path):
-            x, y, w, h = self.get_bbox()
+        needs_update = self.autosave_dirty or not os.path.exists(dat_path)
+        prev_png_bbox = self._autosave_png_bbox
+        # Supercall to queue saving PNG and obtain basic XML
+        elem = super(PaintingLayer, self).queue_autosave(
+            oradir, taskproc, manifest, bbox,
+            **kwargs
+        )
+        # The strokemap is stored relative to the PNG, which may not
+        # have been rewritten at the current bbox.
+        png_bbox = self._autosave_queued_png_bbox
+        if needs_update or png_bbox != prev_png_bbox:
+            x, y, w, h = png_bbox
             task = _StrokemapFileUpdateTask(
                 self.strokes,
                 dat_path,
                 -x, -y,
             )
             taskproc.add_work(task)
-        # Supercall to queue saving PNG and obtain basic XML
-        elem = super(PaintingLayer, self).queue_autosave(
-            oradir, taskproc, manifest, bbox,
-            **kwargs
-        )
         # Add strokemap XML attrs and return.
         # See comment above for compatibility strategy.
         elem.attrib[self._ORA_STROKEMAP_ATTR] = dat_relpath
@@ -1614,6 +1919,10 @@ def _write_strokemap_stroke(f, stroke, brush2id, dx, dy):
 class _StrokemapFileUpdateTask (object):
     """Updates a strokemap file in chunked calls (for autosave)"""
 
+    #: Stroke shapes can be completed or moved by the main thread, so
+    #: the autosave writer must hand this task back to it.
+    autosave_main_thread = True
+
     def __init__(self, strokes, filename, dx, dy):
         super(_StrokemapFileUpdateTask, self).__init__()
         tmp = tempfile.NamedTemporaryFile(
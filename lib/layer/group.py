@@ -28,6 +28,14 @@ import data
 import lib.layer.error
 import lib.surface
 import lib.autosave
+import lib.cache
+
+
+## Module vars
+
+#: Composited tiles cached by the layer stacks of documents, with one
+#: memory budget. The root stack's `render_cache_budget` adjusts it.
+RENDER_CACHE = lib.cache.TileCache(max_bytes=64*1024*1024)
 
 
 ## Class defs
@@ -72,6 +80,14 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         N = tiledsurface.N
         blank_arr = numpy.zeros((N, N, 4), dtype='uint16')
         self._blank_bg_surface = tiledsurface.Background(blank_arr)
+        # Composited tile caches, keyed by (tx, ty, mipmap_level, ...)
+        # They're partitions of the root's cache, so stacks outside a
+        # tree, or in a tree with no cache, don't cache anything.
+        self._tile_cache = None
+        self._composite_cache = lib.cache.TileCachePartition(None)
+        self._below_cache = lib.cache.TileCachePartition(None)
+        self._cache_split_child = None
+        self._above_cache = None  # only while painting
 
     def load_from_openraster(self, orazip, elem, cache_dir, feedback_cb,
                              x=0, y=0, **kwargs):
@@ -208,6 +224,17 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         else:
             return '<%s len=%d>' % (self.__class__.__name__, len(self))
 
+    ## Properties
+
+    @core.LayerBase.root.setter
+    def root(self, newroot):
+        core.LayerBase.root.fset(self, newroot)
+        cache = None
+        if newroot is not None:
+            cache = newroot._tile_cache
+        if cache is not self._tile_cache:
+            self._bind_render_caches(cache)
+
     ## Notification
 
     def _notify_disown(self, orphan, oldindex):
@@ -407,14 +434,27 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
         if isolate and solo and self is not solo:
             isolate = False
         if isolate:
-            N = tiledsurface.N
-            tmp = numpy.zeros((N, N, 4), dtype='uint16')
-            for layer in reversed(self._layers):
-                p = (self is previewing) and layer or previewing
-                s = (self is solo) and layer or solo
-                layer.composite_tile(tmp, True, tx, ty, mipmap_level,
-                                     layers=layers, previewing=p, solo=s,
-                                     **kwargs)
+            using_cache = (layers is None and not (previewing or solo))
+            tmp = None
+            if using_cache:
+                cache_key = (tx, ty, mipmap_level)
+                tmp = self._composite_cache.get(cache_key)
+            if tmp is None:
+                if using_cache:
+                    tmp = self._composite_children_cached(
+                        cache_key, tx, ty, mipmap_level,
+                        **kwargs
+                    )
+                    self._composite_cache[cache_key] = tmp
+                else:
+                    N = tiledsurface.N
+                    tmp = numpy.zeros((N, N, 4), dtype='uint16')
+                    for layer in reversed(self._layers):
+                        p = (self is previewing) and layer or previewing
+                        s = (self is solo) and layer or solo
+                        layer.composite_tile(tmp, True, tx, ty, mipmap_level,
+                                             layers=layers, previewing=p,
+                                             solo=s, **kwargs)
             if previewing or solo:
                 mode = DEFAULT_MODE
                 opacity = 1.0
@@ -431,6 +471,201 @@ class LayerStack (core.LayerBase, lib.autosave.Autosaveable):
                                      layers=layers, previewing=p, solo=s,
                                      **kwargs)
 
+    ## Composited tile caching
+
+    def _composite_children_cached(self, cache_key, tx, ty, mipmap_level,
+                                   dst=None, dst_has_alpha=True, **kwargs):
+        """Composite all children into a new or supplied tile, via caches
+
+        :param tuple cache_key: Key for the below-split cache
+        :param dst: Tile to composite onto; new & blank if None
+        :param bool dst_has_alpha: Alpha flag, for compositing
+        :returns: the composited tile
+        :rtype: numpy.ndarray
+
+        If this stack contains the current layer, the children below
+        the one leading to it are composited once and cached. Painting
+        on the current layer then only needs the cached backdrop plus
+        the layers from the current one upwards.
+
+        """
+        N = tiledsurface.N
+        if dst is None:
+            dst = numpy.zeros((N, N, 4), dtype='uint16')
+        split = self._get_cache_split_index()
+        layers = self._layers
+        if split is not None and split+1 < len(layers):
+            below = self._below_cache.get(cache_key)
+            if below is None:
+                for layer in reversed(layers[split+1:]):
+                    layer.composite_tile(dst, dst_has_alpha, tx, ty,
+                                         mipmap_level, **kwargs)
+                self._below_cache[cache_key] = dst.copy()
+            else:
+                lib.mypaintlib.tile_copy_rgba16_into_rgba16(below, dst)
+            layers = layers[:split+1]
+        above = None
+        if split is not None and split > 0 and self._above_cache is not None:
+            above = self._get_above_tile(cache_key, tx, ty, mipmap_level,
+                                         layers[:split], **kwargs)
+            if above is not None:
+                layers = layers[split:split+1]
+        for layer in reversed(layers):
+            layer.composite_tile(dst, dst_has_alpha, tx, ty,
+                                 mipmap_level, **kwargs)
+        if above is not None:
+            lib.mypaintlib.tile_combine(
+                DEFAULT_MODE, above,
+                dst, dst_has_alpha,
+                1.0,
+            )
+        return dst
+
+    def _get_above_tile(self, cache_key, tx, ty, mipmap_level, layers,
+                        **kwargs):
+        """Get the precomposited layers above the current one's branch
+
+        :param list layers: the layers above the split, topmost first
+        :returns: the cached tile, or None if it can't be used
+
+        Precompositing is only valid if everything above combines
+        using plain src-over, because that's associative.
+
+        """
+        above = self._above_cache.get(cache_key)
+        if above is not None:
+            return above
+        if not _layers_composite_normally(layers):
+            return None
+        N = tiledsurface.N
+        above = numpy.zeros((N, N, 4), dtype='uint16')
+        for layer in reversed(layers):
+            layer.composite_tile(above, True, tx, ty,
+                                 mipmap_level, **kwargs)
+        self._above_cache[cache_key] = above
+        return above
+
+    def _set_above_cache_enabled(self, enabled):
+        """Start or stop caching the layers above the split child
+
+        This is only done while painting, when it's assumed that the
+        layers above are much less likely to change than the current
+        one. Disabling the cache drops its contents.
+
+        """
+        if not enabled:
+            if self._above_cache is not None:
+                self._above_cache.clear()
+            self._above_cache = None
+        elif self._above_cache is None:
+            self._above_cache = lib.cache.TileCachePartition(
+                self._tile_cache,
+            )
+
+    def _bind_render_caches(self, cache):
+        """Use a different shared cache (or None) for composited tiles
+
+        Entries in the old cache are dropped.
+
+        >>> stack = LayerStack()
+        >>> stack._bind_render_caches(RENDER_CACHE)
+        >>> stack._composite_cache[(0, 0, 0)] = numpy.zeros((1,))
+        >>> stack._bind_render_caches(None)
+        >>> stack._composite_cache.get((0, 0, 0)) is None
+        True
+
+        """
+        self._composite_cache.clear()
+        self._below_cache.clear()
+        self._tile_cache = cache
+        self._composite_cache = lib.cache.TileCachePartition(cache)
+        self._below_cache = lib.cache.TileCachePartition(cache)
+        if self._above_cache is not None:
+            self._above_cache.clear()
+            self._above_cache = lib.cache.TileCachePartition(cache)
+
+    def _get_cache_split_index(self):
+        """Index of the child leading to the current layer, or None"""
+        child = self._cache_split_child
+        if child is None:
+            return None
+        try:
+            return self._layers.index(child)
+        except ValueError:
+            return None
+
+    def _set_cache_split_child(self, child):
+        """Sets which child leads to the current layer (or None)
+
+        The below-split cache depends on this, so it's cleared if the
+        child changes.
+
+        """
+        if child is self._cache_split_child:
+            return
+        self._cache_split_child = child
+        self._below_cache.clear()
+        if self._above_cache is not None:
+            self._above_cache.clear()
+
+    def _invalidate_render_caches(self, bbox, child=None):
+        """Drop cached composited tiles in a model-space bbox
+
+        :param tuple bbox: Changed area, x, y, w, h. Zero size means
+            the whole canvas, following `get_full_redraw_bbox()`.
+        :param child: The child layer whose content changed, or None
+            if the change affects all of this stack.
+
+        Cached tiles from below the current layer's branch are kept if
+        the change happened further up the stack, and vice versa.
+
+        """
+        self._drop_cached_tiles(self._composite_cache, bbox)
+        split = self._get_cache_split_index()
+        idx = None
+        if child is not None and split is not None:
+            try:
+                idx = self._layers.index(child)
+            except ValueError:
+                pass
+        if idx is None or idx > split:
+            self._drop_cached_tiles(self._below_cache, bbox)
+        if self._above_cache is not None and (idx is None or idx < split):
+            self._drop_cached_tiles(self._above_cache, bbox)
+
+    @staticmethod
+    def _drop_cached_tiles(cache, bbox):
+        """Drop a cache's entries for tiles intersecting a bbox
+
+        :param lib.cache.TileCachePartition cache: Keyed by
+            (tx, ty, mipmap_level, ...)
+        :param tuple bbox: Model-space x, y, w, h. Empty means everything.
+
+        >>> cache = lib.cache.TileCachePartition(RENDER_CACHE)
+        >>> N = tiledsurface.N
+        >>> keys = [(0, 0, 0), (1, 0, 0), (0, 0, 1), (-1, 3, 0)]
+        >>> for key in keys:
+        ...     cache[key] = numpy.zeros((1,))
+        >>> LayerStack._drop_cached_tiles(cache, (N+1, 1, 1, 1))
+        >>> [k for k in keys if k in cache]
+        [(0, 0, 0), (-1, 3, 0)]
+        >>> LayerStack._drop_cached_tiles(cache, (0, 0, 0, 0))
+        >>> [k for k in keys if k in cache]
+        []
+
+        """
+        cache.drop_area(bbox, tiledsurface.N)
+
+    def clear_render_caches(self):
+        """Clears all cached composited tiles, recursively"""
+        self._composite_cache.clear()
+        self._below_cache.clear()
+        if self._above_cache is not None:
+            self._above_cache.clear()
+        for layer in self._layers:
+            if isinstance(layer, LayerStack):
+                layer.clear_render_caches()
+
     def render_as_pixbuf(self, *args, **kwargs):
         return lib.pixbufsurface.render_as_pixbuf(self, *args, **kwargs)
 
@@ -588,6 +823,28 @@ class LayerStackMove (object):
         return incomplete
 
 
+## Helper functions
+
+
+def _layers_composite_normally(layers):
+    """True if visible layers only ever combine using src-over
+
+    Pass-through groups are looked into, since their children combine
+    directly with the backdrop. Isolated groups only count their own
+    mode.
+
+    """
+    for layer in layers:
+        if not layer.visible:
+            continue
+        if layer.mode == PASS_THROUGH_MODE:
+            if not _layers_composite_normally(layer):
+                return False
+        elif layer.mode != DEFAULT_MODE:
+            return False
+    return True
+
+
 ## Layer factory func
 
 _LAYER_LOADER_CLASS_ORDER = [
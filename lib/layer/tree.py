@@ -17,6 +17,8 @@ from gi.repository import GdkPixbuf
 import re
 import numpy
 import logging
+import contextlib
+import threading
 logger = logging.getLogger(__name__)
 from warnings import warn
 from copy import deepcopy
@@ -28,7 +30,9 @@ import lib.tiledsurface as tiledsurface
 import lib.helpers as helpers
 from lib.observable import event
 import lib.pixbuf
+import lib.pixbufsurface
 import lib.cache
+import lib.surface
 from lib.modes import *
 import data
 import group
@@ -94,6 +98,9 @@ class RootLayerStack (group.LayerStack):
     INITIAL_MODE = lib.mypaintlib.CombineNormal
     PERMITTED_MODES = {INITIAL_MODE}
 
+    #: Default memory budget for the flattened surface's tiles.
+    DEFAULT_FLATTENED_CACHE_BYTES = 32 * 1024 * 1024
+
 
     ## Initialization
 
@@ -102,10 +109,24 @@ class RootLayerStack (group.LayerStack):
 
         :param doc: The model document. May be None for testing.
         :type doc: lib.document.Document
+
+        Stacks with no document, like the clones made for saving,
+        don't use the shared render cache: they'd only evict the
+        document's cached tiles with ones that are never used again.
+
         """
         super(RootLayerStack, self).__init__(**kwargs)
         self.doc = doc
-        self._render_cache = lib.cache.LRUCache()
+        if doc is not None:
+            self._bind_render_caches(group.RENDER_CACHE)
+        self._render_cache = lib.cache.TileCachePartition(self._tile_cache)
+        self._cache_split_stacks = set()
+        self._painting_cache_stacks = set()
+        self._flattened_surface = FlattenedSurface(
+            self,
+            max_bytes = self.DEFAULT_FLATTENED_CACHE_BYTES,
+        )
+        self._thumbnail = StackThumbnail()
         # Background
         default_bg = (255, 255, 255)
         self._default_background = default_bg
@@ -120,20 +141,17 @@ class RootLayerStack (group.LayerStack):
         # Current layer
         self._current_path = ()
         # Self-observation
-        self.layer_content_changed += self._clear_render_cache
-        self.layer_properties_changed += self._clear_render_cache
-        self.layer_deleted += self._clear_render_cache
-        self.layer_inserted += self._clear_render_cache
-
-    def _clear_render_cache(self, *_ignored):
-        self._render_cache.clear()
+        self.layer_content_changed += self._render_caches_content_changed_cb
+        self.layer_deleted += self._render_caches_layer_deleted_cb
+        self.layer_inserted += self._render_caches_layer_inserted_cb
+        self.current_path_updated += self._render_caches_current_path_cb
 
     def clear(self):
         """Clear the layer and set the default background"""
         super(RootLayerStack, self).clear()
         self.set_background(self._default_background)
         self.current_path = ()
-        self._clear_render_cache()
+        self.clear_render_caches()
 
     def ensure_populated(self, layer_class=None):
         """Ensures that the stack is non-empty by making a new layer if needed
@@ -310,15 +328,7 @@ class RootLayerStack (group.LayerStack):
         :param **options: Passed to `render_as_pixbuf()`.
         :rtype: GtkPixbuf
         """
-        x, y, w, h = bbox
-        if w == 0 or h == 0:
-            # workaround to save empty documents
-            x, y, w, h = 0, 0, tiledsurface.N, tiledsurface.N
-        mipmap_level = 0
-        while (mipmap_level < tiledsurface.MAX_MIPMAP_LEVEL and
-               max(w, h) >= 512):
-            mipmap_level += 1
-            x, y, w, h = x/2, y/2, w/2, h/2
+        mipmap_level, (x, y, w, h) = _get_thumbnail_rect(bbox)
         pixbuf = self.render_as_pixbuf(x, y, w, h,
                                        mipmap_level=mipmap_level,
                                        **options)
@@ -375,18 +385,18 @@ class RootLayerStack (group.LayerStack):
 
         N = tiledsurface.N
 
+        using_cache = (
+            layers is None
+            and overlay is None
+            and not (kwargs.get("solo") or kwargs.get("previewing"))
+        )
         cache_key = None
         cache_hit = False
         if dst.dtype == 'uint8':
             dst_8bit = dst
             dst = None
-            using_cache = (
-                layers is None
-                and overlay is None
-                and not (kwargs.get("solo") or kwargs.get("previewing"))
-            )
             if using_cache:
-                cache_key = (tx, ty, dst_has_alpha, mipmap_level,
+                cache_key = (tx, ty, mipmap_level, dst_has_alpha,
                              render_background, id(opaque_base_tile))
                 dst = self._render_cache.get(cache_key)
             if dst is None:
@@ -408,9 +418,19 @@ class RootLayerStack (group.LayerStack):
 
             background_surface.blit_tile_into(dst, dst_has_alpha, tx, ty,
                                               mipmap_level)
-            for layer in reversed(self):
-                layer.composite_tile(dst, dst_has_alpha, tx, ty,
-                                     mipmap_level, layers=layers, **kwargs)
+            if using_cache:
+                below_key = (tx, ty, mipmap_level, dst_has_alpha,
+                             render_background)
+                self._composite_children_cached(
+                    below_key, tx, ty, mipmap_level,
+                    dst=dst, dst_has_alpha=dst_has_alpha,
+                    **kwargs
+                )
+            else:
+                for layer in reversed(self):
+                    layer.composite_tile(dst, dst_has_alpha, tx, ty,
+                                         mipmap_level, layers=layers,
+                                         **kwargs)
             if overlay:
                 overlay.composite_tile(dst, dst_has_alpha, tx, ty,
                                        mipmap_level, layers=set([overlay]),
@@ -434,6 +454,181 @@ class RootLayerStack (group.LayerStack):
             else:
                 lib.mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, dst_8bit)
 
+    ## Rendering: cache maintenance
+
+    def clear_render_caches(self):
+        """Clears all cached composited tiles, recursively"""
+        super(RootLayerStack, self).clear_render_caches()
+        self._render_cache.clear()
+        self._flattened_surface.invalidate((0, 0, 0, 0))
+        self._thumbnail.invalidate((0, 0, 0, 0))
+
+    def _invalidate_render_caches(self, bbox, child=None):
+        """Drop cached composited tiles in a model-space bbox"""
+        super(RootLayerStack, self)._invalidate_render_caches(bbox, child)
+        self._drop_cached_tiles(self._render_cache, bbox)
+        self._flattened_surface.invalidate(bbox)
+        self._thumbnail.invalidate(bbox)
+
+    def get_flattened_surface(self):
+        """Returns a read-only surface showing all the visible layers
+
+        :rtype: FlattenedSurface
+
+        The same surface is returned each time, and it keeps up to
+        date with the stack, so tiles it has composited for one use
+        can be reused by the next.
+
+        """
+        return self._flattened_surface
+
+    def get_thumbnail(self):
+        """Returns a thumbnail of the stack which it keeps up to date
+
+        :rtype: StackThumbnail
+
+        Changes to the stack are reported to the thumbnail, so each
+        render of it only needs to redo the parts which changed.
+
+        """
+        return self._thumbnail
+
+    def start_painting_cache(self, path):
+        """Start precompositing around a layer about to be painted on
+
+        :param tuple path: Path to the layer to be painted
+
+        While painting, each stack along the current layer's path caches
+        the composite of its children above the branch leading to the
+        current layer, in addition to the usual cache of those below.
+        Both are filled lazily for the tiles being redrawn. A redraw of
+        a tile touched by the brush then only combines those with the
+        current layer, rather than walking the whole tree.
+
+        Only the current layer can be cached around. Call
+        `stop_painting_cache()` when the stroke ends.
+
+        """
+        self.stop_painting_cache()
+        self._update_render_cache_splits()
+        if tuple(path) != self.get_current_path():
+            logger.debug("painting cache: %r is not current", path)
+            return
+        for stack in self._cache_split_stacks:
+            stack._set_above_cache_enabled(True)
+        self._painting_cache_stacks = set(self._cache_split_stacks)
+
+    def stop_painting_cache(self):
+        """Stop precompositing around a layer, and drop the extra caches"""
+        for stack in self._painting_cache_stacks:
+            stack._set_above_cache_enabled(False)
+        self._painting_cache_stacks = set()
+
+    @property
+    def render_cache_budget(self):
+        """Memory budget for the rendered tile caches, in bytes
+
+        The stacks of all documents share the one budget, for their composited
+        tiles as well as the fully rendered ones.
+
+        >>> root = RootLayerStack(None)
+        >>> old_budget = root.render_cache_budget
+        >>> root.render_cache_budget = 32 * 1024 * 1024
+        >>> root.render_cache_stats.nbytes <= root.render_cache_budget
+        True
+        >>> root.render_cache_budget = old_budget
+
+        """
+        return group.RENDER_CACHE.max_bytes
+
+    @render_cache_budget.setter
+    def render_cache_budget(self, nbytes):
+        group.RENDER_CACHE.max_bytes = max(0, int(nbytes))
+
+    @property
+    def render_cache_stats(self):
+        """Usage and hit/miss/eviction counts for the rendered tile caches
+
+        :rtype: lib.cache.CacheStats
+
+        """
+        return group.RENDER_CACHE.stats
+
+    def _render_caches_content_changed_cb(self, root, layer, *bbox):
+        """Invalidate cached tiles along the changed layer's path
+
+        Only the changed layer's ancestors are affected, and only in
+        the area which changed. Cached composites of unrelated groups,
+        and of the layers below the current layer, are kept.
+
+        """
+        if layer is self:
+            self._invalidate_render_caches(bbox)
+            return
+        path = self.deepindex(layer)
+        if not path:
+            self.clear_render_caches()
+            return
+        if isinstance(layer, group.LayerStack):
+            layer._invalidate_render_caches(bbox)
+        parents = [self] + list(self.layers_along_path(path[:-1]))
+        children = list(self.layers_along_path(path))
+        for parent, child in zip(parents, children):
+            parent._invalidate_render_caches(bbox, child)
+
+    def _render_caches_layer_inserted_cb(self, root, path):
+        """Forget anything cached by a group before it was inserted"""
+        layer = self.deepget(path)
+        if isinstance(layer, group.LayerStack):
+            layer.clear_render_caches()
+        self._update_render_cache_splits()
+
+    def _render_caches_layer_deleted_cb(self, root, path):
+        self._update_render_cache_splits()
+
+    def _render_caches_current_path_cb(self, root, path):
+        self._update_render_cache_splits()
+
+    def _update_render_cache_splits(self):
+        """Tell the stacks along the current path where to split caching
+
+        Stacks cache the composite of their children below the branch
+        which leads to the current layer, for faster redraws while
+        painting.
+
+        """
+        split_stacks = set()
+        stack = self
+        for idx in self.get_current_path():
+            if not isinstance(stack, group.LayerStack):
+                break
+            if not (0 <= idx < len(stack)):
+                break
+            child = stack[idx]
+            stack._set_cache_split_child(child)
+            split_stacks.add(stack)
+            stack = child
+        for stack in self._cache_split_stacks:
+            if stack not in split_stacks:
+                stack._set_cache_split_child(None)
+        self._cache_split_stacks = split_stacks
+
+    ## Flood fill
+
+    def flood_fill(self, x, y, color, bbox, tolerance, dst_layer=None):
+        """Fills a point on the flattened stack with a color (into other only!)
+
+        See `PaintingLayer.flood_fill() for parameters and semantics.
+        The root stack samples its flattened surface, so fills made one
+        after another share the tiles composited for the first.
+
+        """
+        assert dst_layer is not self
+        assert dst_layer is not None
+        src = self.get_flattened_surface()
+        dst = dst_layer._surface
+        tiledsurface.flood_fill(src, x, y, color, bbox, tolerance, dst)
+
     ## Symmetry axis
 
     @property
@@ -2030,6 +2225,259 @@ class RootLayerStackSnapshot (group.LayerStackSnapshot):
         layer.current_path = self.current_path
 
 
+class FlattenedSurface (lib.surface.TileAccessible):
+    """Read-only tiled view of a root stack, composited as needed
+
+    Tiles are the visible layers composited together, with the
+    background layer if it is shown, and with alpha. Each tile is
+    composited the first time it's requested, and then cached until
+    the content of the stack changes there.
+
+    >>> import data
+    >>> root = RootLayerStack(doc=None)
+    >>> layer = data.PaintingLayer()
+    >>> root.append(layer)
+    >>> flat = root.get_flattened_surface()
+    >>> with flat.tile_request(0, 0, readonly=True) as tile:
+    ...     before = tile.copy()
+    >>> with flat.tile_request(0, 0, readonly=True) as tile:
+    ...     (tile == before).all()
+    True
+    >>> flat.stats.misses, flat.stats.hits
+    (1, 1)
+
+    Tiles are dropped when the stack reports a change to them.
+
+    >>> N = tiledsurface.N
+    >>> with layer._surface.tile_request(0, 0, readonly=False) as a:
+    ...     a[...] = 1 << 15
+    >>> layer._surface.notify_observers(0, 0, N, N)
+    >>> flat.stats.entries
+    0
+    >>> with flat.tile_request(0, 0, readonly=True) as tile:
+    ...     (tile == before).all()
+    False
+
+    The arrays handed out are shared, and must not be modified.
+
+    """
+
+    def __init__(self, root, max_bytes):
+        """Initialize, for a root stack
+
+        :param RootLayerStack root: Layers to composite.
+        :param int max_bytes: Memory budget for cached tiles.
+
+        """
+        super(FlattenedSurface, self).__init__()
+        self._root = root
+        self._cache = lib.cache.TileCache(max_bytes=max_bytes)
+        self._tiles = lib.cache.TileCachePartition(self._cache)
+
+    @contextlib.contextmanager
+    def tile_request(self, tx, ty, readonly):
+        """Context manager that fetches a composited tile
+
+        Only readonly tile requests are supported.
+        """
+        if not readonly:
+            raise ValueError("Only readonly tile requests are supported")
+        key = (tx, ty, 0)
+        tile = self._tiles.get(key)
+        if tile is None:
+            N = tiledsurface.N
+            tile = numpy.zeros((N, N, 4), 'uint16')
+            self._root.composite_tile(tile, True, tx, ty)
+            self._tiles[key] = tile
+        yield tile
+
+    def get_bbox(self):
+        """Explicit passthrough of get_bbox"""
+        return self._root.get_bbox()
+
+    def invalidate(self, bbox):
+        """Drop the cached tiles in a model-space bbox (empty: all)"""
+        group.LayerStack._drop_cached_tiles(self._tiles, bbox)
+
+    @property
+    def stats(self):
+        """Usage and hit/miss/eviction counts for the cached tiles
+
+        :rtype: lib.cache.CacheStats
+
+        """
+        return self._cache.stats
+
+
+class StackThumbnail (object):
+    """Thumbnail of a root stack, re-rendered only where it changed
+
+    The thumbnail is rendered a tile at a time at a mipmap level, like
+    `RootLayerStack.render_thumbnail()`, and the tiles are kept between
+    renders. When the stack reports a change, only the tiles it touched
+    are rendered again. Rendering takes two steps, so that it can be
+    done from a copy of the stack in another thread: `prepare()` is
+    called in the main thread, then `render()` anywhere.
+
+    >>> import data
+    >>> root = RootLayerStack(doc=None)
+    >>> layer = data.PaintingLayer()
+    >>> root.append(layer)
+    >>> N = tiledsurface.N
+    >>> bbox = (0, 0, 4*N, 4*N)
+    >>> thumb = root.get_thumbnail()
+    >>> pixbuf = thumb.render(root, thumb.prepare(bbox))
+    >>> pixbuf.get_width(), pixbuf.get_height(), thumb.tiles_rendered
+    (256, 256, 16)
+
+    >>> with layer._surface.tile_request(1, 1, readonly=False) as a:
+    ...     a[...] = 1 << 15
+    >>> layer._surface.notify_observers(N, N, N, N)
+    >>> pixbuf = thumb.render(root, thumb.prepare(bbox))
+    >>> thumb.tiles_rendered, thumb.changed
+    (1, True)
+    >>> pixbuf = thumb.render(root, thumb.prepare(bbox))
+    >>> thumb.tiles_rendered, thumb.changed
+    (0, False)
+
+    """
+
+    def __init__(self):
+        super(StackThumbnail, self).__init__()
+        self._lock = threading.Lock()
+        # Changes reported since the last prepare(), at _mipmap_level
+        self._mipmap_level = None
+        self._rect = None
+        self._dirty = set()
+        self._all_dirty = True
+        # Rendered tiles, only used by render()
+        self._tiles = {}
+        self._pixbuf = None
+        self._pixbuf_rect = None
+        #: Number of tiles the last render() had to render
+        self.tiles_rendered = 0
+        #: Whether the last render() gave a different thumbnail
+        self.changed = False
+
+    def invalidate(self, bbox):
+        """Marks a model-space bbox as changed (empty: everything)"""
+        x, y, w, h = bbox
+        with self._lock:
+            if self._all_dirty:
+                return
+            if w <= 0 or h <= 0:
+                self._all_dirty = True
+                self._dirty.clear()
+                return
+            N = tiledsurface.N
+            size = N << self._mipmap_level
+            rx, ry, rw, rh = self._rect
+            tx0 = max(x // size, rx // N)
+            ty0 = max(y // size, ry // N)
+            tx1 = min((x + w - 1) // size, (rx + rw - 1) // N)
+            ty1 = min((y + h - 1) // size, (ry + rh - 1) // N)
+            for ty in xrange(ty0, ty1 + 1):
+                for tx in xrange(tx0, tx1 + 1):
+                    self._dirty.add((tx, ty))
+
+    def prepare(self, bbox):
+        """Takes the changes so far, for a render of a bbox (main thread)
+
+        :param tuple bbox: model-space area to make a thumbnail of
+        :returns: an opaque object to pass to `render()`
+
+        """
+        mipmap_level, rect = _get_thumbnail_rect(bbox)
+        with self._lock:
+            if mipmap_level != self._mipmap_level:
+                self._mipmap_level = mipmap_level
+                self._all_dirty = True
+            self._rect = rect
+            dirty = None
+            if not self._all_dirty:
+                dirty = self._dirty
+            self._dirty = set()
+            self._all_dirty = False
+        return (mipmap_level, rect, dirty)
+
+    def render(self, root, job, **options):
+        """Renders the thumbnail, redoing only what's changed
+
+        :param RootLayerStack root: the stack, or a copy of it
+        :param job: from `prepare()`
+        :param **options: passed to `root.blit_tile_into()`
+        :rtype: GdkPixbuf.Pixbuf
+
+        Renders must be done in the order they were prepared in. If one
+        fails, the next one renders everything.
+
+        """
+        mipmap_level, rect, dirty = job
+        tiles = self._tiles
+        if dirty is None:
+            tiles.clear()
+        rendered = 0
+        try:
+            surf = lib.pixbufsurface.Surface(*rect)
+            needed = surf.get_tiles()
+            for pos in needed:
+                if (pos not in tiles) or (dirty and pos in dirty):
+                    rendered += 1
+            changed = (rendered > 0) or (rect != self._pixbuf_rect)
+            if not changed and self._pixbuf is not None:
+                self.tiles_rendered = 0
+                self.changed = False
+                return self._pixbuf
+            for (tx, ty), dst in needed.iteritems():
+                tile = tiles.get((tx, ty))
+                if tile is None or (dirty and (tx, ty) in dirty):
+                    root.blit_tile_into(dst, False, tx, ty,
+                                        mipmap_level=mipmap_level,
+                                        **options)
+                    tiles[(tx, ty)] = dst.copy()
+                else:
+                    dst[...] = tile
+            for pos in list(tiles.keys()):
+                if pos not in needed:
+                    tiles.pop(pos)
+            pixbuf = helpers.scale_proportionally(surf.pixbuf, 256, 256)
+        except Exception:
+            self.invalidate((0, 0, 0, 0))
+            raise
+        self._pixbuf = pixbuf
+        self._pixbuf_rect = rect
+        self.tiles_rendered = rendered
+        self.changed = True
+        return pixbuf
+
+
+## Thumbnail helper functions
+
+
+def _get_thumbnail_rect(bbox):
+    """Returns the mipmap level and rect to render a thumbnail from
+
+    :param tuple bbox: model-space area to make a thumbnail of
+    :returns: (mipmap_level, (x, y, w, h)), with the rect at that level
+
+    >>> _get_thumbnail_rect((0, 0, 2000, 1000))
+    (2, (0, 0, 500, 250))
+    >>> _get_thumbnail_rect((0, 0, 0, 0))
+    (0, (0, 0, 64, 64))
+
+    """
+    x, y, w, h = bbox
+    if w == 0 or h == 0:
+        # workaround to save empty documents
+        x, y, w, h = 0, 0, tiledsurface.N, tiledsurface.N
+    mipmap_level = 0
+    while (mipmap_level < tiledsurface.MAX_MIPMAP_LEVEL and
+           max(w, h) >= 512):
+        mipmap_level += 1
+        x, y, w, h = x/2, y/2, w/2, h/2
+    return mipmap_level, (x, y, w, h)
+
+
 ## Layer path tuple functions
 
 
@@ -0,0 +1,585 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by Andrew Chadwick <a.t.chadwick@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Reading of OpenRaster zipfile entries, with parallel PNG decoding
+
+When loading, the layers tree reads its entries through an
+`OraZipReader` rather than directly from the zipfile. Layer PNGs can
+then be decoded straight into tiles by a `lib.workerpool.WorkerPool`
+while the rest of the tree is being loaded. The decoded tiles are
+handed over to their surfaces in the main thread, in the same order as
+they were requested.
+
+    >>> import zipfile
+    >>> import lib.workerpool
+    >>> pool = lib.workerpool.WorkerPool(2)
+    >>> z = zipfile.ZipFile("tests/smallimage.ora", "r")
+    >>> r = OraZipReader(z, pool=pool)
+    >>> s0 = lib.tiledsurface.Surface()
+    >>> s1 = lib.tiledsurface.Surface()
+    >>> r.load_png("data/layer000.png", 0, 0, s0)
+    >>> r.load_png("data/layer001.png", 64, 0, s1)
+    >>> counts = []
+    >>> r.call_when_loaded(lambda: counts.append(len(s1.tiledict)))
+    >>> r.finish()
+    >>> counts
+    [2]
+    >>> sorted(s0.tiledict.keys()), sorted(s1.tiledict.keys())
+    ([(0, 0), (1, 0)], [(1, 0), (2, 0)])
+    >>> z.close()
+    >>> pool.shutdown()
+
+In lazy mode, surfaces are instead backed by references to their PNGs,
+which are only decoded when the tiles are first needed. PNG data can
+only be decoded from the top, so looking up a tile decodes the rows
+above it too, and the decoder is paused after its row until more are
+needed. The file is kept open for this until all of its PNGs have
+been loaded or dropped.
+
+    >>> z = zipfile.ZipFile("tests/smallimage.ora", "r")
+    >>> r = OraZipReader(z, lazy=True)
+    >>> s0 = lib.tiledsurface.Surface()
+    >>> r.load_png("data/layer000.png", 0, 0, s0)
+    >>> r.finish()
+    >>> z.close()
+    >>> s0.tiledict.__class__.__name__
+    '_LazyTileMap'
+    >>> tuple(s0.get_bbox())
+    (0, 0, 128, 64)
+    >>> s0.tiledict.get((1, 0)) is not None
+    True
+    >>> sorted(s0.tiledict.keys())
+    [(0, 0), (1, 0)]
+
+Windows can't replace a file which is still open, so before saving
+over it, `release_file()` reads whatever is still needed into memory
+and closes it.
+
+    >>> z = zipfile.ZipFile("tests/smallimage.ora", "r")
+    >>> r = OraZipReader(z, lazy=True)
+    >>> s1 = lib.tiledsurface.Surface()
+    >>> r.load_png("data/layer001.png", 64, 0, s1)
+    >>> r.finish()
+    >>> z.close()
+    >>> release_file("tests/smallimage.ora")
+    >>> r._archive.closed
+    True
+    >>> sorted(s1.tiledict.keys())
+    [(1, 0), (2, 0)]
+
+Layers saved with tile index entries (see `lib.tileindex`) can have
+their tiles loaded from those instead, one at a time as each tile is
+first needed, without decoding their PNGs at all. That's the only way
+to get true random access to tiles.
+
+"""
+
+
+## Imports
+
+import os
+import zipfile
+import struct
+import threading
+import weakref
+from cStringIO import StringIO
+import logging
+logger = logging.getLogger(__name__)
+
+import lib.tiledsurface
+import lib.orazipwriter
+import lib.tileindex
+import lib.errors
+
+
+## Module vars
+
+#: Files still open for lazy loading, as _OraArchive objects.
+_OPEN_ARCHIVES = weakref.WeakSet()
+
+
+## Public functions
+
+
+def release_file(filename):
+    """Stops lazily loaded layers from reading a file any more
+
+    :param unicode filename: The file, which is about to be replaced
+
+    Anything which lazily loaded layers or tile indexes still need from
+    the file is read into memory, and then the file is closed. Call
+    this before saving over a file which may have been loaded lazily.
+
+    """
+    path = os.path.realpath(filename)
+    for archive in list(_OPEN_ARCHIVES):
+        if archive.path == path:
+            archive.close()
+
+
+## Class defs
+
+
+class OraZipReader (object):
+    """Wraps a ZipFile, decoding layer PNGs in the background
+
+    This supports the parts of the `zipfile.ZipFile` interface which
+    the layer loading code uses, so it can be passed to layers'
+    ``load_from_openraster()`` methods in place of the zipfile itself.
+
+    """
+
+    #: How often to call the feedback callback while waiting, in seconds
+    FEEDBACK_INTERVAL = 0.1
+
+    def __init__(self, orazip, pool=None, feedback_cb=None, record=None,
+                 lazy=False):
+        """Initialize
+
+        :param zipfile.ZipFile orazip: zipfile open for reading
+        :param lib.workerpool.WorkerPool pool: for decoding PNGs
+        :param callable feedback_cb: called every so often while
+            waiting for PNGs to be decoded in the pool.
+        :param lib.orazipwriter.OraSaveRecord record: receives notes
+            about what the entries hold, for later saves.
+        :param bool lazy: only decode PNGs when their tiles are needed
+
+        If `pool` is None, or if the zipfile wasn't opened by name,
+        PNGs are decoded immediately. Lazy loading and tile indexes
+        also need the zipfile to have been opened by name.
+
+        """
+        super(OraZipReader, self).__init__()
+        self._orazip = orazip
+        if not isinstance(getattr(orazip, "filename", None), basestring):
+            pool = None
+            lazy = False
+        self._pool = pool
+        self._lazy = lazy
+        self._archive = None  # _OraArchive, for lazy or indexed loading
+        self._feedback_cb = feedback_cb
+        if record is None:
+            record = lib.orazipwriter.OraSaveRecord()
+        self.record = record
+        self._pending = []  # [(job_or_None, fallback_func, func, args)]
+
+    @property
+    def zipfile(self):
+        """The underlying zipfile"""
+        return self._orazip
+
+    ## ZipFile-like interface
+
+    def open(self, name, mode="r"):
+        """Open an entry as a file-like object (main thread only)"""
+        return self._orazip.open(name, mode)
+
+    def read(self, name):
+        """Returns the data of an entry"""
+        return self._orazip.read(name)
+
+    def extract(self, member, path=None):
+        """Extract an entry to the filesystem"""
+        return self._orazip.extract(member, path=path)
+
+    def getinfo(self, name):
+        return self._orazip.getinfo(name)
+
+    def namelist(self):
+        return self._orazip.namelist()
+
+    ## PNG decoding
+
+    def load_png(self, src, x, y, surface, fallback_func=None):
+        """Load a PNG entry into a surface, possibly in the background
+
+        :param unicode src: name of the entry in the zipfile
+        :param int x: X-coordinate at which to load the data
+        :param int y: Y-coordinate at which to load the data
+        :param lib.tiledsurface.MyPaintSurface surface: gets the tiles
+        :param callable fallback_func: called in the main thread
+            instead if the PNG can't be decoded this way
+            (e.g. interlaced PNGs), to load it some other way.
+
+        The surface's tiles are replaced in the main thread, once the
+        PNG has been decoded. The entry is opened separately in the
+        worker thread, so this doesn't interfere with reads of other
+        entries meanwhile. In lazy mode, the surface is loaded right
+        away with a reference to the entry instead.
+
+        """
+        if self._lazy and self._load_png_lazily(src, x, y, surface):
+            return
+        done_func = surface.load_snapshot
+        if self._pool is None:
+            try:
+                sshot = self._load_png(self._orazip, src, x, y,
+                                       feedback_cb=self._feedback_cb)
+            except lib.errors.FileHandlingError as err:
+                if fallback_func is None:
+                    raise
+                logger.warning("Falling back for %r: %s", src, err)
+                self._append(None, None, fallback_func)
+            else:
+                self._append(None, None, done_func, sshot)
+        else:
+            job = self._pool.submit(self._load_png_from_file,
+                                    self._orazip.filename, src, x, y)
+            self._append(job, fallback_func, done_func)
+
+    def load_tile_index(self, src, png_src, x, y, surface):
+        """Load a surface from a tile index entry, if it's usable
+
+        :param unicode src: name of the tile index entry
+        :param unicode png_src: name of the PNG entry it goes with
+        :param int x: X-coordinate at which to load the PNG's data
+        :param int y: Y-coordinate at which to load the PNG's data
+        :param lib.tiledsurface.MyPaintSurface surface: gets the tiles
+        :returns: whether the surface will be loaded
+        :rtype: bool
+
+        Only the index is read now. Each tile's data is read from the
+        file when the tile is first used, so the file is kept open
+        until all such tiles have been used or dropped. The index
+        isn't usable if the PNG was changed after it was written, or
+        if the data wouldn't land on the tile grid at `x`, `y`. In
+        those cases, the PNG should be loaded instead.
+
+        """
+        if not isinstance(getattr(self._orazip, "filename", None),
+                          basestring):
+            return False
+        try:
+            png_crc = self._orazip.getinfo(png_src).CRC
+            if self._archive is None:
+                self._archive = _OraArchive(self._orazip.filename)
+            index = self._archive.open_tile_index(src)
+            sshot = index.load_tiles(x, y, png_crc=png_crc)
+        except (KeyError, IOError, lib.tileindex.InvalidTileIndex) as err:
+            logger.warning("Not using tile index %r: %s", src, err)
+            return False
+        self._append(None, None, surface.load_snapshot, sshot)
+        return True
+
+    def call_when_loaded(self, func, *args):
+        """Call a function once the PNGs requested so far are loaded
+
+        The function is called in the main thread, with the given args.
+
+        """
+        self._append(None, None, func, *args)
+
+    def _load_png_lazily(self, src, x, y, surface):
+        """Back a surface with a PNG entry, if it's suitable
+
+        :returns: whether the surface was loaded
+        :rtype: bool
+
+        Only the PNG's header is read now.
+
+        """
+        try:
+            fp = _open_member(self._orazip, src)
+            try:
+                header = fp.read(_PNG_HEADER_SIZE)
+            finally:
+                fp.close()
+        except KeyError:
+            return False
+        if len(header) < _PNG_HEADER_SIZE:
+            return False
+        sig, ihdr, w, h, interlace = struct.unpack(_PNG_HEADER_FORMAT,
+                                                   header)
+        if sig != _PNG_SIGNATURE or ihdr != "IHDR" or interlace != 0:
+            return False  # fastpng can't load it, so no point
+        if self._archive is None:
+            self._archive = _OraArchive(self._orazip.filename)
+        source = _LazyOraPNG(self._archive, src, x, y, w, h)
+        self._archive.add_source(source)
+        surface.load_lazily(source)
+        return True
+
+    def _load_png_from_file(self, filename, src, x, y):
+        """Decode a PNG entry using a private ZipFile (worker thread)"""
+        orazip = zipfile.ZipFile(filename, "r")
+        try:
+            return self._load_png(orazip, src, x, y)
+        finally:
+            orazip.close()
+
+    def _load_png(self, orazip, src, x, y, feedback_cb=None):
+        fp = _open_member(orazip, src)
+        try:
+            return _load_png_tiles(fp, x, y, feedback_cb=feedback_cb)
+        finally:
+            fp.close()
+
+    ## Ordering
+
+    def _append(self, job, fallback_func, func, *args):
+        self._pending.append((job, fallback_func, func, args))
+        self._finish_ready()
+
+    def _finish_ready(self):
+        """Hand over leading results which are ready"""
+        pending = self._pending
+        while pending:
+            job = pending[0][0]
+            if job is not None and not job.done():
+                break
+            self._hand_over(*pending.pop(0))
+
+    def finish(self):
+        """Wait for all pending PNGs, and hand them over"""
+        pending = self._pending
+        try:
+            while pending:
+                entry = pending.pop(0)
+                job = entry[0]
+                if job is not None:
+                    self._join(job)
+                self._hand_over(*entry)
+        finally:
+            self._discard()
+
+    def _hand_over(self, job, fallback_func, func, args):
+        """Call a pending entry's function with its result"""
+        if job is not None:
+            try:
+                args = (job.wait(),)  # re-raises errors
+            except lib.errors.FileHandlingError as err:
+                if fallback_func is None:
+                    raise
+                logger.warning("Falling back after error: %s", err)
+                func, args = fallback_func, ()
+        func(*args)
+
+    def _join(self, job):
+        """Wait for a job to finish, giving feedback while waiting"""
+        if self._feedback_cb is None:
+            return
+        while not job.join(self.FEEDBACK_INTERVAL):
+            self._feedback_cb()
+
+    def _discard(self):
+        """Clean up after an error, waiting for outstanding jobs"""
+        while self._pending:
+            job = self._pending.pop(0)[0]
+            if job is None:
+                continue
+            try:
+                job.wait()
+            except Exception:
+                pass
+
+
+class _OraArchive (object):
+    """An OpenRaster file, kept open for lazy loading of its data
+
+    Keeping the file open means its data stays readable even if it's
+    renamed or unlinked. The file is closed when nothing refers to it
+    any more, i.e. when all the PNGs which were to be loaded lazily and
+    all the tiles in its tile indexes have been loaded, or their layers
+    dropped. It can also be closed early with `close()`.
+
+    """
+
+    def __init__(self, filename):
+        super(_OraArchive, self).__init__()
+        self._filename = filename
+        self.path = os.path.realpath(filename)
+        self._fp = open(filename, "rb")
+        self._zipfile = zipfile.ZipFile(self._fp, "r")
+        self._lock = threading.Lock()
+        self._sources = weakref.WeakSet()  # _LazyOraPNG
+        self._indexes = weakref.WeakSet()  # lib.tileindex.TileIndex
+        self._entries = None  # {src: data} once closed
+        _OPEN_ARCHIVES.add(self)
+
+    def __repr__(self):
+        return "<_OraArchive %r>" % (self._filename,)
+
+    @property
+    def closed(self):
+        """Whether the file has been closed by `close()`"""
+        return self._entries is not None
+
+    def add_source(self, source):
+        """Registers a lazy PNG, whose data is kept if it's closed"""
+        self._sources.add(source)
+
+    def close(self):
+        """Reads in the data still needed, and closes the file
+
+        The tile indexes opened from the file are read into memory, and
+        so are the PNG entries which haven't been decoded yet. Reads
+        are served from memory after this.
+
+        """
+        for index in list(self._indexes):
+            index.detach()
+        with self._lock:
+            if self._entries is not None:
+                return
+            entries = {}
+            for source in list(self._sources):
+                if source.decoded or source.src in entries:
+                    continue
+                fp = _open_member(self._zipfile, source.src)
+                try:
+                    entries[source.src] = fp.read()
+                finally:
+                    fp.close()
+            self._entries = entries
+            self._zipfile.close()
+            self._fp.close()
+        _OPEN_ARCHIVES.discard(self)
+        logger.debug("%r: closed, keeping %d entries in memory",
+                     self, len(entries))
+
+    def read(self, src):
+        """Returns the data of an entry (any thread)"""
+        with self._lock:
+            if self._entries is not None:
+                return self._entries[src]
+            fp = _open_member(self._zipfile, src)
+            try:
+                return fp.read()
+            finally:
+                fp.close()
+
+    def open_tile_index(self, src):
+        """Opens a tile index entry for random access
+
+        :rtype: lib.tileindex.TileIndex
+        :raises lib.tileindex.InvalidTileIndex: if it's unusable
+
+        The entry's tiles are read straight from the file, so it must
+        be stored uncompressed.
+
+        """
+        with self._lock:
+            if self._entries is not None:
+                raise IOError("%r is closed" % (self,))
+            zinfo = self._zipfile.getinfo(src)
+            if zinfo.compress_type != zipfile.ZIP_STORED:
+                raise lib.tileindex.InvalidTileIndex("entry is compressed")
+            self._fp.seek(zinfo.header_offset)
+            header = self._fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader:
+            raise lib.tileindex.InvalidTileIndex("truncated")
+        header = struct.unpack(zipfile.structFileHeader, header)
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise lib.tileindex.InvalidTileIndex("bad local file header")
+        base = (zinfo.header_offset + zipfile.sizeFileHeader +
+                header[zipfile._FH_FILENAME_LENGTH] +
+                header[zipfile._FH_EXTRA_FIELD_LENGTH])
+        index = lib.tileindex.TileIndex(
+            self._fp,
+            base = base,
+            size = zinfo.file_size,
+            lock = self._lock,
+            name = src,
+        )
+        self._indexes.add(index)
+        return index
+
+
+class _LazyOraPNG (lib.tiledsurface.LazyTileSource):
+    """A PNG entry in an OpenRaster file, decoded when first needed
+
+    Single tiles can be looked up after decoding only as far down as
+    their row, but anything else needing the tiles decodes the rest.
+
+    """
+
+    def __init__(self, archive, src, x, y, w, h):
+        super(_LazyOraPNG, self).__init__(x, y, w, h)
+        self._archive = archive
+        self._src = src
+
+    def __repr__(self):
+        return "<_LazyOraPNG %r %r>" % (self._src, self.frame)
+
+    @property
+    def src(self):
+        """Name of the PNG entry"""
+        return self._src
+
+    @property
+    def decoded(self):
+        """Whether all the tiles have been decoded"""
+        return self._tiledict is not None
+
+    def _load(self):
+        # The PNG data is read under the archive's lock, but decoded
+        # outside it, so that several can be decoded at once.
+        fp = StringIO(self._archive.read(self._src))
+        x, y = self.frame[0:2]
+        return _load_png_tiles(fp, x, y)
+
+    def _get_row_decoder(self):
+        archive = self._archive
+        src = self._src
+        x, y = self.frame[0:2]
+
+        def _decode(row_cb):
+            fp = StringIO(archive.read(src))
+            return _load_png_tiles(fp, x, y, row_cb=row_cb)
+
+        return _decode
+
+
+## Helpers
+
+#: PNG signature, then the start of the IHDR chunk.
+_PNG_HEADER_FORMAT = ">8s4x4sII4xB"
+_PNG_HEADER_SIZE = struct.calcsize(_PNG_HEADER_FORMAT)
+_PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+
+def _open_member(orazip, src):
+    """Open a zipfile entry, tolerating badly encoded names"""
+    try:
+        return orazip.open(src, "r")
+    except KeyError:
+        # Support for bad zip files (saved by old versions of the
+        # GIMP ORA plugin)
+        fp = orazip.open(src.encode("utf-8"), "r")
+        logger.warning('Bad ZIP file. There is an utf-8 encoded '
+                       'filename that does not have the utf-8 '
+                       'flag set: %r', src)
+        return fp
+
+
+def _load_png_tiles(fp, x, y, feedback_cb=None, row_cb=None):
+    """Decode a PNG into tiles, returning a snapshot (any thread)"""
+    # No colour management, to match the GdkPixbuf loader used for
+    # other entries.
+    sshot, frame_size = lib.tiledsurface.load_png_tiles(
+        fp, x, y,
+        feedback_cb = feedback_cb,
+        convert_to_srgb = False,
+        row_cb = row_cb,
+    )
+    return sshot
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
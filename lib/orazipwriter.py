@@ -0,0 +1,394 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by Andrew Chadwick <a.t.chadwick@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Ordered writing of OpenRaster zipfile entries, with parallel encoding
+
+When saving, the layers tree writes its entries through an
+`OraZipWriter` rather than directly into the zipfile. PNG entries can
+then be encoded by a `lib.workerpool.WorkerPool` while the rest of the
+tree is being saved, yet the archive always ends up with its members
+in the same order as a serial save would produce.
+
+PNG data is encoded into a spooled buffer, and copied from there
+straight into the zipfile. Only very large PNGs touch the disk before
+being archived.
+
+    >>> import zipfile, tempfile, shutil
+    >>> import lib.workerpool
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> z = zipfile.ZipFile(os.path.join(tmpdir, "t.zip"), "w")
+    >>> pool = lib.workerpool.WorkerPool(2)
+    >>> w = OraZipWriter(z, pool=pool)
+    >>> w.writestr("mimetype", "image/openraster")
+    >>> def slow_write(fp, content):
+    ...     time.sleep(0.1)
+    ...     fp.write(content)
+    >>> w.write_png("data/a.png", slow_write, "A")
+    >>> w.write_png("data/b.png", slow_write, "B")
+    >>> w.writestr("stack.xml", "<image/>")
+    >>> w.flush()
+    >>> z.namelist()
+    ['mimetype', 'data/a.png', 'data/b.png', 'stack.xml']
+    >>> z.read("data/b.png")
+    'B'
+    >>> z.close()
+    >>> pool.shutdown()
+    >>> sorted(os.listdir(tmpdir))
+    ['t.zip']
+    >>> z = zipfile.ZipFile(os.path.join(tmpdir, "t.zip"), "r")
+    >>> z.testzip() is None
+    True
+
+Entries can be recorded when they're written, along with some state
+describing what they hold. When saving over that file again, entries
+whose recorded state is still current can be copied across from it
+raw instead of being encoded again.
+
+    >>> record = OraSaveRecord()
+    >>> record.add("a-key", "data/a.png", "A-state")
+    >>> z2 = zipfile.ZipFile(os.path.join(tmpdir, "t2.zip"), "w")
+    >>> w = OraZipWriter(z2, previous=z, previous_record=record)
+    >>> w.copy_unchanged("data/a2.png", "a-key", lambda s: s == "B-state")
+    >>> w.copy_unchanged("data/a2.png", "a-key", lambda s: s == "A-state")
+    'A-state'
+    >>> w.flush()
+    >>> z2.read("data/a2.png")
+    'A'
+    >>> w.record.get("a-key")
+    ('data/a2.png', 'A-state')
+    >>> z.close(); z2.close()
+    >>> shutil.rmtree(tmpdir)
+
+"""
+
+
+## Imports
+
+import os
+import time
+import tempfile
+import zlib
+import logging
+logger = logging.getLogger(__name__)
+
+import lib.helpers
+import lib.tileindex
+
+
+## Class defs
+
+
+class OraZipWriter (object):
+    """Wraps a ZipFile, keeping entry order for parallel PNG encoding
+
+    This supports the parts of the `zipfile.ZipFile` interface which
+    the layer saving code uses, namely `write()` and `writestr()`, so
+    it can be passed to layers' ``save_to_openraster()`` methods in
+    place of the zipfile itself.
+
+    """
+
+    #: How often to call the feedback callback while waiting, in seconds
+    FEEDBACK_INTERVAL = 0.1
+
+    #: PNG buffers bigger than this are spooled out to an anonymous
+    #: tempfile rather than kept in memory.
+    MAX_MEMORY_BYTES = 32 * 1024 * 1024
+
+    def __init__(self, orazip, pool=None, feedback_cb=None,
+                 previous=None, previous_record=None, record=None,
+                 tile_index=False):
+        """Initialize
+
+        :param zipfile.ZipFile orazip: zipfile open for writing
+        :param lib.workerpool.WorkerPool pool: for encoding PNGs
+        :param callable feedback_cb: called every so often while
+            waiting for PNGs to be encoded in the pool.
+        :param zipfile.ZipFile previous: earlier version of the file,
+            open for reading, to copy unchanged entries from
+        :param OraSaveRecord previous_record: what's in `previous`
+        :param OraSaveRecord record: receives what gets written
+        :param bool tile_index: layers should write tile index entries
+            alongside their PNGs (see `lib.tileindex`)
+
+        If `pool` is None, PNGs are encoded immediately.
+
+        """
+        super(OraZipWriter, self).__init__()
+        self._orazip = orazip
+        self._previous = previous
+        self._previous_record = previous_record
+        if record is None:
+            record = OraSaveRecord()
+        self.record = record
+        self._pool = pool
+        self._feedback_cb = feedback_cb
+        self.tile_index = tile_index
+        self._pending = []  # [(job_or_None, write_func, args)]
+
+    @property
+    def zipfile(self):
+        """The underlying zipfile"""
+        return self._orazip
+
+    ## ZipFile-like interface
+
+    def write(self, filename, arcname):
+        """Archive a file which exists now
+
+        Pending entries are written first, so the file only needs to
+        exist for the duration of the call.
+
+        """
+        self.flush()
+        self._orazip.write(filename, arcname)
+
+    def writestr(self, zinfo_or_arcname, data):
+        """Archive a string, after any pending entries"""
+        self._append(None, self._orazip.writestr, zinfo_or_arcname, data)
+
+    ## PNG encoding
+
+    def write_png(self, arcname, save_func, *args, **kwargs):
+        """Archive a PNG file, encoded in the background
+
+        :param unicode arcname: name of the entry in the zipfile
+        :param callable save_func: called as
+            ``save_func(fp, *args, **kwargs)``
+            to write the PNG data to be archived to a file-like `fp`.
+
+        The save function may run in a worker thread, so it must only
+        read data which won't change until the next `flush()`. Any
+        ``feedback_cb`` keyword arg is removed in that case, because
+        feedback callbacks typically update the UI. The writer's own
+        feedback callback is used while waiting instead.
+
+        """
+        buf = _MemberBuffer(self.MAX_MEMORY_BYTES)
+        if self._pool is None:
+            save_func(buf, *args, **kwargs)
+            job = None
+        else:
+            kwargs.pop("feedback_cb", None)
+            job = self._pool.submit(save_func, buf, *args, **kwargs)
+        self._append(job, self._write_buffer, buf, arcname)
+
+    ## Tile indexes
+
+    def write_tile_index(self, arcname, png_arcname, tiledict, origin):
+        """Archive a tile index of a layer, encoded in the background
+
+        :param unicode arcname: name of the entry in the zipfile
+        :param unicode png_arcname: the layer's PNG entry, which must
+            be written before this one
+        :param tiledict: the layer's tiles, which must not be written
+            to until the next `flush()` (use a snapshot's)
+        :param tuple origin: (x, y) of the top left of the PNG
+
+        The index records the CRC-32 of the PNG entry, so that loaders
+        can tell if the PNG was changed by another program afterwards.
+
+        """
+        buf = _MemberBuffer(self.MAX_MEMORY_BYTES)
+        writer = lib.tileindex.TileIndexWriter(buf, origin)
+        if self._pool is None:
+            writer.write_tiles(tiledict)
+            job = None
+        else:
+            job = self._pool.submit(writer.write_tiles, tiledict)
+        self._append(job, self._write_tile_index, buf, arcname,
+                     writer, png_arcname)
+
+    def _write_tile_index(self, buf, arcname, writer, png_arcname):
+        try:
+            png_crc = self._orazip.getinfo(png_arcname).CRC
+            writer.finish(png_crc)
+        except:
+            buf.close()
+            raise
+        self._write_buffer(buf, arcname)
+
+    ## Reuse of unchanged entries
+
+    def copy_unchanged(self, arcname, key, is_unchanged):
+        """Archive an entry copied raw from the previous file, if valid
+
+        :param unicode arcname: name of the entry in the zipfile
+        :param key: what the entry was recorded as, last time
+        :param callable is_unchanged: called as
+            ``is_unchanged(state)`` with the state recorded for `key`;
+            should return true if that's still accurate.
+        :returns: the state recorded for `key`, if the entry was copied
+            (and recorded again), otherwise None
+
+        """
+        if self._previous is None or self._previous_record is None:
+            return None
+        entry = self._previous_record.get(key)
+        if entry is None:
+            return None
+        prev_arcname, state = entry
+        if not is_unchanged(state):
+            return None
+        try:
+            zinfo = self._previous.getinfo(prev_arcname)
+        except KeyError:
+            return None
+        self._append(None, lib.helpers.zipfile_copy_raw,
+                     self._orazip, arcname, self._previous, zinfo)
+        self.record.add(key, arcname, state)
+        return state
+
+    def _write_buffer(self, buf, arcname):
+        try:
+            buf.seek(0)
+            lib.helpers.zipfile_write_stream(
+                self._orazip, arcname, buf,
+                size = buf.size,
+                crc = buf.crc,
+            )
+        finally:
+            buf.close()
+
+    ## Ordering
+
+    def _append(self, job, write_func, *args):
+        self._pending.append((job, write_func, args))
+        self._write_finished()
+
+    def _write_finished(self):
+        """Write out leading entries whose data is ready"""
+        pending = self._pending
+        while pending:
+            job, write_func, args = pending[0]
+            if job is not None and not job.done():
+                break
+            pending.pop(0)
+            if job is not None:
+                job.wait()  # re-raises errors
+            write_func(*args)
+
+    def flush(self):
+        """Wait for all pending entries, and write them out"""
+        pending = self._pending
+        try:
+            while pending:
+                job, write_func, args = pending.pop(0)
+                if job is not None:
+                    self._join(job)
+                    job.wait()
+                write_func(*args)
+        finally:
+            self._discard()
+
+    def _join(self, job):
+        """Wait for a job to finish, giving feedback while waiting"""
+        if self._feedback_cb is None:
+            return
+        while not job.join(self.FEEDBACK_INTERVAL):
+            self._feedback_cb()
+
+    def _discard(self):
+        """Clean up after an error (buffers and all)"""
+        while self._pending:
+            job, write_func, args = self._pending.pop(0)
+            if job is None:
+                continue
+            try:
+                job.wait()
+            except Exception:
+                pass
+            if write_func in (self._write_buffer, self._write_tile_index):
+                buf = args[0]
+                buf.close()
+
+
+class OraSaveRecord (object):
+    """Notes about what the entries of an OpenRaster file contain
+
+    Entries are recorded by a key which stays the same from one save to
+    the next, like a layer's ``autosave_uuid``, along with some state
+    which can later be checked for currency. The state should be
+    cheap to keep around and to check, e.g. a copy-on-write snapshot.
+
+    """
+
+    def __init__(self):
+        super(OraSaveRecord, self).__init__()
+        self._entries = {}  # {key: (arcname, state)}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, arcname, state):
+        """Record the entry `arcname` as holding `state`"""
+        self._entries[key] = (arcname, state)
+
+    def get(self, key):
+        """Returns (arcname, state) for a key, or None"""
+        return self._entries.get(key)
+
+
+class _MemberBuffer (object):
+    """Spooled buffer for the data of one zipfile entry
+
+    Data is kept in memory up to a size limit, then in an anonymous
+    tempfile. The size and CRC-32 needed for the entry's header are
+    calculated as the data is written.
+
+    >>> buf = _MemberBuffer(4)
+    >>> buf.write("abc")
+    >>> buf.write("defg")
+    >>> buf.size, buf.crc == zlib.crc32("abcdefg") & 0xffffffff
+    (7, True)
+    >>> buf.seek(0)
+    >>> buf.read()
+    'abcdefg'
+    >>> buf.close()
+
+    """
+
+    def __init__(self, max_memory):
+        super(_MemberBuffer, self).__init__()
+        self._fp = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self.size = 0
+        self._crc = 0
+
+    @property
+    def crc(self):
+        """CRC-32 of the data written so far, as an unsigned int"""
+        return self._crc & 0xffffffff
+
+    def write(self, data):
+        self._fp.write(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self.size += len(data)
+
+    def seek(self, pos):
+        self._fp.seek(pos)
+
+    def read(self, size=-1):
+        return self._fp.read(size)
+
+    def close(self):
+        self._fp.close()
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -55,31 +55,54 @@ def save(pixbuf, filename, type='png', **kwargs):
 
     """
     with open(filename, 'wb') as fp:
-        writer = lambda buf, size, data: fp.write(buf) or True
-        try:
-            save_to_callbackv = pixbuf.save_to_callbackv
-        except AttributeError:
-            # save_to_callbackv disappeared in GdkPixbuf 2.31.2
-            # and returned as of GdkPixbuf 2.31.5
-            # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
-            save_to_callbackv = pixbuf.save_to_callback
-        # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
-        # a.k.a. precise, a.k.a. "what Travis-CI runs")
-        result = save_to_callbackv(
-            writer,  # save_func
-            fp,      # user_data
-            type,      # type
-            kwargs.keys(),   # option_keys
-            kwargs.values(),  # option_values
-        )
-        return result
-
-
-def load_from_file(filename, feedback_cb=None):
+        return save_to_stream(pixbuf, fp, type, **kwargs)
+
+
+def save_to_stream(pixbuf, fp, type='png', **kwargs):
+    """Save pixbuf to an open file-like object
+
+    :param GdkPixbuf.Pixbuf pixbuf: the pixbuf to save
+    :param fp: file-like object opened for writing
+    :param str type: type to save as: 'jpeg'/'png'/...
+    :param \*\*kwargs: passed through to GdkPixbuf
+    :rtype: bool
+    :returns: whether the data was saved fully
+
+    >>> import StringIO
+    >>> p = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,True,8,64,64)
+    >>> fp = StringIO.StringIO()
+    >>> save_to_stream(p, fp, type="png")
+    True
+    >>> fp.getvalue().startswith("\x89PNG")
+    True
+
+    """
+    writer = lambda buf, size, data: fp.write(buf) or True
+    try:
+        save_to_callbackv = pixbuf.save_to_callbackv
+    except AttributeError:
+        # save_to_callbackv disappeared in GdkPixbuf 2.31.2
+        # and returned as of GdkPixbuf 2.31.5
+        # https://bugzilla.gnome.org/show_bug.cgi?id=670372#c12
+        save_to_callbackv = pixbuf.save_to_callback
+    # Keyword args are not compatible with 2.26 (Ubuntu 12.04,
+    # a.k.a. precise, a.k.a. "what Travis-CI runs")
+    result = save_to_callbackv(
+        writer,  # save_func
+        fp,      # user_data
+        type,      # type
+        kwargs.keys(),   # option_keys
+        kwargs.values(),  # option_values
+    )
+    return result
+
+
+def load_from_file(filename, feedback_cb=None, max_size=None):
     """Load a pixbuf from a named file
 
     :param unicode filename: name of the file to open and read
     :param callable feedback_cb: invoked to provide feedback to the user
+    :param tuple max_size: shrink to fit this (width, height) box
     :rtype: GdkPixbuf.Pixbuf
     :returns: the loaded pixbuf
 
@@ -88,14 +111,15 @@ def load_from_file(filename, feedback_cb=None):
 
     """
     with open(filename, 'rb') as fp:
-        return load_from_stream(fp, feedback_cb)
+        return load_from_stream(fp, feedback_cb, max_size=max_size)
 
 
-def load_from_stream(fp, feedback_cb=None):
+def load_from_stream(fp, feedback_cb=None, max_size=None):
     """Load a pixbuf from an open file-like object
 
     :param fp: file-like object opened for reading
     :param callable feedback_cb: invoked to provide feedback to the user
+    :param tuple max_size: shrink to fit this (width, height) box
     :rtype: GdkPixbuf.Pixbuf
     :returns: the loaded pixbuf
 
@@ -103,8 +127,19 @@ def load_from_stream(fp, feedback_cb=None):
     >>> load_from_stream(fp)   # doctest: +ELLIPSIS
     <Pixbuf...>
 
+    If a maximum size is given, large images are scaled down
+    proportionally while they are decoded, which is cheaper than
+    loading the full image and then scaling it.
+
+    >>> fp = open("pixmaps/mypaint_logo.png", "rb")
+    >>> p = load_from_stream(fp, max_size=(16, 16))
+    >>> max(p.get_width(), p.get_height())
+    16
+
     """
     loader = GdkPixbuf.PixbufLoader()
+    if max_size is not None:
+        loader.connect("size-prepared", _shrink_to_fit_cb, max_size)
     while True:
         if feedback_cb is not None:
             feedback_cb()
@@ -116,6 +151,15 @@ def load_from_stream(fp, feedback_cb=None):
     return loader.get_pixbuf()
 
 
+def _shrink_to_fit_cb(loader, w, h, max_size):
+    """Loader "size-prepared" callback: shrink proportionally to fit"""
+    max_w, max_h = max_size
+    if w <= max_w and h <= max_h:
+        return
+    scale = min(float(max_w) / w, float(max_h) / h)
+    loader.set_size(max(1, int(w * scale)), max(1, int(h * scale)))
+
+
 def load_from_zipfile(datazip, filename, feedback_cb=None):
     """Extract and return a pixbuf from a zipfile entry
 
@@ -549,6 +549,10 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
   uint16_t * b_p  = (uint16_t*)PyArray_DATA(b);
   uint8_t * res_p = (uint8_t*)PyArray_DATA(res);
 
+  // Strokemap diffs are worked out in worker threads (lib.strokemap),
+  // and nothing below touches Python objects.
+  Py_BEGIN_ALLOW_THREADS
+
   for (int y=0; y<MYPAINT_TILE_SIZE; y++) {
     for (int x=0; x<MYPAINT_TILE_SIZE; x++) {
 
@@ -593,6 +597,8 @@ void tile_perceptual_change_strokemap(PyObject * a_obj, PyObject * b_obj, PyObje
       res_p += 1;
     }
   }
+
+  Py_END_ALLOW_THREADS
 }
 
 
@@ -56,4 +56,35 @@ public:
     return res;
   }
 
+  // Replay a whole array of recorded events in one call. The array
+  // must be a C-contiguous float64 one of shape (N, 6), with columns
+  // (dtime, x, y, pressure, xtilt, ytilt). Returns the number of
+  // events replayed as a Python int. If an exception happens in the
+  // surface code, replay stops and NULL is returned so that it gets
+  // raised in the caller.
+  PyObject * stroke_to_array (Surface * surface, PyObject * obj)
+  {
+    if (!PyArray_Check(obj)) {
+      PyErr_SetString(PyExc_TypeError, "events must be a numpy array");
+      return NULL;
+    }
+    PyArrayObject* data = (PyArrayObject*)obj;
+    if (PyArray_NDIM(data) != 2 || PyArray_DIM(data, 1) != 6
+        || !PyArray_ISCARRAY(data) || PyArray_TYPE(data) != NPY_FLOAT64) {
+      PyErr_SetString(PyExc_ValueError,
+                      "events must be a C-contiguous float64 array "
+                      "of shape (N, 6)");
+      return NULL;
+    }
+    const npy_intp n = PyArray_DIM(data, 0);
+    const npy_float64 * e = (npy_float64*)PyArray_DATA(data);
+    for (npy_intp i=0; i<n; i++, e+=6) {
+      Brush::stroke_to (surface, e[1], e[2], e[3], e[4], e[5], e[0]);
+      if (PyErr_Occurred()) {
+        return NULL;
+      }
+    }
+    return PyInt_FromSsize_t(n);
+  }
+
 };
@@ -6,6 +6,9 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import struct
+import zlib
+
 import brush
 import numpy
 
@@ -23,6 +26,9 @@ class Stroke (object):
 
     _SERIAL_NUMBER = 0
 
+    #: Initial number of events which can be recorded without growing
+    _INITIAL_CAPACITY = 256
+
     def __init__(self):
         """Initialize"""
         super(Stroke, self).__init__()
@@ -44,28 +50,29 @@ class Stroke (object):
         self.brush = brush
         self.brush.new_stroke()  # resets the stroke_* members of the brush
 
-        self.tmp_event_list = []
+        # Events are recorded straight into an array, which doubles in
+        # size whenever it fills up.
+        self._events = numpy.empty((self._INITIAL_CAPACITY, 6), 'float64')
+        self._num_events = 0
 
     def record_event(self, dtime, x, y, pressure, xtilt, ytilt):
         assert not self.finished
-        self.tmp_event_list.append((dtime, x, y, pressure, xtilt, ytilt))
+        n = self._num_events
+        if n == len(self._events):
+            events = numpy.empty((2*n, 6), 'float64')
+            events[:n] = self._events
+            self._events = events
+        self._events[n] = (dtime, x, y, pressure, xtilt, ytilt)
+        self._num_events = n + 1
 
     def stop_recording(self):
         if self.finished:
             return
-        # OPTIMIZE
-        # - for space: just gzip? use integer datatypes?
-        # - for time: maybe already use array storage while recording?
-        data = numpy.array(self.tmp_event_list, dtype='float64')
-        data = data.tostring()
-        version = '2'
-        self.stroke_data = version + data
+        data = self._events[:self._num_events]
+        self.stroke_data = _encode_events(data)
 
         self.total_painting_time = self.brush.get_total_stroke_painting_time()
-        #if not self.empty:
-        #    print 'Recorded', len(self.stroke_data), 'bytes. (painting time: %.2fs)' % self.total_painting_time
-        #print 'Compressed size:', len(zlib.compress(self.stroke_data)), 'bytes.'
-        del self.brush, self.tmp_event_list
+        del self.brush, self._events, self._num_events
         self.finished = True
 
     def is_empty(self):
@@ -76,8 +83,10 @@ class Stroke (object):
     def render(self, surface):
         assert self.finished
 
-        # OPTIMIZE: check if parsing of settings is a performance bottleneck
-        b = brush.Brush(brush.BrushInfo(self.brush_settings))
+        # Strokes are often replayed with the same settings, e.g. when
+        # redoing, so the parsed settings are cached.
+        bi = brush.get_cached_brushinfo(self.brush_settings)
+        b = brush.Brush(bi, observe=False)
 
         states = numpy.fromstring(self.brush_state, dtype='float32')
         b.set_states_from_array(states)
@@ -85,15 +94,18 @@ class Stroke (object):
         #b.set_print_inputs(1)
         #print 'replaying', len(self.stroke_data), 'bytes'
 
-        version, data = self.stroke_data[0], self.stroke_data[1:]
-        assert version == '2'
-        data = numpy.fromstring(data, dtype='float64')
-        data.shape = (len(data)/6, 6)
+        data = _decode_events(self.stroke_data)
 
         surface.begin_atomic()
-        for dtime, x, y, pressure, xtilt, ytilt in data:
-            b.stroke_to(surface.backend, x, y, pressure, xtilt, ytilt, dtime)
-        surface.end_atomic()
+        try:
+            painted = b.stroke_to_array(surface.backend, data)
+        finally:
+            surface.end_atomic()
+        if painted != len(data):
+            raise RuntimeError(
+                "Stroke replay painted only %d of %d events"
+                % (painted, len(data)),
+            )
 
     def copy_using_different_brush(self, brushinfo):
         assert self.finished
@@ -107,3 +119,94 @@ class Stroke (object):
         # has different meanings for the states. This should cause
         # fewer glitches than resetting the initial state to zero.
         return clone
+
+
+## Event data storage
+
+#: Fixed-point scale factors for format "3", one per event column:
+#: dtime (microseconds), x and y (1/64 pixel), pressure, xtilt, ytilt.
+_FORMAT3_SCALES = numpy.array([1e6, 64.0, 64.0, 65536.0, 4096.0, 4096.0])
+
+#: Format "3" header: number of events, and the dtype of each column.
+_FORMAT3_HEADER = "<I6s"
+_FORMAT3_HEADER_SIZE = struct.calcsize(_FORMAT3_HEADER)
+
+#: Integer types for format "3" columns, by struct-style code
+_FORMAT3_DTYPES = {"b": "<i1", "h": "<i2", "i": "<i4", "q": "<i8"}
+
+#: Biggest magnitude allowed for fixed-point values in format "3"
+_FORMAT3_MAX_VALUE = 2**52
+
+
+def _encode_events(data):
+    """Encodes an (N, 6) float64 array of events as stroke data
+
+    Stroke data starts with a version byte. Format "2" is the raw
+    float64 array. Format "3" is a compact one: each column is turned
+    into fixed point, then stored as differences between successive
+    values using the smallest integer type which fits them, and all
+    that is zlib-compressed. Positions are kept to 1/64 pixel, and
+    pressure and tilt to better than the float precision of most
+    tablets, which is plenty for replaying strokes with a different
+    brush. Events which can't be stored that way are stored using
+    format "2" instead.
+
+    >>> data = numpy.array([(0.0, 10.0, 20.0, 0.5, 0.0, 0.0),
+    ...                     (0.008, 10.5, 20.25, 0.51, 0.1, -0.1),
+    ...                     (0.016, 11.0, 20.5, 0.52, 0.2, -0.2)])
+    >>> stroke_data = _encode_events(data)
+    >>> stroke_data[0]
+    '3'
+    >>> abs(_decode_events(stroke_data) - data).max() < 1e-3
+    True
+    >>> _encode_events(numpy.array([(0, numpy.nan, 0, 0, 0, 0)]))[0]
+    '2'
+
+    """
+    data = numpy.asarray(data, dtype='float64')
+    if data.ndim != 2 or data.shape[1] != 6:
+        raise ValueError("events must have shape (N, 6)")
+    fixed = numpy.round(data * _FORMAT3_SCALES)
+    if not numpy.isfinite(fixed).all():
+        return '2' + data.tostring()
+    if len(fixed) and abs(fixed).max() > _FORMAT3_MAX_VALUE:
+        return '2' + data.tostring()
+    fixed = fixed.astype('int64')
+    deltas = numpy.diff(fixed, axis=0)
+    columns = []
+    codes = []
+    for i in xrange(6):
+        col = numpy.concatenate((fixed[:1, i], deltas[:, i]))
+        code = "q"
+        if len(col):
+            lo, hi = col.min(), col.max()
+            for code in "bhiq":
+                info = numpy.iinfo(_FORMAT3_DTYPES[code])
+                if info.min <= lo and hi <= info.max:
+                    break
+        columns.append(col.astype(_FORMAT3_DTYPES[code]).tostring())
+        codes.append(code)
+    header = struct.pack(_FORMAT3_HEADER, len(data), "".join(codes))
+    return '3' + header + zlib.compress("".join(columns))
+
+
+def _decode_events(stroke_data):
+    """Decodes stroke data into an (N, 6) float64 array of events"""
+    version, data = stroke_data[0], stroke_data[1:]
+    if version == '2':
+        data = numpy.fromstring(data, dtype='float64')
+        data.shape = (len(data)/6, 6)
+        return data
+    elif version == '3':
+        n, codes = struct.unpack_from(_FORMAT3_HEADER, data)
+        body = zlib.decompress(data[_FORMAT3_HEADER_SIZE:])
+        events = numpy.empty((n, 6), 'float64')
+        offset = 0
+        for i, code in enumerate(codes):
+            dtype = numpy.dtype(_FORMAT3_DTYPES[code])
+            col = numpy.frombuffer(body, dtype, n, offset)
+            offset += n * dtype.itemsize
+            events[:, i] = numpy.cumsum(col, dtype='int64')
+        events /= _FORMAT3_SCALES
+        return events
+    raise ValueError("unknown stroke data version %r" % (version,))
@@ -14,6 +14,7 @@ import struct
 import zlib
 import numpy
 import math
+import collections
 from logging import getLogger
 logger = getLogger(__name__)
 
@@ -21,9 +22,24 @@ import mypaintlib
 
 import tiledsurface
 import idletask
+import lib.cache
+import lib.workerpool
 
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 
+#: Number of threads working out the shapes of new strokes.
+DIFF_WORKERS = 2
+
+#: Tiles diffed per worker job. Hit-tests wait only for the jobs
+#: covering the tiles they need.
+_DIFF_CHUNK_SIZE = 16
+
+_diff_pool = None
+
+#: How many of the most recently used tiles' bitmaps to keep unpacked
+#: from their compressed form. The same cache is used for all shapes.
+_BITS_CACHE_SIZE = 512
+
 
 ## Class defs
 
@@ -35,44 +51,59 @@ class StrokeShape (object):
     tile (for fast lookup).
 
     """
+
+    #: Incremented whenever the tiles of any existing shape change,
+    #: so that a StrokeIndex can tell when it's out of date.
+    tiles_changed_serial = 0
+
     def __init__(self):
         """Construct a new, blank StrokeShape."""
         object.__init__(self)
         self.tasks = idletask.Processor()
         self.strokemap = {}
         self.brush_string = None
+        #: Tiles the shape may touch, including ones still being worked
+        #: out by queued tasks. Reading this never forces those tasks.
+        self.tile_keys = set()
+
+    @classmethod
+    def _tiles_changed(cls):
+        StrokeShape.tiles_changed_serial += 1
 
     @classmethod
-    def new_from_snapshots(cls, before, after):
+    def new_from_snapshots(cls, before, after, candidates=None):
         """Build a new StrokeShape from before+after pair of snapshots.
 
         :param before: snapshot of the layer before the stroke
         :type before: lib.tiledsurface._TiledSurfaceSnapshot
         :param after: snapshot of the layer after the stroke
         :type after: lib.tiledsurface._TiledSurfaceSnapshot
+        :param list candidates: tiles which may have changed, if known.
+            See lib.tiledsurface.MyPaintSurface.changed_tiles_since().
         :returns: A new StrokeShape, or None.
 
         If the snapshots haven't changed, None is returned. In this
         case, no StrokeShape should be recorded.
 
         """
-        before_dict = before.tiledict
-        after_dict = after.tiledict
-        before_tiles = set(before_dict.iteritems())
-        after_tiles = set(after_dict.iteritems())
-        changed_idxs = set(
-            pos for pos, data
-            in before_tiles.symmetric_difference(after_tiles)
-        )
+        if candidates is None:
+            changed_idxs = before.tiledict.get_changed_keys(after.tiledict)
+        else:
+            changed_idxs = [
+                pos for pos in candidates
+                if before.tiledict.get(pos) is not after.tiledict.get(pos)
+            ]
         if not changed_idxs:
             return None
         shape = cls()
         assert not shape.strokemap
+        shape.tile_keys = set(changed_idxs)
         shape.tasks.add_work(_TileDiffUpdateTask(
             before.tiledict,
             after.tiledict,
             changed_idxs,
             shape.strokemap,
+            pool = _get_diff_pool(),
         ))
         return shape
 
@@ -94,6 +125,7 @@ class StrokeShape (object):
             tile = _Tile.new_from_compressed_bitmap(compressed_bitmap)
             self.strokemap[tx + translate_x, ty + translate_y] = tile
             data = data[size+3*4:]
+        self.tile_keys = set(self.strokemap)
 
     def save_to_string(self, translate_x, translate_y):
         """Return a compressed string representing the stroke shape.
@@ -158,8 +190,7 @@ class StrokeShape (object):
         self._complete_tile_tasks(pred)
         tile = self.strokemap.get(pixel_ti)
         if tile:
-            array = tile.to_array()
-            return bool(array[y % N, x % N])
+            return tile.get_pixel(x % N, y % N)
         return False
 
     def render_to_surface(self, surf, bbox=None, center=None):
@@ -188,13 +219,21 @@ class StrokeShape (object):
             if not pred((tx, ty)):
                 continue
             diff_tile = self.strokemap[(tx, ty)]
-            diff_arr = diff_tile.to_array()
             with surf.tile_request(tx, ty, readonly=False) as surf_arr:
                 diff_tile.write_to_surface_tile_array(surf_arr)
 
     def translate(self, dx, dy):
         """Translate the shape by (dx, dy)"""
         self.tasks.finish_all()
+        slices_x = tiledsurface.calc_translation_slices(int(dx))
+        slices_y = tiledsurface.calc_translation_slices(int(dy))
+        self.tile_keys = set(
+            (tx + tdx, ty + tdy)
+            for (tx, ty) in self.strokemap
+            for (src_x, (tdx, x0, x1)) in slices_x
+            for (src_y, (tdy, y0, y1)) in slices_y
+        )
+        self._tiles_changed()
         tmp = {}
         self.tasks.add_work(_TileTranslateTask(self.strokemap, tmp, dx, dy))
         self.tasks.add_work(_TileRecompressTask(tmp, self.strokemap))
@@ -215,61 +254,169 @@ class StrokeShape (object):
         for tx, ty in list(self.strokemap.keys()):
             if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
                 self.strokemap.pop((tx, ty))
+        self.tile_keys = set(self.strokemap)
+        self._tiles_changed()
         return bool(self.strokemap)
 
 
+class StrokeIndex (object):
+    """Index of the stroke shapes which may touch each tile
+
+    This speeds up finding the topmost shape at a point in a layer's
+    stack of shapes, by only testing the shapes which may touch the
+    tile containing it.
+
+    >>> def make_shape(*tile_keys):
+    ...     shape = StrokeShape()
+    ...     shape.init_from_string("".join(
+    ...         struct.pack(">iiI", tx, ty, 0)
+    ...         for (tx, ty) in tile_keys
+    ...     ), 0, 0)
+    ...     return shape
+    >>> a = make_shape((0, 0), (1, 0))
+    >>> b = make_shape((1, 0))
+    >>> strokes = [a, b]
+    >>> index = StrokeIndex()
+    >>> index.get_shapes_at(strokes, N+1, 1) == [b, a]
+    True
+    >>> index.get_shapes_at(strokes, 1, 1) == [a]
+    True
+
+    The index keeps track of the list it was last used with. Shapes
+    appended to it are added to the index as they are. If the list is
+    changed in any other way, or if any shape's tiles change, the
+    index is rebuilt from scratch.
+
+    >>> c = make_shape((0, 0))
+    >>> strokes.append(c)
+    >>> index.get_shapes_at(strokes, 1, 1) == [c, a]
+    True
+    >>> b.translate(-N, 0)
+    >>> index.get_shapes_at(strokes, 1, 1) == [c, b, a]
+    True
+
+    """
+
+    def __init__(self):
+        super(StrokeIndex, self).__init__()
+        self._strokes = []  # copy of the list indexed
+        self._serial = StrokeShape.tiles_changed_serial
+        self._tiles = {}  # {(tx, ty): [shape, ...]}, in stack order
+
+    def get_shapes_at(self, strokes, x, y):
+        """Returns the shapes which may touch a pixel, topmost first
+
+        :param list strokes: the stack of StrokeShapes, bottom first
+        :param int x: Pixel X position.
+        :param int y: Pixel Y position.
+        :rtype: list
+
+        """
+        self._update(strokes)
+        shapes = self._tiles.get((int(x)/N, int(y)/N))
+        if not shapes:
+            return []
+        return shapes[::-1]
+
+    def _update(self, strokes):
+        """Bring the index up to date with a list of shapes"""
+        n = len(self._strokes)
+        is_current = (self._serial == StrokeShape.tiles_changed_serial)
+        if is_current and len(strokes) >= n and strokes[:n] == self._strokes:
+            if len(strokes) == n:
+                return
+            new_strokes = strokes[n:]
+        else:
+            self._tiles = {}
+            self._strokes = []
+            self._serial = StrokeShape.tiles_changed_serial
+            new_strokes = strokes
+        tiles = self._tiles
+        for shape in new_strokes:
+            for ti in shape.tile_keys:
+                tiles.setdefault(ti, []).append(shape)
+        self._strokes.extend(new_strokes)
+
+
 class _TileDiffUpdateTask:
     """Idle task: update strokemap with tile & pixel diffs of snapshots.
 
-    This task is used during initialization of the StrokeShape.
+    This task is used during initialization of the StrokeShape. The
+    diffs are worked out in chunks by a pool of worker threads, if one
+    is given: snapshot tiles are never modified, so this is safe. The
+    task itself just collects the results in the main thread.
 
     """
 
-    def __init__(self, before, after, changed_idxs, targ):
+    def __init__(self, before, after, changed_idxs, targ, pool=None):
         """Initialize, ready to update a target StrokeShape with diffs
 
         :param dict before: Complete pre-stroke tiledict (RO, {xy:Tile})
         :param dict after: Complete post-stroke tiledict (RO, {xy:Tile})
-        :param set changed_idxs: RW set of (x,y) tile indexes to process
+        :param set changed_idxs: set of (x,y) tile indexes to process
         :param dict targ: Target strokemap (WO, {xy: bytes})
+        :param lib.workerpool.WorkerPool pool: for working out diffs
+
+        Without a pool, the diffs are worked out here when the task is
+        called, as before.
 
         """
         self._before_dict = before
         self._after_dict = after
         self._targ_dict = targ
-        self._remaining = changed_idxs
+        self._chunks = collections.deque()  # [(idxs, job or None)]
+        idxs = sorted(changed_idxs)  # neighbours tend to share jobs
+        for i in xrange(0, len(idxs), _DIFF_CHUNK_SIZE):
+            chunk = idxs[i:i+_DIFF_CHUNK_SIZE]
+            job = None
+            if pool is not None:
+                job = pool.submit(_diff_tiles, before, after, chunk)
+            self._chunks.append((chunk, job))
 
     def __repr__(self):
         return "<{name} remaining={remaining}>".format(
             name = self.__class__.__name__,
-            remaining = len(self._remaining),
+            remaining = sum(len(c) for (c, j) in self._chunks),
         )
 
     def __call__(self):
-        """Diff and update one queued tile."""
-        try:
-            ti = self._remaining.pop()
-        except KeyError:
+        """Store the diffs of one chunk of queued tiles.
+
+        This never blocks: if the next chunk's job is still running,
+        the task yields and looks again on the next call.
+
+        """
+        if not self._chunks:
             return False
-        self._update_tile(ti)
-        return bool(self._remaining)
+        chunk, job = self._chunks[0]
+        if job is not None and not job.done():
+            return True
+        self._chunks.popleft()
+        self._update_chunk(chunk, job)
+        return bool(self._chunks)
 
     def process_tile_subset(self, pred):
-        """Diff and update a subset of queued tiles now."""
-        processed = set()
-        for ti in self._remaining:
-            if not pred(ti):
-                continue
-            self._update_tile(ti)
-            processed.add(ti)
-        self._remaining -= processed
+        """Store the diffs of a subset of queued tiles now.
+
+        Only the jobs for chunks containing matching tiles are waited
+        for, but all of each chunk is stored.
+
+        """
+        remaining = collections.deque()
+        for chunk, job in self._chunks:
+            if [ti for ti in chunk if pred(ti)]:
+                self._update_chunk(chunk, job)
+            else:
+                remaining.append((chunk, job))
+        self._chunks = remaining
 
-    def _update_tile(self, ti):
-        """Diff and update the tile at a specified position."""
-        transparent = tiledsurface.transparent_tile
-        data_before = self._before_dict.get(ti, transparent).rgba
-        data_after = self._after_dict.get(ti, transparent).rgba
-        self._targ_dict[ti] = _Tile.new_from_diff(data_before, data_after)
+    def _update_chunk(self, chunk, job):
+        """Store the diffs for a chunk of tiles."""
+        if job is None:
+            tiles = _diff_tiles(self._before_dict, self._after_dict, chunk)
+        else:
+            tiles = job.wait()
+        self._targ_dict.update(tiles)
 
 
 class _TileTranslateTask:
@@ -386,16 +533,47 @@ class _TileRecompressTask:
 class _Tile:
     """One strokemap tile containing perceptual stroke differences.
 
-    Stored in memory in a compressed and efficient form.
+    Stored in memory in a compressed and efficient form: tiles which
+    are all set or all clear are stored as just that fact. Other tiles
+    hold their bitmap packed 8 pixels to the byte, then compressed.
+    The unpacked bitmaps of recently used tiles are cached, so testing
+    pixels near each other doesn't decompress the same tile again.
+
+    >>> a = numpy.zeros((N, N), 'uint8')
+    >>> a[3, 5] = 1
+    >>> t = _Tile.new_from_array(a)
+    >>> t.get_pixel(5, 3), t.get_pixel(3, 5)
+    (True, False)
+    >>> numpy.array_equal(t.to_array(), a)
+    True
+
+    Tiles are still saved in the "v2" strokemap format, which holds a
+    byte per pixel. Tiles loaded from it are converted the first time
+    they're used, so untouched tiles are saved again unchanged.
+
+    >>> v2 = t.to_string()
+    >>> numpy.array_equal(numpy.fromstring(zlib.decompress(v2), 'uint8'),
+    ...                   a.flatten())
+    True
+    >>> t2 = _Tile.new_from_compressed_bitmap(v2)
+    >>> t2.to_string() == v2
+    True
+    >>> t2.get_pixel(5, 3)
+    True
+    >>> numpy.array_equal(t2.to_array(), a)
+    True
 
     """
 
     _ZDATA_ONES = zlib.compress(numpy.ones((N, N), 'uint8').tostring())
 
+    _bits_cache = lib.cache.LRUCache(capacity=_BITS_CACHE_SIZE)
+
     def __init__(self):
         """Initialize, as a tile filled with all ones."""
-        self._zdata = None
-        self._all = True
+        self._fill = 1  # 1 or 0 if uniform, None if _zbits is used
+        self._zbits = None  # compressed packed bitmap
+        self._zdata = None  # "v2" data as loaded, until converted
 
     @classmethod
     def new_from_diff(cls, before, after):
@@ -412,51 +590,90 @@ class _Tile:
     def new_from_array(cls, array):
         """Initialize from a single uncompressed diff array."""
         tile = cls()
-        if array.all():
-            tile._all = True
-            tile._zdata = None
-        else:
-            tile._all = False
-            tile._zdata = zlib.compress(array.tostring())
+        tile._set_array(array)
         return tile
 
     @classmethod
     def new_from_compressed_bitmap(cls, zdata):
-        """Initialize from raw compressed zlib bitmap data."""
+        """Initialize from raw compressed zlib bitmap data ("v2")."""
         tile = cls()
         if zdata == cls._ZDATA_ONES:
             # ASSUMPTION: this representation of these bytes never changes.
-            tile._all = True
-            tile._zdata = None
+            tile._fill = 1
         else:
-            tile._all = False
+            tile._fill = None
             tile._zdata = zdata
         return tile
 
+    def _set_array(self, array):
+        """Store an array of ones and zeros, returning its packed bits"""
+        self._zdata = None
+        if array.all():
+            self._fill = 1
+            self._zbits = None
+            return None
+        elif not array.any():
+            self._fill = 0
+            self._zbits = None
+            return None
+        bits = numpy.packbits(array.astype(bool)).tostring()
+        self._fill = None
+        self._zbits = zlib.compress(bits)
+        self._bits_cache[self._zbits] = bits
+        return bits
+
+    def _get_bits(self):
+        """Returns the packed bitmap as a string, for non-uniform tiles"""
+        zbits = self._zbits
+        if zbits is None:
+            # Convert from how it was loaded: this is done only once.
+            array = numpy.fromstring(zlib.decompress(self._zdata), 'uint8')
+            return self._set_array(array)
+        bits = self._bits_cache.get(zbits)
+        if bits is None:
+            bits = zlib.decompress(zbits)
+            self._bits_cache[zbits] = bits
+        return bits
+
+    def get_pixel(self, x, y):
+        """Returns whether a pixel within the tile is set.
+
+        :param int x: Pixel X position, 0 <= x < N.
+        :param int y: Pixel Y position, 0 <= y < N.
+        :rtype: bool
+
+        """
+        if self._fill is not None:
+            return bool(self._fill)
+        bits = self._get_bits()
+        if bits is None:
+            return bool(self._fill)
+        i = y*N + x
+        return bool(ord(bits[i >> 3]) & (0x80 >> (i & 7)))
+
     def to_array(self):
         """Convert to an uncompressed array of ones and zeros."""
-        if self._all:
-            array = numpy.ones((N, N), 'uint8')
-        else:
-            array = numpy.fromstring(
-                zlib.decompress(self._zdata),
-                dtype='uint8',
-            )
-            array.shape = (N, N)
-        # Can this result always be treated as read-only?
+        if self._fill is None:
+            bits = self._get_bits()
+        if self._fill is not None:
+            return numpy.full((N, N), self._fill, 'uint8')
+        array = numpy.unpackbits(numpy.fromstring(bits, 'uint8'))
+        array.shape = (N, N)
+        # Each call returns a fresh array, which may be modified.
         return array
 
     def to_string(self):
         """Convert to a string which is storable in "v2" strokemaps."""
-        if self._all:
-            return self._ZDATA_ONES
-        else:
+        if self._zdata is not None:
             return self._zdata
+        elif self._fill == 1:
+            return self._ZDATA_ONES
+        return zlib.compress(self.to_array().tostring())
 
     def write_to_surface_tile_array(self, rgba, _c=(1<<15)/4, _a=(1<<15)/2):
         """Write to a surface's RGBA tile."""
         # neutral gray, 50% opaque
-        if self._all:
+        if self._fill == 1:
             rgba[:] = (_c, _c, _c, _a)
         else:
             array = self.to_array()
@@ -473,14 +690,12 @@ class _Tile:
 
         >>> t = _Tile()
         >>> repr(t)
-        '<_Tile all=True zbytes=0>'
+        '<_Tile fill=1 zbytes=0>'
 
         """
-        zb = 0
-        if not self._all:
-            zb = len(self._zdata)
-        return "<{name} all={all} zbytes={zbytes}>".format(
-            all = self._all,
+        zb = len(self._zbits or self._zdata or "")
+        return "<{name} fill={fill} zbytes={zbytes}>".format(
+            fill = self._fill,
             name = self.__class__.__name__,
             zbytes = zb,
         )
@@ -489,6 +704,36 @@ class _Tile:
 ## Helper funcs
 
 
+def _get_diff_pool():
+    """Returns the shared pool for working out stroke diffs"""
+    global _diff_pool
+    if _diff_pool is None:
+        _diff_pool = lib.workerpool.WorkerPool(
+            DIFF_WORKERS,
+            name = "strokemap",
+        )
+    return _diff_pool
+
+
+def _diff_tiles(before, after, idxs):
+    """Returns strokemap tiles diffing snapshots' tiles (worker thread)
+
+    :param dict before: Complete pre-stroke tiledict (RO, {xy:Tile})
+    :param dict after: Complete post-stroke tiledict (RO, {xy:Tile})
+    :param list idxs: (x,y) tile indexes to diff
+    :returns: New strokemap tiles
+    :rtype: dict
+
+    """
+    transparent = tiledsurface.transparent_tile
+    tiles = {}
+    for ti in idxs:
+        data_before = before.get(ti, transparent).rgba
+        data_after = after.get(ti, transparent).rgba
+        tiles[ti] = _Tile.new_from_diff(data_before, data_after)
+    return tiles
+
+
 class _TileIndexPredicate (object):
     """Tile index tester callable for processing subsets of tiles.
 
@@ -249,7 +249,8 @@ def save_as_png(surface, filename, *rect, **kwargs):
     """Saves a tile-blittable surface to a file in PNG format
 
     :param TileBlittable surface: Surface to save
-    :param unicode filename: The file to write
+    :param filename: The file to write, or a writable file-like object
+    :type filename: unicode or file
     :param tuple \*rect: Rectangle (x, y, w, h) to save
     :param bool alpha: If true, write a PNG with alpha
     :param callable feedback_cb: Called every TILES_PER_CALLBACK tiles.
@@ -260,6 +261,8 @@ def save_as_png(surface, filename, *rect, **kwargs):
     The `alpha` parameter is passed to the surface's `blit_tile_into()`
     method, as well as to the PNG writer.  Rendering is
     skipped for all but the first line for single-tile patterns.
+    If `filename` is a file-like object with a ``write()`` method, the
+    encoded PNG data is written to it, and it is left open afterwards.
     If `*rect` is left unspecified, the surface's own bounding box will
     be used.
     If `save_srgb_chunks` is set to False, sRGB (and associated fallback
@@ -285,8 +288,15 @@ def save_as_png(surface, filename, *rect, **kwargs):
         rect = (x, y, w, h)
 
     writer_fp = None
+    if hasattr(filename, "write"):
+        target_fp = filename
+        filename = getattr(target_fp, "name", u"<stream>")
+    else:
+        target_fp = None
     try:
-        writer_fp = open(filename, "wb")
+        if target_fp is None:
+            writer_fp = open(filename, "wb")
+            target_fp = writer_fp
         logger.debug(
             "Writing %r (%dx%d) alpha=%r srgb=%r",
             filename,
@@ -295,7 +305,7 @@ def save_as_png(surface, filename, *rect, **kwargs):
             save_srgb_chunks,
         )
         pngsave = mypaintlib.ProgressivePNGWriter(
-            writer_fp,
+            target_fp,
             w, h,
             alpha,
             save_srgb_chunks,
@@ -15,6 +15,12 @@ import time
 import sys
 import os
 import contextlib
+import threading
+import weakref
+import zlib
+from collections import namedtuple
+from collections import deque
+from collections import OrderedDict
 import logging
 logger = logging.getLogger(__name__)
 
@@ -37,37 +43,856 @@ TILE_SIZE = N = mypaintlib.TILE_SIZE
 MAX_MIPMAP_LEVEL = mypaintlib.MAX_MIPMAP_LEVEL
 
 
+## Cold tile compression
+
+TileCompressorStats = namedtuple("TileCompressorStats", [
+    "tiles",
+    "compressed_tiles",
+    "compressed_bytes",
+    "compressions",
+    "decompressions",
+    "ratio",
+    "mean_decompress_ms",
+])
+
+
+class TileCompressor (object):
+    """Compresses the pixels of tiles which haven't been used recently
+
+    Every tile is registered with the module's `tile_compressor` when
+    it's created, including those only referenced by undo snapshots.
+    Calling `sweep()` periodically zlib-compresses the pixel data of
+    tiles which haven't been requested for `idle_seconds`, and then
+    the least recently used remaining tiles until the uncompressed
+    tiles fit in `max_bytes`. Compressed tiles are expanded again
+    transparently the next time their ``rgba`` is accessed.
+
+    >>> comp = TileCompressor(idle_seconds=60)
+    >>> t = _Tile(compressor=comp)
+    >>> t.rgba[0, 0] = (1 << 15)
+    >>> t.atime -= 120
+    >>> comp.sweep()
+    1
+    >>> "rgba" in t.__dict__
+    False
+    >>> int(t.rgba[0, 0, 3]), int(t.rgba[1, 1, 3])
+    (32768, 0)
+    >>> stats = comp.stats
+    >>> stats.compressed_tiles, stats.compressions, stats.decompressions
+    (0, 1, 1)
+
+    Sweeps can run in any thread, and `sweep_in_background()` runs
+    them in one of their own. A tile is compressed from its current
+    pixels, but the compressed data only replaces them if the tile
+    wasn't used meanwhile (see `_Tile.touch()`). The C++ backend
+    caches raw pointers to tile memory while painting, so pixels in
+    use must never be replaced.
+
+        >>> t.rgba[0, 0] = 0
+        >>> t.atime -= 120
+        >>> atime, rgba = t.atime, t.rgba
+        >>> data = zlib.compress(rgba.tostring())
+        >>> rgba = t.touch()
+        >>> t._pack(data, rgba, atime), "rgba" in t.__dict__
+        (False, True)
+
+    """
+
+    #: Uncompressed size of a tile's pixel data
+    TILE_NBYTES = N * N * 4 * 2
+
+    #: Tiles used more recently than this are never compressed
+    MIN_IDLE_SECONDS = 2.0
+
+    #: Background sweeps pause after compressing this many tiles
+    CHUNK_SIZE = 16
+
+    #: Seconds to pause for, so that the main thread gets the
+    #: interpreter lock back often while painting.
+    CHUNK_PAUSE = 0.001
+
+    def __init__(self, idle_seconds=None, max_bytes=None, level=1):
+        """Initialize
+
+        :param float idle_seconds: Compress tiles unused for this long
+        :param int max_bytes: Budget for uncompressed tile memory
+        :param int level: zlib compression level
+
+        Either limit can be None to disable it.
+
+        """
+        super(TileCompressor, self).__init__()
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        self.level = level
+        self._tiles = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._compressions = 0
+        self._decompressions = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._decompress_time = 0.0
+        self._sweeping = False
+
+    def __repr__(self):
+        return "<TileCompressor idle=%r max_bytes=%r>" % (
+            self.idle_seconds,
+            self.max_bytes,
+        )
+
+    @property
+    def enabled(self):
+        """True if sweeps can compress anything"""
+        return not (self.idle_seconds is None and self.max_bytes is None)
+
+    def register(self, tile):
+        """Start tracking a tile (called when tiles are created)
+
+        Tiles may be created in worker threads, e.g. while loading.
+
+        """
+        with self._lock:
+            self._tiles.add(tile)
+
+    def forget(self, tile):
+        """Never compress a tile (for the special marker tiles)"""
+        with self._lock:
+            self._tiles.discard(tile)
+
+    def _get_tiles(self):
+        """Returns a list of the tracked tiles"""
+        with self._lock:
+            return list(self._tiles)
+
+    def sweep_in_background(self):
+        """Start a sweep in a thread of its own, unless one is running
+
+        :returns: whether a sweep was started
+        :rtype: bool
+
+        """
+        with self._lock:
+            if self._sweeping or not self.enabled:
+                return False
+            self._sweeping = True
+        thread = threading.Thread(
+            target = self._sweep_thread_cb,
+            name = "tile-compressor",
+        )
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _sweep_thread_cb(self):
+        """Run one sweep, pausing between chunks (sweeper thread)"""
+        try:
+            self.sweep(pause=True)
+        except Exception:
+            logger.exception("%r: background sweep failed", self)
+        finally:
+            with self._lock:
+                self._sweeping = False
+
+    def sweep(self, now=None, pause=False):
+        """Compress tiles which are idle, or beyond the memory budget
+
+        :param float now: Current time.time(), for testing
+        :param bool pause: Pause briefly between chunks of tiles
+        :returns: The number of tiles compressed
+        :rtype: int
+
+        """
+        if not self.enabled:
+            return 0
+        if now is None:
+            now = time.time()
+        recent = now - self.MIN_IDLE_SECONDS
+        if self.idle_seconds is None:
+            cutoff = None
+        else:
+            cutoff = now - max(self.idle_seconds, self.MIN_IDLE_SECONDS)
+        raw = []
+        idle = []
+        for tile in self._get_tiles():
+            if "rgba" not in tile.__dict__:
+                continue
+            if cutoff is not None and tile.atime < cutoff:
+                idle.append(tile)
+            else:
+                raw.append(tile)
+        if self.max_bytes is not None:
+            raw_nbytes = len(raw) * self.TILE_NBYTES
+            raw.sort(key=lambda t: t.atime)
+            for tile in raw:
+                if raw_nbytes <= self.max_bytes:
+                    break
+                if tile.atime >= recent:
+                    break
+                idle.append(tile)
+                raw_nbytes -= self.TILE_NBYTES
+        n = 0
+        for i, tile in enumerate(idle):
+            if pause and i and i % self.CHUNK_SIZE == 0:
+                time.sleep(self.CHUNK_PAUSE)
+            if self._compress(tile):
+                n += 1
+        if n:
+            logger.debug("%r: compressed %d tiles", self, n)
+        return n
+
+    def _compress(self, tile):
+        """Compress a tile's pixels, unless it's used meanwhile"""
+        atime = tile.atime
+        rgba = tile.__dict__.get("rgba")
+        if rgba is None:
+            return False
+        data = zlib.compress(rgba.tostring(), self.level)
+        if not tile._pack(data, rgba, atime):
+            return False
+        with self._lock:
+            self._compressions += 1
+            self._bytes_in += self.TILE_NBYTES
+            self._bytes_out += len(data)
+        return True
+
+    def _decompress(self, data):
+        t0 = time.time()
+        buf = zlib.decompress(data)
+        rgba = numpy.frombuffer(buf, 'uint16').reshape((N, N, 4)).copy()
+        dt = time.time() - t0
+        with self._lock:
+            self._decompressions += 1
+            self._decompress_time += dt
+        return rgba
+
+    @property
+    def stats(self):
+        """Current tile counts, and running totals
+
+        :rtype: TileCompressorStats
+
+        The ratio is the mean compressed size of tiles divided by their
+        uncompressed size, over all compressions so far.
+
+        """
+        tiles = self._get_tiles()
+        compressed = [t._compressed for t in tiles
+                      if isinstance(t._compressed, str)]
+        with self._lock:
+            ratio = None
+            if self._bytes_in:
+                ratio = float(self._bytes_out) / self._bytes_in
+            mean_ms = None
+            if self._decompressions:
+                mean_ms = 1000 * self._decompress_time / self._decompressions
+            return TileCompressorStats(
+                tiles = len(tiles),
+                compressed_tiles = len(compressed),
+                compressed_bytes = sum(len(d) for d in compressed),
+                compressions = self._compressions,
+                decompressions = self._decompressions,
+                ratio = ratio,
+                mean_decompress_ms = mean_ms,
+            )
+
+
+#: The compressor which all new tiles are registered with
+tile_compressor = TileCompressor()
+
+
 ## Tile class and marker tile constants
 
 class _Tile (object):
-    """Internal tile storage, with readonly flag
+    """Internal tile storage
 
     Note: pixels are stored with premultiplied alpha.
     15 bits are used, but fully opaque or white is stored as 2**15
     (requiring 16 bits). This is to allow many calcuations to divide by
     2**15 instead of (2**16-1).
 
+    Tiles may be shared between a surface and its snapshots. Whether a
+    tile can be written to in place is tracked by the _TileMap holding
+    it, not by the tile itself.
+
+    The pixels of tiles which haven't been used for a while may be
+    compressed by a TileCompressor, or swapped out to disk by a
+    lib.tileswap.TileSwap. Accessing ``rgba`` brings them back.
+    Tiles can also be created with their pixels still compressed, e.g.
+    when loading them from a lib.tileindex file. Each tile has a lock
+    so that these can happen in any thread.
+
     """
 
-    def __init__(self, copy_from=None):
+    _compressed = None
+
+    def __init__(self, copy_from=None, compressor=None, compressed=None):
         super(_Tile, self).__init__()
-        if copy_from is None:
+        self._lock = threading.Lock()
+        if compressed is not None:
+            self._compressed = compressed
+        elif copy_from is None:
             self.rgba = numpy.zeros((N, N, 4), 'uint16')
         else:
             self.rgba = copy_from.rgba.copy()
-        self.readonly = False
+        self.atime = time.time()
+        self._compressor = compressor or tile_compressor
+        self._compressor.register(self)
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails, which for "rgba" means
+        # the pixels are compressed (or this is mipmap_dirty_tile).
+        if name != "rgba":
+            raise AttributeError(name)
+        with self._lock:
+            return self._expand()
+
+    def _expand(self):
+        """Returns the pixels, decompressing them if needed (lock held)"""
+        rgba = self.__dict__.get("rgba")
+        if rgba is not None:
+            return rgba  # another thread just decompressed it
+        data = self._compressed
+        if data is None:
+            raise AttributeError("rgba")
+        if not isinstance(data, str):
+            data = data.read()  # swapped out to disk (lib.tileswap)
+        rgba = self._compressor._decompress(data)
+        self.rgba = rgba
+        self._compressed = None
+        self.atime = time.time()
+        return rgba
+
+    def touch(self):
+        """Marks the tile as used now, and returns its pixels
+
+        Pixels got this way won't be replaced by compressed data until
+        the tile has been idle for a while again, so they can be
+        written to, or held on to, e.g. by the C++ backend.
+
+        """
+        with self._lock:
+            self.atime = time.time()
+            return self._expand()
+
+    def _pack(self, data, old, atime):
+        """Replace the pixels with a compressed form, if still unused
+
+        :param data: the compressed pixels, or where they are stored
+        :param old: the pixels, or the compressed form of them, which
+            `data` was made from
+        :param float atime: the tile's atime when `old` was got
+        :returns: whether the pixels were replaced
+        :rtype: bool
+
+        """
+        with self._lock:
+            current = self.__dict__.get("rgba")
+            if current is None:
+                current = self._compressed
+            if current is not old or self.atime != atime:
+                return False
+            self._compressed = data
+            self.__dict__.pop("rgba", None)
+            return True
 
     def copy(self):
-        return _Tile(copy_from=self)
+        return _Tile(copy_from=self, compressor=self._compressor)
 
 
 # tile for read-only operations on empty spots
 transparent_tile = _Tile()
-transparent_tile.readonly = True
+tile_compressor.forget(transparent_tile)
 
 # tile with invalid pixel memory (needs refresh)
 mipmap_dirty_tile = _Tile()
 del mipmap_dirty_tile.rgba
+tile_compressor.forget(mipmap_dirty_tile)
+
+
+## Tile storage
+
+class _TileMap (object):
+    """Copy-on-write mapping of tile positions to tiles
+
+    Tiles are grouped into square chunks, each with its own dict.
+    Copies share all the chunks and tiles with the map they came from,
+    so taking one costs the same however many tiles there are. A chunk
+    dict is only duplicated when it's first written to after a copy,
+    and the tiles themselves are only duplicated by the surface when
+    it needs to write to them. Each map tracks which tiles it owns
+    outright: storing a tile gives the map sole ownership of it, and
+    copying the map revokes ownership of everything on both sides.
+
+        >>> m = _TileMap()
+        >>> m[(0, 0)] = "a"
+        >>> m[(9, 9)] = "b"
+        >>> m.owns_tile((0, 0))
+        True
+        >>> s = m.copy()
+        >>> m.owns_tile((0, 0)), s.owns_tile((0, 0))
+        (False, False)
+        >>> m[(0, 0)] = "c"
+        >>> s[(0, 0)], m[(0, 0)], len(m)
+        ('a', 'c', 2)
+
+    Differences between related maps are found by comparing chunks by
+    identity first, so the cost depends mostly on what was changed.
+
+        >>> sorted(s.get_changed_keys(m))
+        [(0, 0)]
+        >>> m.pop((9, 9))
+        'b'
+        >>> sorted(s.get_changed_keys(m))
+        [(0, 0), (9, 9)]
+        >>> s.get_changed_keys(s.copy())
+        set([])
+        >>> sorted(m.keys()), sorted(s.keys())
+        ([(0, 0)], [(0, 0), (9, 9)])
+
+    """
+
+    #: Chunks are 2**CHUNK_SHIFT tiles on a side
+    CHUNK_SHIFT = 3
+
+    def __init__(self):
+        super(_TileMap, self).__init__()
+        self._chunks = {}
+        self._chunks_shared = False
+        self._owned_chunks = set()
+        self._owned_tiles = set()
+        self._len = 0
+
+    def __repr__(self):
+        return "<_TileMap tiles=%d chunks=%d>" % (
+            self._len,
+            len(self._chunks),
+        )
+
+    ## Dict-like read access
+
+    def _chunk_key(self, pos):
+        tx, ty = pos
+        return (tx >> self.CHUNK_SHIFT, ty >> self.CHUNK_SHIFT)
+
+    def get(self, pos, default=None):
+        chunk = self._chunks.get(self._chunk_key(pos))
+        if chunk is None:
+            return default
+        return chunk.get(pos, default)
+
+    def __getitem__(self, pos):
+        chunk = self._chunks.get(self._chunk_key(pos))
+        if chunk is None:
+            raise KeyError(pos)
+        return chunk[pos]
+
+    def __contains__(self, pos):
+        chunk = self._chunks.get(self._chunk_key(pos))
+        return chunk is not None and pos in chunk
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks.values():
+            for pos in chunk:
+                yield pos
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self):
+        for chunk in self._chunks.values():
+            for tile in chunk.values():
+                yield tile
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for chunk in self._chunks.values():
+            for item in chunk.items():
+                yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    ## Dict-like write access
+
+    def _get_writable_chunk(self, ckey, create):
+        """Get a chunk dict which is private to this map"""
+        if self._chunks_shared:
+            self._chunks = dict(self._chunks)
+            self._chunks_shared = False
+        chunk = self._chunks.get(ckey)
+        if chunk is None:
+            if not create:
+                return None
+            chunk = {}
+        elif ckey in self._owned_chunks:
+            return chunk
+        else:
+            chunk = dict(chunk)
+        self._chunks[ckey] = chunk
+        self._owned_chunks.add(ckey)
+        return chunk
+
+    def __setitem__(self, pos, tile):
+        chunk = self._get_writable_chunk(self._chunk_key(pos), True)
+        if pos not in chunk:
+            self._len += 1
+        chunk[pos] = tile
+        self._owned_tiles.add(pos)
+
+    def pop(self, pos, *default):
+        ckey = self._chunk_key(pos)
+        chunk = self._chunks.get(ckey)
+        if chunk is None or pos not in chunk:
+            if default:
+                return default[0]
+            raise KeyError(pos)
+        chunk = self._get_writable_chunk(ckey, False)
+        tile = chunk.pop(pos)
+        self._len -= 1
+        self._owned_tiles.discard(pos)
+        if not chunk:
+            self._chunks.pop(ckey)
+            self._owned_chunks.discard(ckey)
+        return tile
+
+    ## Sharing
+
+    def owns_tile(self, pos):
+        """True if the tile at pos is not shared with any other map"""
+        return pos in self._owned_tiles
+
+    def copy(self):
+        """Returns a new map sharing all the chunks and tiles of this one"""
+        other = _TileMap()
+        other._chunks = self._chunks
+        other._chunks_shared = True
+        other._len = self._len
+        self._chunks_shared = True
+        self._owned_chunks = set()
+        self._owned_tiles = set()
+        return other
+
+    def get_changed_keys(self, other):
+        """Returns the set of positions whose tiles differ between maps
+
+        :param _TileMap other: the map to compare against
+        :rtype: set
+
+        Tiles are compared by identity, not by content.
+
+        """
+        changed = set()
+        ours = self._chunks
+        theirs = other._chunks
+        if ours is theirs:
+            return changed
+        for ckey, chunk in ours.iteritems():
+            other_chunk = theirs.get(ckey)
+            if other_chunk is chunk:
+                continue
+            elif other_chunk is None:
+                changed.update(chunk)
+                continue
+            for pos, tile in chunk.iteritems():
+                if other_chunk.get(pos) is not tile:
+                    changed.add(pos)
+            for pos in other_chunk:
+                if pos not in chunk:
+                    changed.add(pos)
+        for ckey, other_chunk in theirs.iteritems():
+            if ckey not in ours:
+                changed.update(other_chunk)
+        return changed
+
+
+class _LazyTileMap (_TileMap):
+    """Tile map whose tiles are only decoded when first needed
+
+    The tiles come from a `LazyTileSource`. Until they are needed,
+    lookups outside the source's frame are answered without decoding
+    anything, and copies share the source rather than its tiles.
+    Lookups of single tiles inside the frame only decode as far as
+    the source needs to for them. Any other access decodes all the
+    tiles, after which the map turns into a plain `_TileMap`, so
+    there's no overhead from then on.
+
+    """
+
+    #: Serializes installing the decoded tiles
+    _load_lock = threading.Lock()
+
+    def __init__(self, source):
+        super(_LazyTileMap, self).__init__()
+        # Accessing these triggers __getattr__, which loads the tiles
+        del self._chunks
+        del self._len
+        self._chunks_shared = True
+        self._source = source
+        self._tile_bbox = source.get_tile_bbox()
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, i.e. before loading
+        if name not in ("_chunks", "_len"):
+            raise AttributeError(name)
+        source = self.__dict__.get("_source")
+        if source is not None:
+            tiledict = source.get_tiledict()  # decodes, once
+            with self._load_lock:
+                if "_chunks" not in self.__dict__:
+                    self._chunks = tiledict._chunks
+                    self._len = tiledict._len
+                    self._chunks_shared = True
+                    self._source = None
+                    self.__class__ = _TileMap
+        return self.__dict__[name]
+
+    def _may_contain(self, pos):
+        bbox = self._tile_bbox
+        if bbox is None:
+            return False
+        tx0, ty0, tx1, ty1 = bbox
+        tx, ty = pos
+        return tx0 <= tx <= tx1 and ty0 <= ty <= ty1
+
+    def get(self, pos, default=None):
+        if not self._may_contain(pos):
+            return default
+        source = self.__dict__.get("_source")
+        if source is not None:
+            return source.get_tile(pos, default)
+        return _TileMap.get(self, pos, default)
+
+    def __getitem__(self, pos):
+        tile = self.get(pos)
+        if tile is None:
+            raise KeyError(pos)
+        return tile
+
+    def __contains__(self, pos):
+        return self.get(pos) is not None
+
+    def get_bbox(self):
+        """The bbox of the source's frame, tile-aligned, as a Rect"""
+        bbox = self._tile_bbox
+        if bbox is None:
+            return helpers.Rect()
+        tx0, ty0, tx1, ty1 = bbox
+        return helpers.Rect(tx0*N, ty0*N, (tx1-tx0+1)*N, (ty1-ty0+1)*N)
+
+    def copy(self):
+        source = self.__dict__.get("_source")
+        if source is None:
+            return _TileMap.copy(self)
+        return _LazyTileMap(source)
+
+    def get_changed_keys(self, other):
+        source = self.__dict__.get("_source")
+        if source is not None and isinstance(other, _LazyTileMap):
+            if other.__dict__.get("_source") is source:
+                return set()
+        return _TileMap.get_changed_keys(self, other)
+
+
+class LazyTileSource (object):
+    """Tile data for a surface, decoded when it's first needed
+
+    See `MyPaintSurface.load_lazily()`. Subclasses must implement
+    `_load()`, which may be called from any thread, but only once.
+
+    Subclasses whose data is decoded one tile row at a time from the
+    top, like PNG data, can also implement `_get_row_decoder()`.
+    Looking up a single tile then decodes only as far down as its
+    row. The decoder is kept paused there, in a thread of its own,
+    until a later row is needed or the source is dropped.
+
+        >>> def decode(row_cb):
+        ...     tiledict = _TileMap()
+        ...     for ty in xrange(8):
+        ...         tiledict[(0, ty)] = _Tile()
+        ...         if ty < 7:
+        ...             row_cb(tiledict, ty)
+        ...     sshot = _SurfaceSnapshot()
+        ...     sshot.tiledict = tiledict
+        ...     return sshot
+        >>> class _Source (LazyTileSource):
+        ...     def _get_row_decoder(self):
+        ...         return decode
+        >>> src = _Source(0, 0, N, 8*N)
+        >>> src.get_tile((0, 2)) is not None
+        True
+        >>> sorted(src._rows.tiledict.keys())
+        [(0, 0), (0, 1), (0, 2)]
+        >>> src.get_tile((0, 1)) is src.get_tiledict()[(0, 1)]
+        True
+        >>> len(src.get_tiledict())
+        8
+
+    """
+
+    def __init__(self, x, y, w, h):
+        """Initialize, with the frame the data will occupy"""
+        super(LazyTileSource, self).__init__()
+        self.frame = (x, y, w, h)
+        self._lock = threading.Lock()
+        self._tiledict = None
+        self._rows = None
+
+    def __del__(self):
+        rows = self.__dict__.get("_rows")
+        if rows is not None:
+            rows.abandon()
+
+    def get_tile_bbox(self):
+        """Tile coords of the frame, as (tx0, ty0, tx1, ty1), or None"""
+        x, y, w, h = self.frame
+        if w <= 0 or h <= 0:
+            return None
+        return (x/N, y/N, (x+w-1)/N, (y+h-1)/N)
+
+    def get_tiledict(self):
+        """Returns the decoded tiles, decoding them if needed"""
+        with self._lock:
+            if self._tiledict is None:
+                t0 = time.time()
+                if self._rows is not None:
+                    self._tiledict = self._rows.wait_for_all()
+                    self._rows = None
+                else:
+                    self._tiledict = self._load_all()
+                logger.debug("%r: loaded in %.3fs", self, time.time() - t0)
+            return self._tiledict
+
+    def get_tile(self, pos, default=None):
+        """Returns one tile, decoding no more than needed (any thread)"""
+        with self._lock:
+            tiledict = self._tiledict
+            rows = self._rows
+            if tiledict is None and rows is None:
+                decoder = self._get_row_decoder()
+                if decoder is None:
+                    tiledict = self._tiledict = self._load_all()
+                else:
+                    rows = self._rows = _RowDecoder(decoder, repr(self))
+        if tiledict is None:
+            tiledict = rows.wait_for_row(pos[1])
+        return tiledict.get(pos, default)
+
+    def _load_all(self):
+        try:
+            return self._load().tiledict
+        except FileHandlingError:
+            logger.exception("Failed to load %r, leaving it empty", self)
+            return _TileMap()
+
+    def _load(self):
+        """Decodes the data, returning a snapshot holding the tiles"""
+        raise NotImplementedError
+
+    def _get_row_decoder(self):
+        """Returns a function decoding the data a tile row at a time
+
+        :returns: a decoder function, or None if rows can't be decoded
+            separately (the default).
+
+        The decoder function is called with a single ``row_cb``
+        argument in a thread of its own. It must decode the data into
+        a new `_TileMap`, calling ``row_cb(tiledict, ty)`` each time a
+        row of tiles has been added to it, apart from the last row.
+        It returns a snapshot holding the tiles when done. It must not
+        refer to the source, so that the source can be dropped while
+        the decoder is paused. The callback raises an exception to
+        stop the decoder if that happens.
+
+        """
+        return None
+
+
+class _RowDecoder (object):
+    """Runs a LazyTileSource's row decoder, as far as rows are wanted"""
+
+    def __init__(self, decoder, name):
+        super(_RowDecoder, self).__init__()
+        self._decoder = decoder
+        self._cond = threading.Condition()
+        self._tiledict = _TileMap()
+        self._last_row = None
+        self._wanted_row = float("-inf")
+        self._finished = False
+        self._abandoned = False
+        thread = threading.Thread(target=self._run, name=name)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def tiledict(self):
+        """The tiles decoded so far"""
+        return self._tiledict
+
+    def wait_for_row(self, ty):
+        """Wait until tile row ty has been decoded
+
+        :returns: the tiles decoded so far
+        :rtype: _TileMap
+
+        """
+        with self._cond:
+            if ty > self._wanted_row:
+                self._wanted_row = ty
+                self._cond.notify_all()
+            while not self._finished:
+                if self._last_row is not None and self._last_row >= ty:
+                    break
+                self._cond.wait()
+            return self._tiledict
+
+    def wait_for_all(self):
+        """Wait until all the rows have been decoded
+
+        :returns: all the tiles
+        :rtype: _TileMap
+
+        """
+        return self.wait_for_row(float("inf"))
+
+    def abandon(self):
+        """Stop the decoder early, if it's paused or running"""
+        with self._cond:
+            self._abandoned = True
+            self._cond.notify_all()
+
+    def _run(self):
+        """Decode until done or abandoned (decoder thread)"""
+        try:
+            sshot = self._decoder(self._row_decoded_cb)
+        except Exception:
+            sshot = None
+            if not self._abandoned:
+                logger.exception("Failed to decode %r, leaving it partial",
+                                 self._decoder)
+        with self._cond:
+            if sshot is not None:
+                self._tiledict = sshot.tiledict
+            self._finished = True
+            self._decoder = None
+            self._cond.notify_all()
+
+    def _row_decoded_cb(self, tiledict, ty):
+        """Publish a decoded row, then wait for more to be wanted"""
+        with self._cond:
+            self._tiledict = tiledict
+            self._last_row = ty
+            self._cond.notify_all()
+            while ty >= self._wanted_row and not self._abandoned:
+                self._cond.wait()
+            if self._abandoned:
+                raise RuntimeError("decoding abandoned")
 
 
 ## Class defs: surfaces
@@ -90,9 +915,15 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
         # TODO: pass just what it needs access to, not all of self
         self._backend = mypaintlib.TiledSurface(self)
-        self.tiledict = {}
+        self.tiledict = _TileMap()
         self.observers = []
 
+        # Change tracking, see changed_tiles_since(). Tile positions
+        # map to the generation they last changed in, oldest first.
+        self._generation = 0
+        self._tile_generations = OrderedDict()
+        self._untracked_generation = 0
+
         # Used to implement repeating surfaces, like Background
         if looped_size[0] % N or looped_size[1] % N:
             raise ValueError('Looped size must be multiples of tile size')
@@ -154,7 +985,9 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
     def clear(self):
         tiles = self.tiledict.keys()
-        self.tiledict = {}
+        self.tiledict = _TileMap()
+        for pos in tiles:
+            self._note_tile_changed(pos)
         self.notify_observers(*lib.surface.get_tiles_bbox(tiles))
         if self.mipmap:
             self.mipmap.clear()
@@ -224,14 +1057,14 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
             ...     assert (t2 == t1).all()
 
         Read-only tile requests on empty addresses yield the special
-        transparent tile, which is marked as read-only::
+        transparent tile, which must not be written to::
 
             >>> with surf.tile_request(666, 666, readonly=True) as tr:
             ...     assert tr is transparent_tile.rgba
 
-        Snapshotting a surface makes all its tiles read-only as a side
-        effect, so the next read/write tile request will yield a copy
-        for you to work on::
+        Snapshotting a surface shares all its tiles with the snapshot,
+        so the next read/write tile request will yield a copy for you
+        to work on::
 
             >>> sshot = surf.save_snapshot()
             >>> with surf.tile_request(1, 2, readonly=True) as t3:
@@ -284,20 +1117,22 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                 self.tiledict[(tx, ty)] = t
         if t is mipmap_dirty_tile:
             t = self._regenerate_mipmap(t, tx, ty)
-        if t.readonly and not readonly:
-            # shared memory, get a private copy for writing
-            t = t.copy()
-            self.tiledict[(tx, ty)] = t
         if not readonly:
+            if not self.tiledict.owns_tile((tx, ty)):
+                # shared memory, get a private copy for writing
+                t = t.copy()
+                self.tiledict[(tx, ty)] = t
             # assert self.mipmap_level == 0
             self._mark_mipmap_dirty(tx, ty)
-        return t.rgba
+        return t.touch()
 
     def _set_tile_numpy(self, tx, ty, obj, readonly):
         pass  # Data can be modified directly, no action needed
 
     def _mark_mipmap_dirty(self, tx, ty):
         #assert self.mipmap_level == 0
+        # All writes to tiles are marked here, so this tracks changes.
+        self._note_tile_changed((tx, ty))
         if not self._mipmaps:
             return
         for level, mipmap in enumerate(self._mipmaps):
@@ -389,39 +1224,174 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                     return
             mypaintlib.tile_combine(mode, src, dst, dst_has_alpha, opacity)
 
+    ## Change tracking
+
+    def get_generation(self):
+        """Returns a marker to pass to changed_tiles_since() later
+
+        :rtype: int
+
+        Any number of consumers can track changes independently, each
+        with its own marker. Markers should be taken outside of any
+        begin_atomic() ... end_atomic() sequence, because tiles being
+        painted are only noted as changed when first requested.
+
+        """
+        generation = self._generation
+        self._generation += 1
+        return generation
+
+    def changed_tiles_since(self, generation):
+        """Returns the positions of tiles changed since a marker
+
+        :param int generation: from get_generation()
+        :returns: (tx, ty) positions, or None if it can't be known
+        :rtype: list
+
+        The cost is proportional to the number of tiles which changed,
+        not the size of the surface. Removed tiles count as changed.
+        None is returned if the tiles were replaced wholesale after the
+        marker was taken, e.g. by `load_lazily()`.
+
+            >>> surf = MyPaintSurface()
+            >>> gen1 = surf.get_generation()
+            >>> for tx in (1, 2):
+            ...     with surf.tile_request(tx, 2, readonly=False) as t:
+            ...         t[...] = 1 << 15
+            >>> gen2 = surf.get_generation()
+            >>> surf.changed_tiles_since(gen2)
+            []
+            >>> with surf.tile_request(1, 2, readonly=False) as t:
+            ...     t[...] = 0
+            >>> surf.changed_tiles_since(gen2)
+            [(1, 2)]
+            >>> surf.changed_tiles_since(gen1)
+            [(2, 2), (1, 2)]
+            >>> gen3 = surf.get_generation()
+            >>> surf.clear()
+            >>> sorted(surf.changed_tiles_since(gen3))
+            [(1, 2), (2, 2)]
+
+        """
+        if generation < self._untracked_generation:
+            return None
+        changed = []
+        tile_generations = self._tile_generations
+        for pos in reversed(tile_generations):
+            if tile_generations[pos] <= generation:
+                break
+            changed.append(pos)
+        changed.reverse()
+        return changed
+
+    def _note_tile_changed(self, pos):
+        """Records that a tile changed, for changed_tiles_since()"""
+        generation = self._generation
+        tile_generations = self._tile_generations
+        if tile_generations.get(pos) == generation:
+            return  # already noted, and it's still in order
+        tile_generations.pop(pos, None)
+        tile_generations[pos] = generation
+
+    def _note_tiles_replaced(self):
+        """Records that all tiles changed, in ways that can't be listed"""
+        self._untracked_generation = self._generation
+        self._tile_generations.clear()
+
     ## Snapshotting
 
     def save_snapshot(self):
         """Creates and returns a snapshot of the surface
 
-        Snapshotting marks all the tiles of the surface as read-only,
-        then just shallow-copes the tiledict. It's quick. See
-        tile_request() for how new read/write tiles can be unlocked.
+        Snapshotting just makes a copy-on-write copy of the tiledict,
+        sharing all its tiles. It's quick, and its cost doesn't depend
+        on the number of tiles. See tile_request() for how new
+        read/write tiles can be unlocked.
 
         """
         sshot = _SurfaceSnapshot()
-        for t in self.tiledict.itervalues():
-            t.readonly = True
         sshot.tiledict = self.tiledict.copy()
+        sshot.generation = self.get_generation()
         return sshot
 
     def load_snapshot(self, sshot):
         """Loads a saved snapshot, replacing the internal tiledict"""
         self._load_tiledict(sshot.tiledict)
 
+    def is_unchanged_since(self, sshot):
+        """True if no tiles have changed since a snapshot was taken
+
+        :param sshot: a snapshot from `save_snapshot()`
+        :rtype: bool
+
+        Tiles are compared by identity, which is enough because taking
+        the snapshot stops the surface writing to the tiles in place.
+        This is cheap when little or nothing has changed.
+
+        """
+        return not sshot.tiledict.get_changed_keys(self.tiledict)
+
+    def load_lazily(self, source):
+        """Replaces the tiles with ones decoded only when needed
+
+        :param LazyTileSource source: where the tiles come from
+
+        Rendering, tile requests, and most other access will decode
+        the tiles, but the bbox is the source's frame until then.
+        Snapshots share the source, so taking them decodes nothing.
+
+            >>> class _Source (LazyTileSource):
+            ...     def _load(self):
+            ...         s = MyPaintSurface()
+            ...         with s.tile_request(1, 1, readonly=False) as t:
+            ...             t[...] = 1 << 15
+            ...         return s.save_snapshot()
+            >>> surf = MyPaintSurface()
+            >>> src = _Source(0, 0, 4*N, 4*N)
+            >>> surf.load_lazily(src)
+            >>> sshot = surf.save_snapshot()
+            >>> tuple(surf.get_bbox()) == (0, 0, 4*N, 4*N)
+            True
+            >>> with surf.tile_request(9, 9, readonly=True) as t:
+            ...     assert t is transparent_tile.rgba
+            >>> surf.is_unchanged_since(sshot), src._tiledict is None
+            (True, True)
+            >>> with surf.tile_request(1, 1, readonly=True) as t:
+            ...     int(t[0, 0, 3])
+            32768
+            >>> surf.tiledict.keys(), tuple(surf.get_bbox()) == (N, N, N, N)
+            ([(1, 1)], True)
+            >>> surf.is_unchanged_since(sshot)
+            True
+
+        """
+        dirty = lib.surface.get_tiles_bbox(self.tiledict)
+        self.tiledict = _LazyTileMap(source)
+        self._note_tiles_replaced()
+        bbox = self.tiledict.get_bbox()
+        tile_bbox = source.get_tile_bbox()
+        if tile_bbox is not None and self._mipmaps:
+            tx0, ty0, tx1, ty1 = tile_bbox
+            for level, mipmap in enumerate(self._mipmaps):
+                if level == 0:
+                    continue
+                for ty in xrange(ty0 >> level, (ty1 >> level) + 1):
+                    for tx in xrange(tx0 >> level, (tx1 >> level) + 1):
+                        mipmap.tiledict[(tx, ty)] = mipmap_dirty_tile
+        dirty.expandToIncludeRect(bbox)
+        if not dirty.empty():
+            self.notify_observers(*dirty)
+
     def _load_tiledict(self, d):
         """Efficiently loads a tiledict, and notifies the observers"""
-        if d == self.tiledict:
+        dirty = self.tiledict.get_changed_keys(d)
+        if not dirty:
             # common case optimization, called via stroke.redo()
-            # testcase: comparison above (if equal) takes 0.6ms, code below 30ms
             return
-        old = set(self.tiledict.iteritems())
         self.tiledict = d.copy()
-        new = set(self.tiledict.iteritems())
-        dirty = old.symmetric_difference(new)
-        for pos, tile in dirty:
+        for pos in dirty:
             self._mark_mipmap_dirty(*pos)
-        bbox = lib.surface.get_tiles_bbox(pos for (pos, tile) in dirty)
+        bbox = lib.surface.get_tiles_bbox(dirty)
         if not bbox.empty():
             self.notify_observers(*bbox)
 
@@ -433,7 +1403,9 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
 
     def _load_from_pixbufsurface(self, s):
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict = _TileMap()
+        for pos in dirty_tiles:
+            self._note_tile_changed(pos)
 
         for tx, ty in s.get_tiles():
             with self.tile_request(tx, ty, readonly=False) as dst:
@@ -470,7 +1442,7 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
                       **kwargs):
         """Load from a PNG, one tilerow at a time, discarding empty tiles.
 
-        :param str filename: The file to load
+        :param filename: The file to load, or a readable file object
         :param int x: X-coordinate at which to load the replacement data
         :param int y: Y-coordinate at which to load the replacement data
         :param bool convert_to_srgb: If True, convert to sRGB
@@ -481,74 +1453,14 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         string when conversion or PNG reading fails.
 
         """
-        dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
-
-        state = {}
-        state['buf'] = None  # array of height N, width depends on image
-        state['ty'] = y/N  # current tile row being filled into buf
-        state['frame_size'] = None
-
-        def get_buffer(png_w, png_h):
-            state['frame_size'] = x, y, png_w, png_h
-            if feedback_cb:
-                feedback_cb()
-            buf_x0 = x/N*N
-            buf_x1 = ((x+png_w-1)/N+1)*N
-            buf_y0 = state['ty']*N
-            buf_y1 = buf_y0+N
-            buf_w = buf_x1-buf_x0
-            buf_h = buf_y1-buf_y0
-            assert buf_w % N == 0
-            assert buf_h == N
-            if state['buf'] is not None:
-                consume_buf()
-            else:
-                state['buf'] = numpy.empty((buf_h, buf_w, 4), 'uint8')
-
-            png_x0 = x
-            png_x1 = x+png_w
-            subbuf = state['buf'][:, png_x0-buf_x0:png_x1-buf_x0]
-            if 1:  # optimize: only needed for first and last
-                state['buf'].fill(0)
-                png_y0 = max(buf_y0, y)
-                png_y1 = min(buf_y0+buf_h, y+png_h)
-                assert png_y1 > png_y0
-                subbuf = subbuf[png_y0-buf_y0:png_y1-buf_y0, :]
-
-            state['ty'] += 1
-            return subbuf
-
-        def consume_buf():
-            ty = state['ty']-1
-            for i in xrange(state['buf'].shape[1]/N):
-                tx = x/N + i
-                src = state['buf'][:, i*N:(i+1)*N, :]
-                if src[:, :, 3].any():
-                    with self.tile_request(tx, ty, readonly=False) as dst:
-                        mypaintlib.tile_convert_rgba8_to_rgba16(src, dst)
-
-        if sys.platform == 'win32':
-            filename_sys = filename.encode("utf-8")
-        else:
-            filename_sys = filename.encode(sys.getfilesystemencoding())  # FIXME: should not do that, should use open(unicode_object)
-        try:
-            flags = mypaintlib.load_png_fast_progressive(
-                filename_sys,
-                get_buffer,
-                convert_to_srgb,
-            )
-        except (IOError, OSError, RuntimeError) as ex:
-            raise FileHandlingError(_("PNG reader failed: %s") % str(ex))
-        consume_buf()  # also process the final chunk of data
-        logger.debug("PNG loader flags: %r", flags)
-
-        dirty_tiles.update(self.tiledict.keys())
-        bbox = lib.surface.get_tiles_bbox(dirty_tiles)
-        self.notify_observers(*bbox)
-
+        sshot, frame_size = load_png_tiles(
+            filename, x, y,
+            feedback_cb = feedback_cb,
+            convert_to_srgb = convert_to_srgb,
+        )
+        self.load_snapshot(sshot)
         # return the bbox of the loaded image
-        return state['frame_size']
+        return frame_size
 
     def render_as_pixbuf(self, *args, **kwargs):
         if not self.tiledict:
@@ -568,7 +1480,10 @@ class MyPaintSurface (TileAccessible, TileBlittable, TileCompositable):
         lib.surface.save_as_png(self, filename, *args, **kwargs)
 
     def get_bbox(self):
-        return lib.surface.get_tiles_bbox(self.tiledict)
+        tiledict = self.tiledict
+        if isinstance(tiledict, _LazyTileMap):
+            return tiledict.get_bbox()  # not loaded yet
+        return lib.surface.get_tiles_bbox(tiledict)
 
     def get_tiles(self):
         return self.tiledict
@@ -904,6 +1819,128 @@ def calc_translation_slices(dc):
         ]
 
 
+def load_png_tiles(filename, x, y, feedback_cb=None, convert_to_srgb=True,
+                   row_cb=None):
+    """Decode a PNG into new tiles, one tilerow at a time
+
+    :param filename: The file to load, or a readable file object
+    :param int x: X-coordinate at which to load the data
+    :param int y: Y-coordinate at which to load the data
+    :param callable feedback_cb: Called every few tile rows
+    :param bool convert_to_srgb: If True, convert to sRGB
+    :param callable row_cb: Called as ``row_cb(tiledict, ty)`` after
+        each tile row but the last is added to the new tiles.
+        Raising an exception from it stops decoding.
+    :returns: a snapshot holding the tiles, and the PNG's (x,y,w,h)
+    :rtype: tuple
+
+    Empty tiles are discarded. The snapshot can be loaded into a
+    surface with `MyPaintSurface.load_snapshot()`. Nothing but new
+    tiles is touched, so this may be called from worker threads, with
+    no feedback callback. Rows are decoded without holding the GIL.
+
+    Raises a `lib.errors.FileHandlingError` with a descriptive
+    string when conversion or PNG reading fails.
+
+    """
+    tiledict = _TileMap()
+
+    state = {}
+    state['buf'] = None  # array of height N, width depends on image
+    state['ty'] = y/N  # current tile row being filled into buf
+    state['frame_size'] = None
+
+    def get_buffer(png_w, png_h):
+        state['frame_size'] = x, y, png_w, png_h
+        if feedback_cb:
+            feedback_cb()
+        buf_x0 = x/N*N
+        buf_x1 = ((x+png_w-1)/N+1)*N
+        buf_y0 = state['ty']*N
+        buf_y1 = buf_y0+N
+        buf_w = buf_x1-buf_x0
+        buf_h = buf_y1-buf_y0
+        assert buf_w % N == 0
+        assert buf_h == N
+        if state['buf'] is not None:
+            consume_buf()
+            if row_cb:
+                row_cb(tiledict, state['ty']-1)
+        else:
+            state['buf'] = numpy.empty((buf_h, buf_w, 4), 'uint8')
+
+        png_x0 = x
+        png_x1 = x+png_w
+        subbuf = state['buf'][:, png_x0-buf_x0:png_x1-buf_x0]
+        if 1:  # optimize: only needed for first and last
+            state['buf'].fill(0)
+            png_y0 = max(buf_y0, y)
+            png_y1 = min(buf_y0+buf_h, y+png_h)
+            assert png_y1 > png_y0
+            subbuf = subbuf[png_y0-buf_y0:png_y1-buf_y0, :]
+
+        state['ty'] += 1
+        return subbuf
+
+    def consume_buf():
+        ty = state['ty']-1
+        for i in xrange(state['buf'].shape[1]/N):
+            tx = x/N + i
+            src = state['buf'][:, i*N:(i+1)*N, :]
+            if src[:, :, 3].any():
+                t = _Tile()
+                mypaintlib.tile_convert_rgba8_to_rgba16(src, t.rgba)
+                tiledict[(tx, ty)] = t
+
+    try:
+        if hasattr(filename, "read"):
+            flags = mypaintlib.load_png_fast_progressive_from_file(
+                filename,
+                get_buffer,
+                convert_to_srgb,
+            )
+        else:
+            if sys.platform == 'win32':
+                filename_sys = filename.encode("utf-8")
+            else:
+                filename_sys = filename.encode(sys.getfilesystemencoding())  # FIXME: should not do that, should use open(unicode_object)
+            flags = mypaintlib.load_png_fast_progressive(
+                filename_sys,
+                get_buffer,
+                convert_to_srgb,
+            )
+    except (IOError, OSError, RuntimeError) as ex:
+        raise FileHandlingError(_("PNG reader failed: %s") % str(ex))
+    if state['buf'] is not None:
+        consume_buf()  # also process the final chunk of data
+    logger.debug("PNG loader flags: %r", flags)
+
+    sshot = _SurfaceSnapshot()
+    sshot.tiledict = tiledict
+    return sshot, state['frame_size']
+
+
+def load_compressed_tiles(items):
+    """Make new tiles whose pixels are only decompressed when needed
+
+    :param iterable items: ((tx, ty), data) pairs. The data is
+        zlib-compressed pixel data, like a `TileCompressor` makes, or
+        an object whose ``read()`` method returns that.
+    :returns: a snapshot holding the tiles
+    :rtype: _SurfaceSnapshot
+
+    The snapshot can be loaded into a surface with
+    `MyPaintSurface.load_snapshot()`.
+
+    """
+    tiledict = _TileMap()
+    for pos, data in items:
+        tiledict[pos] = _Tile(compressed=data)
+    sshot = _SurfaceSnapshot()
+    sshot.tiledict = tiledict
+    return sshot
+
+
 # Set which surface backend to use
 Surface = MyPaintSurface
 
@@ -1039,14 +2076,39 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
         targ_b = 0
         targ_a = 0
 
-    # Flood-fill loop
+    # Tiles which are entirely transparent and entirely within the bbox
+    # can be filled in one go when the target color is transparent too,
+    # and they all get the same result.
+    full_tile = None
+    if targ_a == 0:
+        one = 1 << 15
+        full_tile = numpy.empty((N, N, 4), 'uint16')
+        full_tile[:, :, :3] = [
+            min(max(0, int(c * one)), one)
+            for c in (fill_r, fill_g, fill_b)
+        ]
+        full_tile[:, :, 3] = one
+        full_overflows = (
+            [(i, N-1) for i in xrange(N)],
+            [(0, i) for i in xrange(N)],
+            [(i, 0) for i in xrange(N)],
+            [(N-1, i) for i in xrange(N)],
+        )
+
+    # Flood-fill loop. Seeds are collected per tile while it's waiting
+    # in the queue, so that each visit handles all the seeds which have
+    # reached it so far.
     filled = {}
-    tileq = [
-        ((tx, ty),
-         [(px, py)])
-    ]
-    while len(tileq) > 0:
-        (tx, ty), seeds = tileq.pop(0)
+    full = set()
+    scratch = None
+    tileq = deque([(tx, ty)])
+    tile_seeds = {(tx, ty): [(px, py)]}
+    while tileq:
+        tpos = tileq.popleft()
+        seeds = tile_seeds.pop(tpos)
+        if tpos in full:
+            continue
+        tx, ty = tpos
         # Bbox-derived limits
         if tx > max_tx or ty > max_ty:
             continue
@@ -1066,33 +2128,48 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
             max_x = max_px
         if ty == max_ty:
             max_y = max_py
+        is_whole = (min_x, min_y, max_x, max_y) == (0, 0, N-1, N-1)
         # Flood-fill one tile
         with src.tile_request(tx, ty, readonly=True) as src_tile:
-            dst_tile = filled.get((tx, ty), None)
-            if dst_tile is None:
-                dst_tile = numpy.zeros((N, N, 4), 'uint16')
-                filled[(tx, ty)] = dst_tile
-            overflows = mypaintlib.tile_flood_fill(
-                src_tile, dst_tile, seeds,
-                targ_r, targ_g, targ_b, targ_a,
-                fill_r, fill_g, fill_b,
-                min_x, min_y, max_x, max_y,
-                tolerance
-            )
+            if (full_tile is not None and is_whole
+                    and src_tile is transparent_tile.rgba
+                    and tpos not in filled):
+                filled[tpos] = full_tile
+                full.add(tpos)
+                overflows = full_overflows
+            else:
+                # Tiles are filled into a scratch array until they're
+                # known to be touched, so they can be skipped otherwise.
+                dst_tile = filled.get(tpos, None)
+                if dst_tile is None:
+                    if scratch is None:
+                        scratch = numpy.zeros((N, N, 4), 'uint16')
+                    dst_tile = scratch
+                overflows = mypaintlib.tile_flood_fill(
+                    src_tile, dst_tile, seeds,
+                    targ_r, targ_g, targ_b, targ_a,
+                    fill_r, fill_g, fill_b,
+                    min_x, min_y, max_x, max_y,
+                    tolerance
+                )
+                if dst_tile is scratch and scratch[:, :, 3].any():
+                    filled[tpos] = scratch
+                    scratch = None
             seeds_n, seeds_e, seeds_s, seeds_w = overflows
         # Enqueue overflows in each cardinal direction
-        if seeds_n and ty > min_ty:
-            tpos = (tx, ty-1)
-            tileq.append((tpos, seeds_n))
-        if seeds_w and tx > min_tx:
-            tpos = (tx-1, ty)
-            tileq.append((tpos, seeds_w))
-        if seeds_s and ty < max_ty:
-            tpos = (tx, ty+1)
-            tileq.append((tpos, seeds_s))
-        if seeds_e and tx < max_tx:
-            tpos = (tx+1, ty)
-            tileq.append((tpos, seeds_e))
+        for seeds, tpos, in_bbox in [
+                (seeds_n, (tx, ty-1), ty > min_ty),
+                (seeds_w, (tx-1, ty), tx > min_tx),
+                (seeds_s, (tx, ty+1), ty < max_ty),
+                (seeds_e, (tx+1, ty), tx < max_tx)]:
+            if not (seeds and in_bbox) or tpos in full:
+                continue
+            queued_seeds = tile_seeds.get(tpos, None)
+            if queued_seeds is None:
+                tile_seeds[tpos] = list(seeds)
+                tileq.append(tpos)
+            else:
+                queued_seeds.extend(seeds)
 
     # Composite filled tiles into the destination surface
     mode = mypaintlib.CombineNormal
@@ -1154,6 +2231,9 @@ class PNGFileUpdateTask (object):
         if not (self._png_writer and self._strips_iter):
             raise RuntimeError("Called too many times")
         try:
+            # Rendering holds the GIL only briefly for each tile, and
+            # the writer releases it while encoding the strip, so this
+            # can run in lib.autosave.Writer's thread while painting.
             strip = self._strips_iter.next()
             self._png_writer.write(strip)
             return True
@@ -0,0 +1,524 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by Andrew Chadwick <a.t.chadwick@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Tile index files: layer tiles stored for random access
+
+PNGs can only be decoded from start to finish, so getting at any one
+tile of a layer PNG means decoding all of it, and changing one tile
+means encoding it all again. Alongside its PNG, a layer can also be
+saved as a tile index file, which holds the pixels of each tile
+compressed separately, plus an index saying where each tile is. Any
+tile can then be read without touching the others, and the file can
+be updated by appending just the tiles which have changed.
+
+    >>> import tempfile, shutil
+    >>> import lib.tiledsurface
+    >>> s = lib.tiledsurface.Surface()
+    >>> for tx in (0, 1, 2):
+    ...     with s.tile_request(tx, 0, readonly=False) as rgba:
+    ...         rgba[...] = tx << 12
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> filename = os.path.join(tmpdir, "layer.tiles")
+    >>> update_file(filename, s.tiledict, None, (0, 0), png_crc=1234)
+
+The tiles can be loaded from it into another surface, wherever the
+layer's PNG would have been loaded. Only the index is read when they
+are loaded, and each tile's pixels are only read when it's used.
+
+    >>> index = open_file(filename)
+    >>> index.png_crc, len(index)
+    (1234, 3)
+    >>> s2 = lib.tiledsurface.Surface()
+    >>> s2.load_snapshot(index.load_tiles(N, 0))
+    >>> sorted(s2.tiledict.keys())
+    [(1, 0), (2, 0), (3, 0)]
+    >>> with s2.tile_request(3, 0, readonly=True) as rgba:
+    ...     int(rgba[0, 0, 0]) == 2 << 12
+    True
+
+Updates only append the tiles which changed since the last write,
+followed by a new index. The old tile data stays where it is, so
+tiles still to be read from the file aren't disturbed.
+
+    >>> sshot = s.save_snapshot()
+    >>> with s.tile_request(5, 5, readonly=False) as rgba:
+    ...     rgba[...] = 1 << 15
+    >>> changed = sshot.tiledict.get_changed_keys(s.tiledict)
+    >>> update_file(filename, s.tiledict, changed, (0, 0), png_crc=5678)
+    >>> index = open_file(filename)
+    >>> index.png_crc, len(index)
+    (5678, 4)
+    >>> with s2.tile_request(2, 0, readonly=True) as rgba:
+    ...     int(rgba[0, 0, 0]) == 1 << 12
+    True
+
+Each update leaves the previous index in place, so if one is cut
+short, e.g. by a crash, the last complete index in the file is used.
+This makes the file a journal which can be replayed up to the last
+update which was fully written.
+
+    >>> with open(filename, "ab") as fp:
+    ...     fp.write("\0" * 100)
+    >>> index = open_file(filename)
+    >>> index.png_crc, len(index)
+    (5678, 4)
+
+Detaching an index reads it all into memory, so that its tiles don't
+need the file any more, e.g. before it's replaced.
+
+    >>> s3 = lib.tiledsurface.Surface()
+    >>> s3.load_snapshot(index.load_tiles(0, 0))
+    >>> index.detach()
+    >>> with s3.tile_request(5, 5, readonly=True) as rgba:
+    ...     int(rgba[0, 0, 0]) == 1 << 15
+    True
+    >>> shutil.rmtree(tmpdir)
+
+File layout: the compressed tiles come first, in any order. Then comes
+the index, with an entry for each tile giving its position and where
+its data is. A fixed-size footer at the very end says where the index
+starts. Each tile's data is its 16-bit premultiplied RGBA pixels,
+little-endian, compressed with zlib. That's the same as tiles
+compressed in memory by a `lib.tiledsurface.TileCompressor`, so those
+can be written out as they are.
+
+"""
+
+
+## Imports
+
+import os
+import sys
+import zlib
+import struct
+import threading
+from cStringIO import StringIO
+import logging
+logger = logging.getLogger(__name__)
+
+import lib.tiledsurface
+import lib.fileutils
+from lib.tiledsurface import N
+
+
+## Constants
+
+#: File identifier, at the very end of the footer
+MAGIC = "MYPTILES"
+
+#: Current version of the file format
+VERSION = 1
+
+#: zlib level for tiles which aren't already compressed
+COMPRESSION_LEVEL = 1
+
+#: Footer: version, tile size, CRC-32 of the PNG the tiles match,
+#: PNG origin (x, y), offset of the index, number of entries, magic.
+_FOOTER_FORMAT = ">IIIiiQI8s"
+_FOOTER_SIZE = struct.calcsize(_FOOTER_FORMAT)
+
+#: Index entry: tile position (tx, ty), data offset, data length
+_ENTRY_FORMAT = ">iiQI"
+_ENTRY_SIZE = struct.calcsize(_ENTRY_FORMAT)
+
+#: Tile data is only used as it is on little-endian hosts
+_LITTLE_ENDIAN = (sys.byteorder == "little")
+
+#: Updates rewrite the file if it would waste more than this,
+#: and more than the size of the live tile data.
+_MAX_WASTED_BYTES = 1024 * 1024
+
+#: Block size for searching back through a file for an earlier index
+_RECOVERY_BLOCK_SIZE = 1024 * 1024
+
+
+## Class defs
+
+
+class InvalidTileIndex (Exception):
+    """Raised when a tile index can't be used
+
+    Callers are expected to fall back to the layer's PNG.
+
+    """
+
+
+class TileIndexWriter (object):
+    """Writes a tile index file, or appends to an existing one"""
+
+    def __init__(self, fp, origin, offset=0, entries=None):
+        """Initialize
+
+        :param fp: writable file-like object, positioned at `offset`
+        :param tuple origin: (x, y) of the top left of the layer's PNG
+        :param int offset: where in the file the first data will go
+        :param dict entries: {(tx, ty): (offset, length)} for tiles
+            already in the file, when appending.
+
+        """
+        super(TileIndexWriter, self).__init__()
+        self._fp = fp
+        self._origin = tuple(origin)
+        self._offset = offset
+        self._entries = dict(entries or {})
+
+    @property
+    def live_bytes(self):
+        """Size of the tile data which the index refers to"""
+        return sum(length for (offset, length) in self._entries.values())
+
+    def write_tiles(self, tiledict, positions=None):
+        """Writes the data of tiles
+
+        :param tiledict: the tiles, as a `lib.tiledsurface._TileMap`
+        :param iterable positions: which tiles to write, default all.
+            Positions without a tile are removed from the index.
+
+        This may be called from a worker thread, if the tiles won't
+        be written to meanwhile, e.g. if they are from a snapshot.
+
+        """
+        if positions is None:
+            positions = tiledict.keys()
+        for pos in positions:
+            tile = tiledict.get(pos)
+            if tile is None:
+                self._entries.pop(pos, None)
+                continue
+            data = _get_compressed_data(tile)
+            self._fp.write(data)
+            self._entries[pos] = (self._offset, len(data))
+            self._offset += len(data)
+
+    def finish(self, png_crc):
+        """Writes the index and footer
+
+        :param int png_crc: CRC-32 of the PNG which the tiles match
+
+        """
+        index_offset = self._offset
+        entries = sorted(self._entries.iteritems())
+        chunks = [
+            struct.pack(_ENTRY_FORMAT, tx, ty, offset, length)
+            for ((tx, ty), (offset, length)) in entries
+        ]
+        x, y = self._origin
+        chunks.append(struct.pack(
+            _FOOTER_FORMAT,
+            VERSION, N,
+            png_crc & 0xffffffff,
+            x, y,
+            index_offset, len(entries),
+            MAGIC,
+        ))
+        data = "".join(chunks)
+        self._fp.write(data)
+        self._offset += len(data)
+
+
+class TileIndex (object):
+    """An open tile index, whose tiles can be read in any order
+
+    Only the footer is read when this is created. Tiles loaded from it
+    keep it open, and their data is read back through it (from any
+    thread) when they are first used.
+
+    """
+
+    def __init__(self, fp, base=0, size=None, lock=None, name=None):
+        """Initialize, and check the footer
+
+        :param fp: seekable, readable file-like object
+        :param int base: where the tile index data starts in `fp`
+        :param int size: size of the tile index data, default: to EOF
+        :param threading.Lock lock: held while using `fp`
+        :param unicode name: for messages
+        :raises InvalidTileIndex: if the data isn't a usable index
+
+        """
+        super(TileIndex, self).__init__()
+        if lock is None:
+            lock = threading.Lock()
+        self._fp = fp
+        self._base = base
+        self._lock = lock
+        self._name = name
+        if size is None:
+            with lock:
+                fp.seek(0, os.SEEK_END)
+                size = fp.tell() - base
+        self.size = size
+        if not _LITTLE_ENDIAN:
+            raise InvalidTileIndex("not supported on big-endian hosts")
+        if size < _FOOTER_SIZE:
+            raise InvalidTileIndex("too small")
+        footer = self.read(size - _FOOTER_SIZE, _FOOTER_SIZE)
+        (version, tile_size, png_crc, x, y,
+         index_offset, count, magic) = struct.unpack(_FOOTER_FORMAT, footer)
+        if magic != MAGIC:
+            raise InvalidTileIndex("bad magic number")
+        if version != VERSION:
+            raise InvalidTileIndex("unsupported version %d" % (version,))
+        if tile_size != N:
+            raise InvalidTileIndex("tile size is %d" % (tile_size,))
+        if index_offset + count * _ENTRY_SIZE != size - _FOOTER_SIZE:
+            raise InvalidTileIndex("bad index offset")
+        self.png_crc = png_crc
+        self.origin = (x, y)
+        self._index_offset = index_offset
+        self._count = count
+
+    def __repr__(self):
+        return "<TileIndex %r tiles=%d>" % (self._name, self._count)
+
+    def __len__(self):
+        return self._count
+
+    def read(self, offset, length):
+        """Returns data from the tile index (any thread)"""
+        with self._lock:
+            self._fp.seek(self._base + offset)
+            data = self._fp.read(length)
+        if len(data) != length:
+            raise InvalidTileIndex("truncated")
+        return data
+
+    def detach(self):
+        """Reads all of the tile index into memory, to stop using the file
+
+        Tiles still to be read are read from memory afterwards.
+
+        """
+        with self._lock:
+            self._fp.seek(self._base)
+            self._fp = StringIO(self._fp.read(self.size))
+            self._base = 0
+
+    def get_entries(self):
+        """Reads the index
+
+        :returns: {(tx, ty): (offset, length)}
+        :rtype: dict
+
+        """
+        data = self.read(self._index_offset, self._count * _ENTRY_SIZE)
+        entries = {}
+        for i in xrange(self._count):
+            tx, ty, offset, length = struct.unpack_from(
+                _ENTRY_FORMAT, data, i * _ENTRY_SIZE,
+            )
+            if offset + length > self._index_offset:
+                raise InvalidTileIndex("bad entry for %r" % ((tx, ty),))
+            entries[(tx, ty)] = (offset, length)
+        return entries
+
+    def load_tiles(self, x, y, png_crc=None):
+        """Returns a snapshot of the tiles, placed as the PNG would be
+
+        :param int x: X-coordinate at which the PNG would be loaded
+        :param int y: Y-coordinate at which the PNG would be loaded
+        :param int png_crc: CRC-32 of the PNG, to check against
+        :returns: a snapshot for `MyPaintSurface.load_snapshot()`
+        :raises InvalidTileIndex: if the PNG has changed since the
+            index was written, or if it would not land on tile
+            boundaries.
+
+        No tile data is read yet.
+
+        """
+        if png_crc is not None and (png_crc & 0xffffffff) != self.png_crc:
+            raise InvalidTileIndex("PNG has changed")
+        dx = x - self.origin[0]
+        dy = y - self.origin[1]
+        if dx % N or dy % N:
+            raise InvalidTileIndex("not on the tile grid at %+d%+d" % (x, y))
+        dtx = dx // N
+        dty = dy // N
+        items = [
+            ((tx + dtx, ty + dty), _TileExtent(self, offset, length))
+            for ((tx, ty), (offset, length)) in self.get_entries().iteritems()
+        ]
+        return lib.tiledsurface.load_compressed_tiles(items)
+
+
+class _TileExtent (object):
+    """Where a tile's compressed pixel data lives in a TileIndex
+
+    These are stored in a tile's ``_compressed`` slot, like the extents
+    of a `lib.tileswap.TileSwap`.
+
+    """
+
+    __slots__ = ("_index", "_offset", "_length")
+
+    def __init__(self, index, offset, length):
+        self._index = index
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self):
+        """Returns the compressed data"""
+        return self._index.read(self._offset, self._length)
+
+
+## Helper functions
+
+
+def _get_compressed_data(tile):
+    """Returns a tile's pixels, compressed for a tile index"""
+    data = tile._compressed
+    if _LITTLE_ENDIAN and data is not None:
+        if isinstance(data, str):
+            return data  # compressed in memory, by a TileCompressor
+        return data.read()  # swapped out to disk, or in a tile index
+    rgba = tile.rgba
+    if not _LITTLE_ENDIAN:
+        rgba = rgba.astype("<u2")
+    return zlib.compress(rgba.tostring(), COMPRESSION_LEVEL)
+
+
+def open_file(filename):
+    """Opens a tile index file for reading
+
+    :rtype: TileIndex
+    :raises InvalidTileIndex: if the file isn't a usable index
+    :raises IOError: if the file can't be opened
+
+    The file stays open until nothing refers to it or its tiles. If
+    the last update to it was never finished, the newest complete
+    index before it is used.
+
+    """
+    fp = open(filename, "rb")
+    try:
+        return TileIndex(fp, name=filename)
+    except InvalidTileIndex as err:
+        index = _find_previous_index(fp, filename)
+        if index is None:
+            raise
+        logger.warning(
+            "Using an earlier index in %r (%s): %d bytes ignored",
+            filename, err, os.fstat(fp.fileno()).st_size - index.size,
+        )
+        return index
+
+
+def _find_previous_index(fp, name):
+    """Searches back through a file for its last complete index
+
+    :returns: the index, or None if there isn't one
+    :rtype: TileIndex
+
+    """
+    fp.seek(0, os.SEEK_END)
+    end = fp.tell()
+    pos = end
+    overlap = ""
+    while pos > 0:
+        start = max(0, pos - _RECOVERY_BLOCK_SIZE)
+        fp.seek(start)
+        block = fp.read(pos - start) + overlap
+        i = len(block)
+        while True:
+            i = block.rfind(MAGIC, 0, i)
+            if i < 0:
+                break
+            size = start + i + len(MAGIC)
+            if size < end:
+                try:
+                    index = TileIndex(fp, size=size, name=name)
+                    index.get_entries()
+                    return index
+                except InvalidTileIndex:
+                    pass
+            i += len(MAGIC) - 1
+        overlap = block[:len(MAGIC) - 1]
+        pos = start
+    return None
+
+
+def file_crc(filename):
+    """Returns the CRC-32 of a file's contents, e.g. a layer's PNG"""
+    crc = 0
+    with open(filename, "rb") as fp:
+        while True:
+            data = fp.read(1024 * 1024)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+    return crc & 0xffffffff
+
+
+def update_file(filename, tiledict, changed, origin, png_crc):
+    """Writes a tile index file, or updates it in place
+
+    :param unicode filename: the file to update
+    :param tiledict: all of the layer's tiles
+    :param iterable changed: positions of tiles which changed since
+        the file was last written, or None to rewrite it completely
+    :param tuple origin: (x, y) of the top left of the layer's PNG
+    :param int png_crc: CRC-32 of the layer's PNG
+
+    Updates append the changed tiles and a new index to the existing
+    file. If that can't be done, or if too much space would be wasted
+    by tiles which are no longer used, the whole file is rewritten
+    atomically instead.
+
+    """
+    if changed is not None:
+        try:
+            if _append_to_file(filename, tiledict, changed, origin, png_crc):
+                return
+        except (IOError, OSError, InvalidTileIndex) as err:
+            logger.warning("Rewriting %r: %s", filename, err)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as fp:
+        writer = TileIndexWriter(fp, origin)
+        writer.write_tiles(tiledict)
+        writer.finish(png_crc)
+    lib.fileutils.replace(tmp_filename, filename)
+
+
+def _append_to_file(filename, tiledict, changed, origin, png_crc):
+    """Appends changed tiles to a tile index file
+
+    :returns: False if the file should be rewritten instead
+
+    """
+    with open(filename, "r+b") as fp:
+        index = TileIndex(fp, name=filename)
+        writer = TileIndexWriter(
+            fp, origin,
+            offset = index.size,
+            entries = index.get_entries(),
+        )
+        wasted = index.size - writer.live_bytes
+        if wasted > max(_MAX_WASTED_BYTES, writer.live_bytes):
+            return False
+        fp.seek(index.size)
+        writer.write_tiles(tiledict, changed)
+        writer.finish(png_crc)
+    return True
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
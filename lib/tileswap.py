@@ -0,0 +1,429 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by Andrew Chadwick <a.t.chadwick@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Disk-backed swap space for tiles only needed by the undo history
+
+Tiles which are only referenced by old undo steps can be written out
+to a memory-mapped swap file, freeing their pixel memory. The tiles
+themselves stay where they are, in the snapshots holding them, so the
+swap is completely transparent: accessing a swapped-out tile's
+``rgba`` reads it back in again, typically during an undo.
+
+    >>> import lib.tiledsurface
+    >>> swap = TileSwap()
+    >>> t = lib.tiledsurface._Tile()
+    >>> t.rgba[...] = 1 << 15
+    >>> t.atime -= 60
+    >>> swap.spill([t])
+    1
+    >>> "rgba" in t.__dict__
+    False
+    >>> swap.stats.extents
+    1
+    >>> int(t.rgba.min())
+    32768
+    >>> swap.stats.extents
+    0
+
+Space freed by tiles which were read back or discarded is reused for
+later writes, so the file only grows to the peak amount of swapped
+data. Tiles can also be spilled by a thread belonging to the swap.
+
+    >>> tiles = [lib.tiledsurface._Tile() for i in xrange(3)]
+    >>> for i, t in enumerate(tiles):
+    ...     t.rgba[...] = i
+    ...     t.atime -= 60
+    >>> swap.spill(tiles)
+    3
+    >>> size = swap.stats.file_bytes
+    >>> int(tiles[1].rgba.max())
+    1
+    >>> swap.stats.free_bytes > 0
+    True
+    >>> tiles[1].atime -= 60
+    >>> swap.spill_in_background([tiles[1]])
+    >>> swap.join()
+    >>> swap.stats.free_bytes, swap.stats.file_bytes == size
+    (0, True)
+
+"""
+
+
+## Imports
+
+import mmap
+import time
+import tempfile
+import threading
+import zlib
+import bisect
+from collections import namedtuple
+from collections import deque
+import logging
+logger = logging.getLogger(__name__)
+
+
+## Class defs
+
+
+TileSwapStats = namedtuple("TileSwapStats", [
+    "extents",
+    "live_bytes",
+    "file_bytes",
+    "free_bytes",
+    "spilled",
+    "loaded",
+])
+
+
+class _SwapExtent (object):
+    """Where a tile's compressed pixel data lives in a TileSwap
+
+    These are stored in a tile's ``_compressed`` slot in place of the
+    in-memory compressed data. The space is released when the extent
+    is garbage collected, i.e. when its tile is read back or dies.
+    Collection can happen at any point, even while the swap is in the
+    middle of updating its free list, so the release is only queued
+    here, and carried out by the swap later.
+
+    """
+
+    __slots__ = ("_swap", "_offset", "_length")
+
+    def __init__(self, swap, offset, length):
+        self._swap = swap
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __del__(self):
+        self._swap._pending_releases.append((self._offset, self._length))
+
+    def read(self):
+        """Returns the compressed data"""
+        return self._swap._read(self._offset, self._length)
+
+
+class TileSwap (object):
+    """Memory-mapped swap file for tile data
+
+    The backing file is an anonymous temporary file, so it never
+    outlives the process and never needs explicit removal. Space which
+    is no longer used is kept in a free list, and reused by later
+    writes which fit. The file is truncated back to nothing whenever
+    all the data written to it has been read back or discarded.
+
+    """
+
+    #: Tiles used more recently than this are never swapped out
+    MIN_IDLE_SECONDS = 10.0
+
+    #: zlib level for tiles not already compressed in memory
+    COMPRESSION_LEVEL = 1
+
+    #: Background spills pause after writing this many tiles
+    CHUNK_SIZE = 16
+
+    #: Seconds to pause for, so that the main thread gets the
+    #: interpreter lock back often while painting.
+    CHUNK_PAUSE = 0.001
+
+    def __init__(self, dirname=None):
+        """Initialize
+
+        :param unicode dirname: Where to create the swap file
+
+        The swap file is created lazily, when it's first needed.
+
+        """
+        super(TileSwap, self).__init__()
+        self._dirname = dirname
+        self._fp = None
+        self._map = None
+        self._unflushed = False
+        self._end = 0
+        self._free = []  # sorted (length, offset) pairs
+        self._free_starts = {}  # {offset: length}
+        self._free_ends = {}  # {offset+length: offset}
+        self._free_bytes = 0
+        self._extents = 0
+        self._live_bytes = 0
+        self._spilled = 0
+        self._loaded = 0
+        self._pending_releases = deque()  # (offset, length), see _release
+        self._lock = threading.RLock()
+        # Background spilling
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._busy = False
+        self._stopping = False
+        self._thread = None
+
+    def __repr__(self):
+        return "<TileSwap %r extents=%d size=%d>" % (
+            self._dirname,
+            self._extents,
+            self._end,
+        )
+
+    @property
+    def stats(self):
+        """Current swap usage, and running totals
+
+        :rtype: TileSwapStats
+
+        """
+        with self._lock:
+            self._release_pending()
+            return TileSwapStats(
+                extents = self._extents,
+                live_bytes = self._live_bytes,
+                file_bytes = self._end,
+                free_bytes = self._free_bytes,
+                spilled = self._spilled,
+                loaded = self._loaded,
+            )
+
+    ## Swapping out
+
+    def spill(self, tiles, now=None, pause=False):
+        """Write tiles out to the swap file, freeing their pixels
+
+        :param iterable tiles: lib.tiledsurface._Tile objects to spill
+        :param float now: Current time.time(), for testing
+        :param bool pause: Pause briefly between chunks of tiles
+        :returns: The number of tiles swapped out
+        :rtype: int
+
+        Tiles which have been used recently, or which are already
+        swapped out, are skipped. This can be called from any thread:
+        tiles used while being spilled keep their pixels in memory.
+
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - self.MIN_IDLE_SECONDS
+        n = 0
+        for i, tile in enumerate(tiles):
+            if pause and i and i % self.CHUNK_SIZE == 0:
+                time.sleep(self.CHUNK_PAUSE)
+            atime = tile.atime
+            old = tile.__dict__.get("rgba")
+            if old is not None:
+                if atime > cutoff:
+                    continue
+                data = zlib.compress(old.tostring(), self.COMPRESSION_LEVEL)
+            else:
+                old = data = tile._compressed
+                if not isinstance(data, str):
+                    continue  # marker tiles, or already swapped out
+            if tile._pack(self._write(data), old, atime):
+                n += 1
+        if n:
+            logger.debug("%r: spilled %d tiles", self, n)
+        return n
+
+    def spill_in_background(self, tiles):
+        """Queue tiles to be spilled by a thread of the swap's own
+
+        :param iterable tiles: lib.tiledsurface._Tile objects to spill
+
+        The tiles are spilled in the order queued, with `spill()`.
+
+        """
+        tiles = list(tiles)
+        if not tiles:
+            return
+        with self._cond:
+            self._queue.append(tiles)
+            self._stopping = False
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target = self._thread_loop,
+                    name = "tileswap",
+                )
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def stop(self):
+        """Drop queued background spills, and wait for the current one
+
+        The spiller thread exits too, so nothing keeps the swap alive.
+
+        """
+        with self._cond:
+            self._queue.clear()
+            self._stopping = True
+            self._cond.notify_all()
+            while self._busy:
+                self._cond.wait()
+
+    def join(self):
+        """Wait until all queued background spills are done"""
+        with self._cond:
+            while self._busy or self._queue:
+                self._cond.wait()
+
+    def _thread_loop(self):
+        """Spill queued tiles forever (spiller thread)"""
+        while True:
+            with self._cond:
+                while not (self._queue or self._stopping):
+                    self._cond.wait()
+                if not self._queue:
+                    self._thread = None
+                    return
+                tiles = self._queue.popleft()
+                self._busy = True
+            try:
+                self.spill(tiles, pause=True)
+            except Exception:
+                logger.exception("%r: background spill failed", self)
+            finally:
+                tiles = None
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _write(self, data):
+        with self._lock:
+            self._release_pending()
+            if self._fp is None:
+                self._fp = tempfile.TemporaryFile(
+                    prefix = "tileswap",
+                    dir = self._dirname,
+                )
+            offset = self._allocate(len(data))
+            self._fp.seek(offset)
+            self._fp.write(data)
+            self._unflushed = True
+            self._extents += 1
+            self._live_bytes += len(data)
+            self._spilled += 1
+            return _SwapExtent(self, offset, len(data))
+
+    ## Space management
+
+    def _allocate(self, length):
+        """Find space for data, preferring the best free fit (lock held)"""
+        free = self._free
+        i = bisect.bisect_left(free, (length, -1))
+        if i == len(free):
+            offset = self._end
+            self._end += length
+            return offset
+        free_length, offset = free[i]
+        self._remove_free(offset, free_length)
+        if free_length > length:
+            self._add_free(offset + length, free_length - length)
+        return offset
+
+    def _add_free(self, offset, length):
+        """Record free space, merging it with neighbours (lock held)"""
+        end = offset + length
+        next_length = self._free_starts.get(end)
+        if next_length is not None:
+            self._remove_free(end, next_length)
+            length += next_length
+            end += next_length
+        prev_offset = self._free_ends.get(offset)
+        if prev_offset is not None:
+            prev_length = self._free_starts[prev_offset]
+            self._remove_free(prev_offset, prev_length)
+            offset = prev_offset
+            length += prev_length
+        if end == self._end:
+            self._end = offset  # later writes overwrite the tail
+            return
+        bisect.insort(self._free, (length, offset))
+        self._free_starts[offset] = length
+        self._free_ends[end] = offset
+        self._free_bytes += length
+
+    def _remove_free(self, offset, length):
+        """Stop recording some free space (lock held)"""
+        i = bisect.bisect_left(self._free, (length, offset))
+        del self._free[i]
+        del self._free_starts[offset]
+        del self._free_ends[offset + length]
+        self._free_bytes -= length
+
+    ## Reading back
+
+    def _read(self, offset, length):
+        with self._lock:
+            if self._map is None or len(self._map) < offset + length:
+                self._remap()
+            elif self._unflushed:
+                self._fp.flush()  # the map shares the file's pages
+                self._unflushed = False
+            self._loaded += 1
+            return self._map[offset:offset+length]
+
+    def _remap(self):
+        """Map the whole of the file written so far (lock held)"""
+        if self._map is not None:
+            self._map.close()
+        self._fp.flush()
+        self._unflushed = False
+        self._map = mmap.mmap(
+            self._fp.fileno(),
+            self._end,
+            access = mmap.ACCESS_READ,
+        )
+
+    def _release_pending(self):
+        """Free the space of extents which were cleaned up (lock held)
+
+        Extents only queue their release when they are finalized, and
+        it's done here instead. Any which are finalized while this
+        runs are added to the queue and handled in the same loop.
+
+        """
+        pending = self._pending_releases
+        while pending:
+            offset, length = pending.popleft()
+            self._release(offset, length)
+
+    def _release(self, offset, length):
+        """Free an extent's space (lock held)"""
+        self._extents -= 1
+        self._live_bytes -= length
+        if self._extents > 0:
+            self._add_free(offset, length)
+            return
+        # Nothing refers to the file's contents any more
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fp is not None:
+            self._fp.seek(0)
+            self._fp.truncate()
+        self._end = 0
+        self._free = []
+        self._free_starts.clear()
+        self._free_ends.clear()
+        self._free_bytes = 0
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
@@ -0,0 +1,212 @@
+# This file is part of MyPaint.
+# Copyright (C) 2015 by Andrew Chadwick <a.t.chadwick@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+
+"""Simple pool of worker threads, for independent chunks of work.
+
+This is the threaded counterpart of `lib.idletask`. Work submitted to a
+pool runs outside the main thread, so it must not touch GTK, and it
+must only read model data which nothing else is modifying at the time.
+Tiles from frozen layer trees or from snapshots are fine.
+
+Compiled code and zlib only run truly in parallel when they release
+the GIL, so pools help most for coarse-grained jobs.
+
+"""
+
+
+## Imports
+
+import sys
+import threading
+import Queue
+import logging
+logger = logging.getLogger(__name__)
+
+
+## Class defs
+
+
+class Job (object):
+    """Handle for a unit of work submitted to a WorkerPool
+
+    Jobs are a cut-down version of the futures in later Pythons.
+    Waiting on a job returns the callable's result,
+    or re-raises its exception in the waiting thread.
+
+    >>> pool = WorkerPool(2)
+    >>> job = pool.submit(sum, [1, 2, 3])
+    >>> job.wait()
+    6
+    >>> job.done()
+    True
+    >>> pool.shutdown()
+
+    """
+
+    def __init__(self, func, args, kwargs):
+        super(Job, self).__init__()
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._finished = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def _run(self):
+        """Runs the payload (worker thread)"""
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._func = self._args = self._kwargs = None
+            self._finished.set()
+
+    def done(self):
+        """True if the job has finished running"""
+        return self._finished.is_set()
+
+    def join(self, timeout=None):
+        """Waits for the job to finish, or for a timeout in seconds
+
+        :returns: whether the job has finished
+        :rtype: bool
+
+        Unlike `wait()`, this never raises the job's exception.
+
+        """
+        self._finished.wait(timeout)
+        return self._finished.is_set()
+
+    def wait(self):
+        """Waits for the job to finish, and returns its result"""
+        self._finished.wait()
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+        return self._result
+
+
+class WorkerPool (object):
+    """Fixed-size pool of daemon worker threads
+
+    Threads are started lazily, on the first submission.
+
+    >>> pool = WorkerPool(3)
+    >>> pool.map(lambda x: x*x, range(5))
+    [0, 1, 4, 9, 16]
+    >>> pool.shutdown()
+
+    Exceptions raised by the work propagate to the waiting caller.
+
+    >>> pool = WorkerPool(2)
+    >>> pool.map(lambda x: 1/x, [1, 0])
+    Traceback (most recent call last):
+    ...
+    ZeroDivisionError: integer division or modulo by zero
+    >>> pool.shutdown()
+
+    """
+
+    _STOP = object()
+
+    def __init__(self, size, name="worker"):
+        """Initialize, with a number of worker threads
+
+        :param int size: Number of worker threads (at least 1)
+        :param str name: Prefix for thread names, for debugging
+
+        """
+        super(WorkerPool, self).__init__()
+        self._size = max(1, int(size))
+        self._name = name
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<WorkerPool %r size=%d>" % (self._name, self._size)
+
+    @property
+    def size(self):
+        """Number of worker threads in the pool"""
+        return self._size
+
+    def _start_threads(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in xrange(self._size):
+                thread = threading.Thread(
+                    target = self._worker_loop,
+                    name = "%s-%d" % (self._name, i),
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            logger.debug("%r: started", self)
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            if job is self._STOP:
+                break
+            job._run()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a callable for running in a worker thread
+
+        :returns: a handle for the queued work
+        :rtype: Job
+
+        """
+        if not self._threads:
+            self._start_threads()
+        job = Job(func, args, kwargs)
+        self._queue.put(job)
+        return job
+
+    def map(self, func, items):
+        """Run a callable over items in parallel, waiting for all
+
+        :returns: results, in the same order as `items`
+        :rtype: list
+
+        All jobs are allowed to complete before any exception
+        raised by them is re-raised here.
+
+        """
+        jobs = [self.submit(func, item) for item in items]
+        for job in jobs:
+            job._finished.wait()
+        return [job.wait() for job in jobs]
+
+    def shutdown(self):
+        """Stop the worker threads after pending work has run"""
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+            for thread in threads:
+                self._queue.put(self._STOP)
+        for thread in threads:
+            thread.join()
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    _test()
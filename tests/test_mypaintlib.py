@@ -126,6 +126,131 @@ def brushPaint():
     s.save_as_png('test_brushPaint.png')
 
 
+def _flood_fill_reference(src, x, y, color, bbox, tolerance, dst):
+    # The original one-seed-batch-per-visit flood fill, without the
+    # shortcuts tiledsurface.flood_fill() takes. Fills into dst.
+    N = mypaintlib.TILE_SIZE
+    fill_r, fill_g, fill_b = color
+    bbx, bby, bbw, bbh = bbox
+    min_tx, min_ty = bbx // N, bby // N
+    max_tx, max_ty = (bbx+bbw-1) // N, (bby+bbh-1) // N
+    min_px, min_py = bbx % N, bby % N
+    max_px, max_py = (bbx+bbw-1) % N, (bby+bbh-1) % N
+    tx, ty = x // N, y // N
+    with src.tile_request(tx, ty, readonly=True) as start:
+        targ = [int(c) for c in start[y % N][x % N]]
+    if targ[3] == 0:
+        targ = [0, 0, 0, 0]
+    filled = {}
+    tileq = [((tx, ty), [(x % N, y % N)])]
+    while tileq:
+        (tx, ty), seeds = tileq.pop(0)
+        if not (min_tx <= tx <= max_tx and min_ty <= ty <= max_ty):
+            continue
+        limits = [
+            min_px if tx == min_tx else 0,
+            min_py if ty == min_ty else 0,
+            max_px if tx == max_tx else N-1,
+            max_py if ty == max_ty else N-1,
+        ]
+        with src.tile_request(tx, ty, readonly=True) as src_tile:
+            dst_tile = filled.setdefault(
+                (tx, ty),
+                numpy.zeros((N, N, 4), 'uint16'),
+            )
+            overflows = mypaintlib.tile_flood_fill(
+                src_tile, dst_tile, seeds,
+                targ[0], targ[1], targ[2], targ[3],
+                fill_r, fill_g, fill_b,
+                limits[0], limits[1], limits[2], limits[3],
+                tolerance
+            )
+        seeds_n, seeds_e, seeds_s, seeds_w = overflows
+        for seeds, tpos in [(seeds_n, (tx, ty-1)), (seeds_w, (tx-1, ty)),
+                            (seeds_s, (tx, ty+1)), (seeds_e, (tx+1, ty))]:
+            if seeds:
+                tileq.append((tpos, seeds))
+    for (tx, ty), src_tile in filled.iteritems():
+        with dst.tile_request(tx, ty, readonly=False) as dst_tile:
+            mypaintlib.tile_combine(mypaintlib.CombineNormal,
+                                    src_tile, dst_tile, True, 1.0)
+
+
+def floodFill():
+    # Compare flood_fill() against a straightforward implementation, on
+    # random surfaces with transparent tiles (which flood_fill() fills
+    # wholesale) and random bboxes cutting through tiles.
+    N = mypaintlib.TILE_SIZE
+    rng = numpy.random.RandomState(42)
+    one = 1 << 15
+    ntests = 0
+    for i in xrange(40):
+        src = tiledsurface.Surface()
+        blank = []
+        for tx in xrange(-1, 5):
+            for ty in xrange(-1, 5):
+                kind = rng.randint(7)
+                if kind < 2:
+                    blank.append((tx, ty))
+                    continue
+                with src.tile_request(tx, ty, readonly=False) as t:
+                    if kind == 2:
+                        t[:, :, :3] = rng.randint(0, one+1, 3) / 2
+                        t[:, :, 3] = one
+                        continue
+                    if kind in (3, 4):
+                        # Walls across the tile: parts of it can only
+                        # be reached from particular neighbours
+                        t[rng.randint(N), :, 3] = one
+                        t[:, rng.randint(N), 3] = one
+                        continue
+                    for j in xrange(rng.randint(1, 6)):
+                        x0, y0 = rng.randint(0, N, 2)
+                        x1, y1 = rng.randint(0, N, 2)
+                        x0, x1 = sorted((x0, x1))
+                        y0, y1 = sorted((y0, y1))
+                        t[y0:y1+1, x0:x1+1, :3] = one / 2
+                        t[y0:y1+1, x0:x1+1, 3] = one
+        bbx, bby = rng.randint(-N-N/2, N, 2)
+        bbw, bbh = rng.randint(N/2, 5*N, 2)
+        bbox = (int(bbx), int(bby), int(bbw), int(bbh))
+        # Seed in a blank tile inside the bbox if possible, else anywhere
+        inside = [
+            (tx, ty) for (tx, ty) in blank
+            if bbx <= tx*N and (tx+1)*N <= bbx+bbw
+            and bby <= ty*N and (ty+1)*N <= bby+bbh
+        ]
+        if inside and i % 2 == 0:
+            tx, ty = inside[rng.randint(len(inside))]
+            x, y = tx*N + rng.randint(N), ty*N + rng.randint(N)
+        else:
+            x = bbx + rng.randint(bbw)
+            y = bby + rng.randint(bbh)
+        color = tuple(rng.uniform(0, 1, 3))
+        tolerance = [0.0, 0.1, 0.5][i % 3]
+        # Fill into surfaces with existing content, so that compositing
+        # is checked too
+        results = []
+        for fill in (tiledsurface.flood_fill, _flood_fill_reference):
+            dst = tiledsurface.Surface()
+            with dst.tile_request(0, 0, readonly=False) as t:
+                t[:, :N/2, :3] = one / 4
+                t[:, :N/2, 3] = one
+            fill(src, int(x), int(y), color, bbox, tolerance, dst)
+            results.append(dst)
+        new, ref = results
+        positions = set(new.get_tiles().keys())
+        positions.update(ref.get_tiles().keys())
+        for tx, ty in positions:
+            with new.tile_request(tx, ty, readonly=True) as a:
+                with ref.tile_request(tx, ty, readonly=True) as b:
+                    assert (a == b).all(), (
+                        "flood_fill mismatch in tile %r (test %d)"
+                        % ((tx, ty), i))
+        ntests += 1
+    print 'checked', ntests, 'random flood fills'
+
+
 def files_equal(a, b):
     return open(a, 'rb').read() == open(b, 'rb').read()
 
@@ -315,6 +440,7 @@ options, tests = parser.parse_args()
 #layerModes()
 directPaint()
 brushPaint()
+floodFill()
 #    docPaint()
 
 #saveFrame()
@@ -2,6 +2,7 @@
 import sys
 import os
 import tempfile
+import zipfile
 import subprocess
 import gc
 import cProfile
@@ -159,6 +160,50 @@ def load_ora():
     yield stop_measurement
 
 
+@nogui_test
+def load_ora_serial():
+    # Baseline for load_ora: layer PNGs decoded one after another
+    from lib import document
+    d = document.Document()
+    d.load_workers = 1
+    yield start_measurement
+    d.load('bigimage.ora')
+    yield stop_measurement
+
+
+@nogui_test
+def load_ora_lazy():
+    # Time to first paint of a small area, with lazily loaded layers
+    import numpy
+    from lib import document
+    from lib.tiledsurface import N
+    d = document.Document()
+    d.load_lazily = True
+    dst = numpy.zeros((N, N, 4), dtype='uint16')
+    yield start_measurement
+    d.load('bigimage.ora')
+    d.layer_stack.composite_tile(dst, True, 0, 0)
+    yield stop_measurement
+
+
+@nogui_test
+def load_ora_tile_index():
+    # Time to first paint of a small area, from layer tile indexes
+    import numpy
+    from lib import document
+    from lib.tiledsurface import N
+    d = document.Document()
+    d.load('bigimage.ora')
+    d.save_tile_index = True
+    d.save('test_tile_index.ora')
+    d = document.Document()
+    dst = numpy.zeros((N, N, 4), dtype='uint16')
+    yield start_measurement
+    d.load('test_tile_index.ora')
+    d.layer_stack.composite_tile(dst, True, 0, 0)
+    yield stop_measurement
+
+
 @nogui_test
 def save_ora():
     from lib import document
@@ -169,6 +214,31 @@ def save_ora():
     yield stop_measurement
 
 
+@nogui_test
+def save_ora_serial():
+    # Baseline for save_ora: layer PNGs encoded one after another
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    d.save_workers = 1
+    yield start_measurement
+    d.save('test_save.ora')
+    yield stop_measurement
+
+
+@nogui_test
+def save_ora_parallel():
+    # Encoding runs without the GIL, so more workers should help
+    # as long as there are cores for them.
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    d.save_workers = 4
+    yield start_measurement
+    d.save('test_save.ora')
+    yield stop_measurement
+
+
 @nogui_test
 def save_ora_again():
     from lib import document
@@ -180,6 +250,66 @@ def save_ora_again():
     yield stop_measurement
 
 
+@nogui_test
+def save_ora_after_edit():
+    from lib import document, brush
+    d = document.Document()
+    d.load('bigimage.ora')
+    d.save('test_save.ora')
+    layer = d.layer_stack.current
+    b = brush.Brush(brush.BrushInfo(open('brushes/charcoal.myb').read()))
+    for i in xrange(100):
+        layer.stroke_to(b, 100+i, 100+i*2, 1.0, 0.0, 0.0, 0.01)
+    yield start_measurement
+    d.save('test_save.ora')
+    yield stop_measurement
+
+
+@nogui_test
+def save_ora_tempfiles():
+    # Baseline for save_ora_streamed: layer PNGs copied from tempfiles
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    root = d.layer_stack
+    bbox = root.get_bbox()
+    yield start_measurement
+    tmpdir = tempfile.mkdtemp()
+    with zipfile.ZipFile('test_save.ora', 'w') as orazip:
+        for i, (path, layer) in enumerate(root.walk()):
+            tmp = os.path.join(tmpdir, 'layer%d.png' % (i,))
+            layer.save_as_png(tmp, *bbox)
+            orazip.write(tmp, 'data/layer%d.png' % (i,))
+            os.remove(tmp)
+        tmp = os.path.join(tmpdir, 'mergedimage.png')
+        root.save_as_png(tmp, *bbox, alpha=False, background=True)
+        orazip.write(tmp, 'mergedimage.png')
+        os.remove(tmp)
+    os.rmdir(tmpdir)
+    yield stop_measurement
+
+
+@nogui_test
+def save_ora_streamed():
+    # How save_ora writes its PNGs: straight into the zipfile
+    from lib import document
+    from lib.orazipwriter import OraZipWriter
+    d = document.Document()
+    d.load('bigimage.ora')
+    root = d.layer_stack
+    bbox = root.get_bbox()
+    yield start_measurement
+    with zipfile.ZipFile('test_save.ora', 'w') as orazip:
+        writer = OraZipWriter(orazip)
+        for i, (path, layer) in enumerate(root.walk()):
+            writer.write_png('data/layer%d.png' % (i,),
+                             layer.save_as_png, *bbox)
+        writer.write_png('mergedimage.png', root.save_as_png, *bbox,
+                         alpha=False, background=True)
+        writer.flush()
+    yield stop_measurement
+
+
 @nogui_test
 def save_png():
     from lib import document
@@ -228,6 +358,93 @@ def brushengine_paint_hires():
     #s.save('test_paint_hires.png') # approx. 3000x3000
 
 
+@nogui_test
+def flood_fill_large_area():
+    # Filling the inside of a large painted frame, as on a big canvas
+    from lib import tiledsurface
+    from lib.tiledsurface import N
+    src = tiledsurface.Surface()
+    size = 64*N
+    for tx in range(-1, size/N + 1):
+        for ty in (-1, size/N):
+            for tpos in [(tx, ty), (ty, tx)]:
+                with src.tile_request(tpos[0], tpos[1], readonly=False) as a:
+                    a[...] = 1 << 15
+    bbox = (-N, -N, size + 2*N, size + 2*N)
+    yield start_measurement
+    for i in range(3):
+        dst = tiledsurface.Surface()
+        src.flood_fill(size/2, size/2, (1.0, 0.5, 0.0), bbox, 0.1, dst)
+    yield stop_measurement
+
+
+@nogui_test
+def flood_fill_sample_merged():
+    # Repeated fills sampling all layers, each into a new layer
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    x, y, w, h = d.get_effective_bbox()
+    points = [(x + w*i/5, y + h*j/5) for i in range(1, 5) for j in range(1, 5)]
+    yield start_measurement
+    for px, py in points:
+        d.flood_fill(px, py, (1.0, 0.0, 0.0), tolerance=0.2,
+                     sample_merged=True, make_new_layer=True)
+    yield stop_measurement
+
+
+@nogui_test
+def strokemap_pick_stroke():
+    # Picking strokes from a layer with a heavy strokemap, made by
+    # painting the recorded events as many short strokes.
+    from lib import brush, stroke
+    from lib.layer import PaintingLayer
+    bi = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    b = brush.Brush(bi)
+    layer = PaintingLayer()
+    events = loadtxt('painting30sec.dat')
+    t_old = events[0][0]
+    for i in range(0, len(events), 5):
+        st = stroke.Stroke()
+        st.start_recording(b)
+        for t, x, y, pressure in events[i:i+5]:
+            dtime = t - t_old
+            t_old = t
+            st.record_event(dtime, x*5, y*5, pressure, 0.0, 0.0)
+        st.stop_recording()
+        before = layer.save_snapshot()
+        layer.render_stroke(st)
+        layer.add_stroke_shape(st, before)
+    points = [(x*5, y*5) for t, x, y, pressure in events[::10]]
+    yield start_measurement
+    for i in range(3):
+        for x, y in points:
+            layer.get_stroke_info_at(x, y)
+    yield stop_measurement
+
+
+@nogui_test
+def brushengine_replay_stroke():
+    # Replays of a recorded stroke, as done by undo/redo and by
+    # changing the brush of a stroke after painting it.
+    from lib import tiledsurface, brush, stroke
+    bi = brush.BrushInfo(open('brushes/watercolor.myb').read())
+    b = brush.Brush(bi)
+    st = stroke.Stroke()
+    st.start_recording(b)
+    events = loadtxt('painting30sec.dat')
+    t_old = events[0][0]
+    for t, x, y, pressure in events:
+        dtime = t - t_old
+        t_old = t
+        st.record_event(dtime, x*5, y*5, pressure, 0.0, 0.0)
+    st.stop_recording()
+    yield start_measurement
+    for i in range(3):
+        st.render(tiledsurface.Surface())
+    yield stop_measurement
+
+
 @gui_test
 def scroll_nozoom(gui):
     gui.wait_for_idle()